@@ -31,77 +31,65 @@ from tqdm import tqdm as tqdm
 # In this package I have already made scripts that effectively turn the CSV files into raw files using a generator function: `restraws()`. You can find that [here](data/processed/resting.py). It doesn't do anything other than: 1) load the data from CSV; 2) load the channel locations; 3) combine the two to make a neat [`Raw`](http://martinos.org/mne/dev/generated/mne.io.Raw.html) data with a proper montage, all zero-channels set as `bads`, and the subject's name in the info structure. The neat thing is that it does it _on each iteration_, so it loads the data one by one, and removes it from memory when the next one comes up.
 # 
 # Here, I'm going to load that data, then average-ref it and do a time-frequency transform on it. This is already effectively preprocessed. The time-frequency data is saved to the data/interim/freqanalysis.
+# 
+# This runs the same pipeline as `make psds` (in parallel, and it picks up where it left off), see [src/data/resting_psd.py](src/data/resting_psd.py). Subjects that already have a spectrum with these parameters aren't done again, and changing a parameter replaces the old spectra instead of mixing them in with the new ones.
 
 # In[ ]:
 
-from data.processed.resting import restraws, restevents, nrest
+from src.data import resting_psd
 
-for raw in restraws():
-    
-    # output names
-    psdfname = (Path('.') / 'data' / 'interim' / 'freqanalysis' /
-                ('rest-' + raw.info['subject_info'] + '.pickle'))
-    infofname = (Path('.') / 'data' / 'interim' / 'info' /
-                 ('rest-' + raw.info['subject_info'] + '.pickle'))
-    
-    # save the info structure to file (incl bads)
-    with open(infofname, 'wb+') as f:
-        pickle.dump(raw.info, f)
-    
-    # if it exists already, skip
-    if os.path.isfile(psdfname): continue
-        
-    # try cropping it; this will fail if less than 200s; so skip
-    try:
-        raw.crop(tmin=0, tmax=200)
-    except ValueError:
-        continue
-    
-    # average reference
-    raw.set_eeg_reference()
-    raw.apply_proj()
-    
-    # do the time-frequency analysis
-    psd, freqs = mne.time_frequency.psd_multitaper(raw, fmin=1, fmax=30, n_jobs=4)
-    
-    # save TFR and Info to pickle
-    with open(psdfname, 'wb+') as f:
-        pickle.dump((freqs, psd), f)
+# only the first 200s are analysed (subjects with less are skipped), with
+# an average reference and multitaper spectra from 1 to 30 Hz
+resting_psd.main(['--tmax', '200', '--fmin', '1', '--fmax', '30'],
+                 standalone_mode=False)
 
 
 
 # ## Load the data back from pickle
 # 
-# In `data/interim/freqanalysis` [another python script](data/interim/freqanalysis/__init__.py) sits that lets you load the data __back__ into memory via a generator. So here I do that, then fit the linear regression in semilog and loglog space.
+# In `data/interim/freqanalysis` [another python script](data/interim/freqanalysis/__init__.py) sits that collects all the spectra into one subjects x channels x freqs array. So here I load that, then fit the linear regression in semilog and loglog space - for every sensor of every subject at once (see [src/features/powerlaw.py](src/features/powerlaw.py)).
 
 # In[6]:
 
-from data.interim.freqanalysis import psds
+from data.interim import freqanalysis
+from src.features.powerlaw import fit_1f
 import scipy.stats
 
+# put any new pickles into the store, then load all of it
+freqanalysis.consolidate('rest')
+pids, freq, ch_names, psd, params = freqanalysis.load('rest')
+
 alldata = []
 
-for pid, freq, psd in psds():
-    
-    # identify the right frequency band
-    idx = ((freq > 4) & (freq < 7)) | ((freq > 14) & (freq < 24))
-    
-    # fit linear regression in semilog space
-    semilogfits = [scipy.stats.linregress(freq[idx], np.log10(psd.T[idx, sensor]))
-                      for sensor in range(psd.shape[0])]
-    loglogfits  = [scipy.stats.linregress(np.log10(freq[idx]), np.log10(psd.T[idx, sensor]))
-                      for sensor in range(psd.shape[0])]
+# fit linear regression in semilog and loglog space
+# (in 4-7Hz and 14-24Hz; bad channels are NaN). the fits go through the
+# derivation cache, so they are only redone if the stored spectra, the
+# bands or the fitting code change
+from data import derivations
+from src.features import powerlaw
+storefiles = sorted(freqanalysis.storefolder('rest').glob('*.npy'))
+fits = {name: derivations.derive('rest-fit', fit_1f, freq, psd,
+                                 inputs=storefiles,
+                                 params={'bands': powerlaw.bands,
+                                         'space': name},
+                                 version=derivations.code_version(powerlaw)
+                                 ).value
+        for name in ['semilog', 'loglog']}
+print(derivations.report())
+
+for i, pid in enumerate(pids):
     
     # append a dictionary that holds all the relevant info
     datadict = {'EID': pid}
-    for name, fits in [('semilog', semilogfits), ('loglog', loglogfits)]:
+    for name, fit in fits.items():
+        good = ~np.isnan(fit.slope[i])
         datadict.update(
-            {name + 'slopes_individual'    : [fit.slope for fit in fits],
-             name + 'intercept_individual' : [fit.intercept for fit in fits],
-             name + 'rval_individual'      : [fit.rvalue for fit in fits],
-             name + 'slopes_mean'    : np.mean([fit.slope for fit in fits]),
-             name + 'intercept_mean' : np.mean([fit.intercept for fit in fits]),
-             name + 'rval_mean'      : np.mean([fit.rvalue for fit in fits])}
+            {name + 'slopes_individual'    : list(fit.slope[i, good]),
+             name + 'intercept_individual' : list(fit.intercept[i, good]),
+             name + 'rval_individual'      : list(fit.rvalue[i, good]),
+             name + 'slopes_mean'    : np.mean(fit.slope[i, good]),
+             name + 'intercept_mean' : np.mean(fit.intercept[i, good]),
+             name + 'rval_mean'      : np.mean(fit.rvalue[i, good])}
         )
 
     alldata.append(datadict)
@@ -133,6 +121,39 @@ plt.show();
 print(scipy.stats.pearsonr(alldf['loglogslopes_mean'], alldf['loglogintercept_mean']))
 
 
+# ## Every metric against every phenotype
+# 
+# The same correlations for all metrics (every channel and the channel average) against all numeric phenotypes in one go, with permutation p-values, bootstrap confidence intervals and FDR correction (see [src/models/associations.py](src/models/associations.py)). The table is saved to `data/interim/associations`, so a new phenotype can be looked at without running this notebook again.
+
+# In[ ]:
+
+from src.models import associations
+from data.pheno import load_phenotypes
+
+metrics = associations.metric_table(fits, pids, ch_names)
+results = associations.associate(metrics, load_phenotypes(),
+                                  n_permutations=1000, n_bootstrap=1000)
+associations.save(results, 'rest-1f')
+results[results['metric'].str.endswith('_mean')].sort_values('p')
+
+
+# ## Spectra by age
+# 
+# The average spectrum in a few age bins, summarised one subject at a time from the store (see [src/features/aggregate.py](src/features/aggregate.py)), so this doesn't need every spectrum in memory.
+
+# In[ ]:
+
+from src.features.aggregate import aggregate_store
+
+agg = aggregate_store('rest', bins={'Age': [5, 8, 11, 14, 22]}, workers=4)
+for b, (low, high) in agg.binned['Age'].labels().items():
+    moments = agg.binned['Age'][b]
+    plt.semilogy(freq, np.nanmean(moments.mean, axis=0),
+                 label=f'{low:.0f}-{high:.0f} years (n={moments.count.max()})')
+plt.legend()
+plt.show();
+
+
 # In[ ]:
 
 
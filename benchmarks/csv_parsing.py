@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Compare data.csvformat.read_data against np.genfromtxt on a file with the
+# same layout as the HBN csv_format data files (one line per channel).
+#
+#   python -m benchmarks.csv_parsing --n-channels 111 --n-samples 170000
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+
+from data import csvformat
+
+
+def write_fake_csv(fname, n_channels, n_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    # random-walk signals in the uV range with 4 decimals, like the real data
+    data = np.cumsum(rng.randn(n_channels, n_samples), axis=1)
+    np.savetxt(fname, data, delimiter=',', fmt='%.4f')
+    return data
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+@click.command()
+@click.option('--n-channels', default=111)
+@click.option('--n-samples', default=170000)
+@click.option('--tmax', default=200., help='seconds to parse for the '
+              'cropped read (like crop(tmin=0, tmax=200))')
+@click.option('--repeat', default=1)
+@click.option('--skip-genfromtxt', is_flag=True)
+def main(n_channels, n_samples, tmax, repeat, skip_genfromtxt):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = Path(tmpdir) / 'RestingState_data.csv'
+        print(f"Writing a {n_channels} x {n_samples} file...")
+        expected = write_fake_csv(fname, n_channels, n_samples)
+        print(f"File size: {fname.stat().st_size / 1e6:.1f} MB")
+
+        results = {}
+        if not skip_genfromtxt:
+            results['np.genfromtxt'] = timeit(
+                lambda: np.genfromtxt(fname, delimiter=','), repeat)
+        results['read_data (float64)'] = timeit(
+            lambda: csvformat.read_data(fname), repeat)
+        results['read_data (float32)'] = timeit(
+            lambda: csvformat.read_data(fname, dtype='float32'), repeat)
+        results['read_data (known n_channels)'] = timeit(
+            lambda: csvformat.read_data(fname, n_channels=n_channels), repeat)
+        results[f'read_data (tmax={tmax:g}s)'] = timeit(
+            lambda: csvformat.read_data(
+                fname, n_channels=n_channels,
+                n_samples=csvformat.tmax_to_samples(tmax)),
+            repeat)
+
+        baseline = list(results.values())[0][0]
+        for name, (seconds, data) in results.items():
+            # make sure everything parsed the same numbers
+            n = data.shape[1]
+            assert np.allclose(data, expected[:, :n], atol=1e-3)
+            print(f"{name:32s} {seconds:8.2f} s "
+                  f"({baseline / seconds:5.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+# Benchmarks for the loaders, the spectral engines and the 1/f fits, run on
+# a synthetic data set (see src/data/make_synthetic.py) so they work without
+# the real drive. Every benchmark runs in a fresh process, which gives honest
+# import times and a peak memory figure per benchmark. The results are
+# appended to reports/benchmarks.jsonl, and the run fails if a benchmark got
+# slower (or bigger) than the recent history by more than the threshold.
+#
+#   python -m benchmarks.suite --subjects 10
+#   python -m benchmarks.suite --only psd --threshold 0.1
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+project_dir = Path(__file__).resolve().parents[1]
+historyfile = project_dir / 'reports' / 'benchmarks.jsonl'
+datadir = project_dir / 'data' / 'synthetic'
+
+# name -> (setup, run). setup(n_subjects) prepares whatever the benchmark
+# needs and isn't timed; run(state) is timed and returns how many items
+# (subjects) it processed
+benchmarks = {}
+
+
+def benchmark(name):
+    def register(func):
+        setup = getattr(func, 'setup', lambda n: n)
+        benchmarks[name] = (setup, func)
+        return func
+    return register
+
+
+def _with_setup(setup):
+    def attach(func):
+        func.setup = setup
+        return func
+    return attach
+
+
+# --- the benchmarks ---------------------------------------------------------
+
+@benchmark('import-preprocessed')
+def bench_import(n):
+    import data.preprocessed.resting  # noqa: F401
+    import data.preprocessed.surround_suppression  # noqa: F401
+    return 1
+
+
+def _restfiles(n):
+    from data import manifest
+    files = manifest.files('RestingState')
+    return [blocks[0]['data'] for blocks in files.values()][:n]
+
+
+@benchmark('csv-read')
+@_with_setup(_restfiles)
+def bench_csv_read(files):
+    from data import csvformat
+    for fname in files:
+        csvformat.read_data(fname)
+    return len(files)
+
+
+@benchmark('resting-raws')
+def bench_resting_raws(n):
+    from data.preprocessed import resting
+    count = 0
+    for raw, _ in zip(resting.raws(), range(n)):
+        count += 1
+    return count
+
+
+@benchmark('surround-epochs')
+def bench_surround_epochs(n):
+    from data.preprocessed import surround_suppression
+    count = 0
+    for epoch, _ in zip(surround_suppression.epochs(), range(n)):
+        count += 1
+    return count
+
+
+def _resting_arrays(n):
+    from data import npystore
+    return [npystore.read(fname)[0] for fname in _restfiles(n)]
+
+
+@benchmark('psd-multitaper')
+@_with_setup(_resting_arrays)
+def bench_psd(arrays):
+    from src.features import multitaper
+    for data in arrays:
+        multitaper.psd_array(data, 500, fmin=1, fmax=30)
+    return len(arrays)
+
+
+@benchmark('psd-welch-streaming')
+@_with_setup(_restfiles)
+def bench_welch(files):
+    from src.features import welch
+    for fname in files:
+        welch.welch(fname, fmin=1, fmax=30)
+    return len(files)
+
+
+def _spectra(n):
+    import numpy as np
+    # 1/f spectra for n subjects (repeated to make the fit measurable)
+    freqs = np.linspace(1, 30, 59)
+    rng = np.random.default_rng(0)
+    psd = (freqs ** -rng.uniform(1, 2, (n * 10, 111, 1)) *
+           rng.lognormal(0, 0.1, (n * 10, 111, freqs.size)))
+    return freqs, psd
+
+
+@benchmark('fit-1f')
+@_with_setup(_spectra)
+def bench_fit(state):
+    from src.features.powerlaw import fit_1f
+    freqs, psd = state
+    fit_1f(freqs, psd, space='loglog')
+    fit_1f(freqs, psd, space='semilog')
+    return psd.shape[0]
+
+
+# --- running them -----------------------------------------------------------
+
+# the synthetic data set for n subjects (made once, then reused)
+def synthetic_data(n_subjects, seed=0):
+    root = datadir / f'benchmark-{n_subjects}-{seed}'
+    done = root / '.complete'
+    if not done.exists():
+        script = project_dir / 'src' / 'data' / 'make_synthetic.py'
+        subprocess.run([sys.executable, str(script),
+                        str(root), '--subjects', str(n_subjects),
+                        '--missing', '0', '--seed', str(seed)],
+                       check=True, cwd=project_dir)
+        done.touch()
+    return root
+
+
+def _environment(root):
+    env = dict(os.environ)
+    env['HBN_DATA'] = str(root)
+    env['HBN_PHENOTYPES'] = str(root / 'HBN_S1_Pheno_data.csv')
+    env['HBN_MANIFEST'] = str(root / 'manifest.sqlite')
+    return env
+
+
+# runs in the child process: set up, time, report as one json line
+def run_one(name, n_subjects):
+    setup, run = benchmarks[name]
+    state = setup(n_subjects)
+    start = time.perf_counter()
+    items = run(state)
+    seconds = time.perf_counter() - start
+    # (imported afterwards, so it isn't part of the import benchmark)
+    from data.instrument import _peak_rss_mb
+    print(json.dumps({'seconds': seconds, 'items': items,
+                      'peak_rss_mb': _peak_rss_mb()}))
+
+
+def _git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True,
+                                cwd=project_dir).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain',
+                                '--untracked-files=no'],
+                               capture_output=True, text=True,
+                               cwd=project_dir).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _history(name, n_subjects, last):
+    if not historyfile.exists():
+        return []
+    with open(historyfile) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return [entry for entry in entries
+            if entry['benchmark'] == name and
+            entry['subjects'] == n_subjects and
+            entry['status'] == 'ok'][-last:]
+
+
+# compare a result to the median of the recent ones
+def _regressions(entry, history, threshold, rss_threshold):
+    problems = []
+    if not history:
+        return problems
+    seconds = statistics.median(e['seconds'] for e in history)
+    if entry['seconds'] > seconds * (1 + threshold):
+        problems.append(f"time {entry['seconds']:.3f}s vs {seconds:.3f}s")
+    rss = [e['peak_rss_mb'] for e in history if e['peak_rss_mb']]
+    if rss and entry['peak_rss_mb'] and entry['peak_rss_mb'] > \
+            statistics.median(rss) * (1 + rss_threshold):
+        problems.append(f"peak RSS {entry['peak_rss_mb']:.0f}MB vs "
+                        f"{statistics.median(rss):.0f}MB")
+    return problems
+
+
+@click.command()
+@click.option('--subjects', default=10, show_default=True,
+              help='synthetic subjects to generate and run on')
+@click.option('--only', multiple=True,
+              help='only run benchmarks whose name contains this')
+@click.option('--repeat', default=3, show_default=True,
+              help='runs per benchmark (the fastest counts)')
+@click.option('--threshold', default=0.2, show_default=True,
+              help='allowed slowdown against the recent median (0.2 = 20%)')
+@click.option('--rss-threshold', default=0.2, show_default=True,
+              help='allowed growth of peak memory against the recent median')
+@click.option('--last', default=5, show_default=True,
+              help='how many earlier runs make up the baseline')
+@click.option('--record/--no-record', default=True,
+              help='append the results to reports/benchmarks.jsonl')
+@click.option('--allow-errors', is_flag=True,
+              help="don't fail the run when a benchmark crashes (e.g. one "
+              "that needs a different mne)")
+@click.option('--child', hidden=True)
+def main(subjects, only, repeat, threshold, rss_threshold, last, record,
+         allow_errors, child):
+    if child:
+        run_one(child, subjects)
+        return
+
+    root = synthetic_data(subjects)
+    env = _environment(root)
+    # scan the synthetic data set once, so the import benchmark is warm
+    subprocess.run([sys.executable, '-m', 'data.manifest', '--full'],
+                   env=env, cwd=project_dir, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    names = [name for name in benchmarks
+             if not only or any(pattern in name for pattern in only)]
+    commit = _git_commit()
+    failed = []
+    errors = []
+    for name in names:
+        runs = []
+        error = None
+        for _ in range(repeat):
+            proc = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.suite', '--child', name,
+                 '--subjects', str(subjects)],
+                env=env, cwd=project_dir, capture_output=True, text=True)
+            if proc.returncode != 0:
+                error = proc.stderr.strip().splitlines()[-1:]
+                break
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'commit': commit, 'benchmark': name, 'subjects': subjects}
+        if error is not None:
+            entry.update(status='error', message=''.join(error))
+            click.echo(f"{name:24s} error: {entry['message']}")
+            errors.append(name)
+        else:
+            best = min(runs, key=lambda r: r['seconds'])
+            entry.update(
+                status='ok', seconds=best['seconds'], items=best['items'],
+                throughput=best['items'] / best['seconds'],
+                peak_rss_mb=max((r['peak_rss_mb'] or 0) for r in runs) or None
+            )
+            problems = _regressions(entry, _history(name, subjects, last),
+                                    threshold, rss_threshold)
+            rss = (f"{entry['peak_rss_mb']:7.0f} MB"
+                   if entry['peak_rss_mb'] else '      ? MB')
+            click.echo(f"{name:24s} {entry['seconds']:8.3f} s  {rss}  "
+                       f"{entry['throughput']:8.2f} /s"
+                       + (f"  REGRESSION: {'; '.join(problems)}"
+                          if problems else ''))
+            if problems:
+                failed.append(name)
+
+        if record:
+            historyfile.parent.mkdir(parents=True, exist_ok=True)
+            with open(historyfile, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    # a benchmark that crashes fails the run too, unless told otherwise
+    problems = []
+    if failed:
+        problems.append(f"{len(failed)} benchmark(s) regressed: "
+                        f"{', '.join(failed)}")
+    if errors and not allow_errors:
+        problems.append(f"{len(errors)} benchmark(s) crashed: "
+                        f"{', '.join(errors)}")
+    if problems:
+        raise click.ClickException('; '.join(problems))
+
+
+if __name__ == '__main__':
+    main()
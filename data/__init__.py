@@ -1,15 +1,29 @@
 from pathlib import Path
-import pandas as pd
+import os
 
 
-datafolder = Path('/') / 'Volumes' / 'Seagate Expansion Drive' / 'cmi-hbn'
+# the data can be anywhere if HBN_DATA is set (e.g. to a synthetic data set
+# made with src/data/make_synthetic.py); otherwise try the usual drives
+if os.environ.get('HBN_DATA'):
+    datafolder = Path(os.environ['HBN_DATA'])
+else:
+    datafolder = Path('/') / 'Volumes' / 'Seagate Expansion Drive' / \
+        'cmi-hbn'
 
-if not datafolder.exists():
-    datafolder = Path('/') / 'Users' / 'jan' / \
-        'Documents' / 'eeg-data' / 'cmi-hbn'
+    if not datafolder.exists():
+        datafolder = Path('/') / 'Users' / 'jan' / \
+            'Documents' / 'eeg-data' / 'cmi-hbn'
 
-if not datafolder.exists():
-    # try the windows option
-    datafolder = Path('d:') / 'cmi-hbn'
+    if not datafolder.exists():
+        # try the windows option
+        datafolder = Path('d:') / 'cmi-hbn'
 
-phenotypes = pd.read_csv('data/HBN_S1_Pheno_data.csv')
+
+# the phenotype table is only loaded when someone asks for it, so that
+# importing the loaders (or data.download) doesn't have to read it.
+# use data.pheno.load_phenotypes to only load some columns or subjects
+def __getattr__(name):
+    if name == 'phenotypes':
+        from data.pheno import load_phenotypes
+        return load_phenotypes().reset_index()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
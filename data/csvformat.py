@@ -0,0 +1,99 @@
+from pathlib import Path
+import numpy as np
+
+
+# the HBN csv_format data files have one line per channel, and each line
+# holds every sample of that channel separated by commas. that makes them
+# ~200MB of text per recording, which np.genfromtxt turns into millions of
+# python objects before building the array. this reads the file in big
+# binary chunks instead and parses each line straight into a preallocated
+# channels x samples array.
+
+# how many bytes to read at once (one line is usually a couple of MB)
+chunksize = 2 ** 24
+
+
+# count the lines (= channels) in a file without parsing it
+def count_lines(fname, chunksize=chunksize):
+    n = 0
+    last = b'\n'
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            n += chunk.count(b'\n')
+            last = chunk[-1:]
+    # the last line may not end in a newline
+    if last != b'\n':
+        n += 1
+    return n
+
+
+# yield the lines of a file, reading it in large chunks
+def _lines(f, chunksize=chunksize):
+    tail = b''
+    for chunk in iter(lambda: f.read(chunksize), b''):
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+    if tail.strip():
+        yield tail
+
+
+# read a csv_format data file into a channels x samples array.
+#   n_samples: only parse this many samples per channel (at most); the rest
+#              of each line is skipped without being converted
+#   n_channels: the number of lines in the file, if known (e.g. from the
+#               chanlocs). if not given, the file is scanned once to count
+#   dtype: the dtype of the array, e.g. 'float32' to halve the memory
+#   return_flat: also return which channels are all zeros over the whole
+#                recording, not just the samples that were read (the rest
+#                of a line is only parsed if the start of it is all zeros)
+def read_data(fname, n_samples=None, n_channels=None, dtype='float64',
+              chunksize=chunksize, return_flat=False):
+    fname = Path(fname)
+    if n_channels is None:
+        n_channels = count_lines(fname, chunksize=chunksize)
+
+    data = None
+    flat = np.zeros(n_channels, dtype=bool)
+    row = 0
+    with open(fname, 'rb') as f:
+        for line in _lines(f, chunksize=chunksize):
+            if row == n_channels:
+                raise ValueError(f"{fname} has more than {n_channels} lines.")
+            if data is None:
+                # the first line tells us how many samples there are
+                n_available = line.count(b',') + 1
+                if n_samples is not None:
+                    n_available = min(n_samples, n_available)
+                data = np.empty((n_channels, n_available), dtype=dtype)
+            # (fromstring doesn't complain about short lines, so check first)
+            n_values = line.count(b',') + 1
+            if n_values < data.shape[1]:
+                raise ValueError(f"Line {row + 1} of {fname} has "
+                                 f"{n_values} values, expected "
+                                 f"{data.shape[1]}.")
+            data[row, :] = np.fromstring(line, dtype=dtype, sep=',',
+                                         count=data.shape[1])
+            if return_flat and not data[row].any():
+                flat[row] = (n_values == data.shape[1] or
+                             not np.fromstring(line, sep=',').any())
+            row += 1
+
+    if data is None:
+        raise ValueError(f"{fname} is empty.")
+    if row != n_channels:
+        raise ValueError(f"{fname} has {row} lines, expected {n_channels}.")
+
+    if return_flat:
+        return data, flat
+    return data
+
+
+# convert a duration in seconds into the number of samples to read,
+# including the sample at tmax (the same as raw.crop(tmin=0, tmax=tmax))
+def tmax_to_samples(tmax, sfreq=500):
+    if tmax is None:
+        return None
+    return int(round(tmax * sfreq)) + 1
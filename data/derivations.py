@@ -0,0 +1,237 @@
+from collections import namedtuple, defaultdict
+from pathlib import Path
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import time
+
+
+# a cache for the results of each processing stage (spectra, fits, ...).
+# every result is stored under a key made from
+#   - the stage name
+#   - the inputs: a content hash of each input file, or the key of an
+#     upstream result (so a stage is recomputed when anything it was made
+#     from changes, and only then)
+#   - the processing parameters
+#   - the code version: a hash of the source of the functions involved,
+#     plus the versions of numpy / scipy / mne
+# so a changed band limit gives new keys for the stages that use it and
+# everything downstream, while the stages before it are still hits.
+#
+# the results are pickles in data/interim/derivations, and a small sqlite
+# index keeps their size and when they were last used. once the cache gets
+# bigger than max_bytes, the least recently used results are dropped.
+folder = Path(__file__).parent / 'interim' / 'derivations'
+dbfile = folder / 'index.sqlite'
+max_bytes = 20 * 2 ** 30
+
+# hits and misses per stage, in this process
+_stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+Derivation = namedtuple('Derivation', ('key', 'value', 'hit'))
+
+
+def _connect(dbfile=dbfile):
+    dbfile.parent.mkdir(parents=True, exist_ok=True)
+    # several pipeline workers can use the cache at once
+    con = sqlite3.connect(str(dbfile), timeout=60)
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS hashes (
+            path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT);
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, stage TEXT, size INTEGER, created REAL,
+            used REAL);
+    """)
+    return con
+
+
+def _sha1(fname, chunksize=2 ** 24):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# a content hash of a file. the hash is remembered with the size and mtime
+# of the file, so it is only worked out again when the file changes
+def fingerprint(fname):
+    fname = Path(fname).resolve()
+    stat = os.stat(fname)
+    con = _connect()
+    try:
+        row = con.execute('SELECT size, mtime, sha1 FROM hashes '
+                          'WHERE path = ?', (str(fname),)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime):
+            return row[2]
+        sha1 = _sha1(fname)
+        with con:
+            con.execute('INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)',
+                        (str(fname), stat.st_size, stat.st_mtime, sha1))
+        return sha1
+    finally:
+        con.close()
+
+
+# a version string for some code: a hash of the source of the functions
+# (or modules) given, and the versions of the numerical libraries in use
+def code_version(*objs):
+    sha1 = hashlib.sha1()
+    for obj in objs:
+        try:
+            sha1.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            # no source file (e.g. defined interactively): use the bytecode
+            sha1.update(obj.__code__.co_code)
+    for name in ('numpy', 'scipy', 'mne'):
+        if name in sys.modules:
+            version = getattr(sys.modules[name], '__version__', '')
+            sha1.update(f'{name}={version}'.encode())
+    return sha1.hexdigest()
+
+
+# the key of a result.
+#   inputs: files (Path objects) and keys of upstream results (strings)
+#   params: anything json can store
+def key(stage, inputs=(), params=None, version=''):
+    inputs = [fingerprint(x) if isinstance(x, Path) else str(x)
+              for x in inputs]
+    blob = json.dumps({'stage': stage, 'inputs': inputs,
+                       'params': params or {}, 'version': version},
+                      sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def _file(key):
+    return folder / key[:2] / (key + '.pickle')
+
+
+# look up a result. returns (True, value) or (False, None)
+def get(stage, key):
+    try:
+        with open(_file(key), 'rb') as f:
+            value = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        _stats[stage]['misses'] += 1
+        return False, None
+    _stats[stage]['hits'] += 1
+    con = _connect()
+    try:
+        with con:
+            con.execute('UPDATE entries SET used = ? WHERE key = ?',
+                        (time.time(), key))
+    finally:
+        con.close()
+    return True, value
+
+
+# store a result (written to a temporary file first, so readers never see
+# half of it), then make room if the cache has grown too big
+def put(stage, key, value):
+    fname = _file(key)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmpfile = fname.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmpfile, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpfile, fname)
+    now = time.time()
+    con = _connect()
+    try:
+        with con:
+            con.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)',
+                        (key, stage, fname.stat().st_size, now, now))
+    finally:
+        con.close()
+    evict()
+
+
+# the result of func(*args, **params), from the cache if it is there.
+# the version defaults to the source of func; pass code_version(...) of the
+# helpers it calls too, if they should count
+def derive(stage, func, *args, inputs=(), params=None, version=None):
+    if version is None:
+        version = code_version(func)
+    k = key(stage, inputs, params, version)
+    hit, value = get(stage, k)
+    if not hit:
+        value = func(*args, **(params or {}))
+        put(stage, k, value)
+    return Derivation(k, value, hit)
+
+
+# drop the least recently used results until the cache fits in max_bytes
+def evict(max_bytes=max_bytes):
+    con = _connect()
+    try:
+        total, = con.execute('SELECT COALESCE(SUM(size), 0) '
+                             'FROM entries').fetchone()
+        if total <= max_bytes:
+            return
+        for k, size in con.execute('SELECT key, size FROM entries '
+                                   'ORDER BY used').fetchall():
+            try:
+                os.remove(_file(k))
+            except FileNotFoundError:
+                pass
+            with con:
+                con.execute('DELETE FROM entries WHERE key = ?', (k,))
+            total -= size
+            if total <= max_bytes:
+                break
+    finally:
+        con.close()
+
+
+# remove all results (of one stage, or all of them)
+def clear(stage=None):
+    con = _connect()
+    try:
+        query = 'SELECT key FROM entries'
+        rows = (con.execute(query + ' WHERE stage = ?', (stage,))
+                if stage else con.execute(query)).fetchall()
+        for k, in rows:
+            try:
+                os.remove(_file(k))
+            except FileNotFoundError:
+                pass
+            with con:
+                con.execute('DELETE FROM entries WHERE key = ?', (k,))
+    finally:
+        con.close()
+
+
+# hits and misses per stage in this process ({stage: {'hits', 'misses'}})
+def stats():
+    return {stage: dict(counts) for stage, counts in _stats.items()}
+
+
+def reset_stats():
+    _stats.clear()
+
+
+# add hits and misses counted elsewhere (e.g. in a worker process)
+def add_stats(other):
+    for stage, counts in other.items():
+        for kind, count in counts.items():
+            _stats[stage][kind] += count
+
+
+def report(stats=None):
+    stats = _stats if stats is None else stats
+    return ', '.join(f"{stage}: {counts['hits']} hits, "
+                     f"{counts['misses']} misses"
+                     for stage, counts in sorted(stats.items()))
+
+
+if __name__ == '__main__':
+    con = _connect()
+    for stage, n, size in con.execute(
+            'SELECT stage, COUNT(*), SUM(size) FROM entries GROUP BY stage'):
+        print(f"{stage}: {n} results, {size / 2 ** 20:.1f} MB")
+    con.close()
+    if '--clear' in sys.argv:
+        clear()
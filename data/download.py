@@ -1,60 +1,345 @@
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
-
 from data import datafolder
 
 import requests
 import os
+import json
+import time
+import hashlib  # checksums
 import random  # random sampling
 from pathlib import Path  # path operations
 import shutil  # unzip utils
+import tarfile  # streaming extraction
+from pathlib import PurePosixPath
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
 from tqdm import tqdm  # progress bar
 
-s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-
-all_remote_files = s3.list_objects(
-    Bucket='fcp-indi', Prefix='data/Projects/HBN/S1/EEG/'
-)
-
-n_remote = len(all_remote_files['Contents'])
-
-def download_all():
-    print(f"Downloading {n_remote} random data sets.")
-    for fileobj in tqdm(all_remote_files['Contents'], desc='Files'):
-        # request the file
-        requests.get(f"https://s3.amazonaws.com/fcp-indi/{fileobj['Key']}",
-                     stream=True)
-        
-        total_length = int(r.headers.get('content-length'))
-        
-        with open(datafolder / Path(fileobj['Key']).name, 'wb+') as f:
-            for chunk in tqdm(r.iter_content(chunk_size=1024),
-                              total=(total_length / 1024), desc='Bytes'): 
-                if chunk: # filter out keep-alive new chunks
+# where the EEG release lives on S3
+bucket = 'fcp-indi'
+prefix = 'data/Projects/HBN/S1/EEG/'
+# a local copy of the listing, so we don't ask S3 every time
+listingfile = Path(__file__).parent / 'interim' / 's3-listing.json'
+
+
+# list every file in the release (Key, Size and ETag of each). the listing
+# is cached in listingfile and only fetched again once it is older than
+# ttl seconds (or if refresh=True). nothing happens on import any more.
+def list_remote(refresh=False, ttl=24 * 60 * 60):
+    if not refresh and listingfile.exists():
+        with open(listingfile) as f:
+            listing = json.load(f)
+        if (listing['bucket'] == bucket and listing['prefix'] == prefix and
+                time.time() - listing['time'] < ttl):
+            return listing['files']
+
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.client import Config
+    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
+
+    # list_objects only returns 1000 keys at a time, so page through them
+    files = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        files += [{'Key': obj['Key'], 'Size': obj['Size'],
+                   'ETag': obj['ETag']}
+                  for obj in page.get('Contents', [])]
+
+    listingfile.parent.mkdir(parents=True, exist_ok=True)
+    tmpfile = listingfile.with_suffix('.json.tmp')
+    with open(tmpfile, 'w') as f:
+        json.dump({'bucket': bucket, 'prefix': prefix, 'time': time.time(),
+                   'files': files}, f)
+    os.replace(tmpfile, listingfile)
+    return files
+
+
+# the remote files we don't have yet: neither the complete archive nor the
+# folder it extracts into (<EID>.tar.gz -> <EID>/, finished extracting) is
+# in dest
+def missing(fileobjs, dest=datafolder):
+    dest = Path(dest)
+    out = []
+    for fileobj in fileobjs:
+        name = Path(fileobj['Key']).name
+        archive = dest / name
+        if name.endswith('.tar.gz') and is_extracted(dest / name[:-7]):
+            continue
+        if archive.exists() and archive.stat().st_size == fileobj['Size']:
+            continue
+        out.append(fileobj)
+    return out
+
+
+# where the files are served from (can point at a local server for testing)
+baseurl = 'https://s3.amazonaws.com/fcp-indi/'
+# how much to read from the connection at a time
+chunksize = 2 ** 20
+
+
+# one session shared by all download threads, so connections are reused
+def _session(n_connections):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=n_connections, pool_maxsize=n_connections,
+        max_retries=3
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _md5(fname):
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# download one file, carrying on from a .part file if there is one.
+# fileobj is an entry from an S3 listing (with Key, and ideally Size and ETag)
+def _download_file(session, fileobj, dest, baseurl, progress):
+    key = fileobj['Key']
+    size = fileobj.get('Size')
+    etag = fileobj.get('ETag')
+    target = Path(dest) / Path(key).name
+    partfile = target.with_name(target.name + '.part')
+
+    # already done
+    if target.exists() and (size is None or target.stat().st_size == size):
+        progress.update(target.stat().st_size)
+        return target
+
+    offset = partfile.stat().st_size if partfile.exists() else 0
+    # a part file that is longer than the file can't be resumed: start again
+    if size is not None and offset > size:
+        os.remove(partfile)
+        offset = 0
+    if size is None or offset < size:
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            # only resume if the file hasn't changed on the server since
+            if etag:
+                headers['If-Range'] = etag
+        with session.get(baseurl + key, headers=headers, stream=True,
+                         timeout=60) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                # the server sent the whole file, so start from scratch
+                offset = 0
+            progress.update(offset)
+            with open(partfile, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=chunksize):
                     f.write(chunk)
+                    progress.update(len(chunk))
+    else:
+        progress.update(offset)
+
+    # check the file is complete and intact before calling it done
+    actual = partfile.stat().st_size
+    if size is not None and actual != size:
+        # (too short can be resumed, too long has to be downloaded again)
+        if actual > size:
+            os.remove(partfile)
+        raise IOError(f"{key}: got {actual} bytes, expected {size}.")
+    # (the ETag is the md5 of the file, unless it was a multipart upload)
+    if etag and '-' not in etag and _md5(partfile) != etag.strip('"'):
+        os.remove(partfile)
+        raise IOError(f"{key}: checksum doesn't match the ETag.")
+
+    os.replace(partfile, target)
+    return target
+
+
+# download a list of files (entries of an S3 listing) into dest, with a
+# number of transfers in parallel. interrupted downloads are resumed.
+def download(fileobjs, dest=datafolder, workers=4, baseurl=baseurl):
+    fileobjs = list(fileobjs)
+    session = _session(workers)
+    total = sum(fileobj.get('Size', 0) for fileobj in fileobjs)
+    failed = []
+    done = []
+    with tqdm(total=total, unit='B', unit_scale=True,
+              desc=f'{len(fileobjs)} files') as progress:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(_download_file, session, fileobj, dest, baseurl,
+                            progress): fileobj['Key']
+                for fileobj in fileobjs
+            }
+            for future in as_completed(futures):
+                try:
+                    done.append(future.result())
+                except Exception as e:
+                    failed.append(futures[future])
+                    tqdm.write(f"Failed: {futures[future]} ({e})")
+    if failed:
+        print(f"{len(failed)} downloads failed; run again to resume them.")
+    return done
+
+
+def download_all(workers=4):
+    remote = list_remote()
+    todo = missing(remote)
+    print(f"Downloading {len(todo)} of {len(remote)} data sets.")
+    return download(todo, workers=workers)
 
 
-def download_sample(n=10):
+def download_sample(n=10, workers=4):
+    todo = missing(list_remote())
+    n = min(n, len(todo))
     print(f"Downloading {n} random data sets.")
-    for fileobj in tqdm(random.sample(all_remote_files['Contents'], n), desc='Files'):
-        # request the file
-        r = requests.get(f"http://s3.amazonaws.com/fcp-indi/{fileobj['Key']}",
-                         stream=True)
-        
-        total_length = int(r.headers.get('content-length'))
-        
-        with open(datafolder / Path(fileobj['Key']).name, 'wb+') as f:
-            for chunk in tqdm(r.iter_content(chunk_size=1024),
-                              total=(total_length / 1024), desc='Bytes'):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
+    return download(random.sample(todo, n), workers=workers)
+
+
+# the parts of each subject archive we don't use, relative to the subject
+# folder. these are never written to disk when extracting.
+exclude = ['EEG/raw', 'EEG/preprocessed/mat_format',
+           'Eyetracking/idf', 'Eyetracking/idf_format']
+
+
+def _startswith(parts, prefix):
+    return parts[:len(prefix)] == prefix
+
+
+# whether an archive member (<EID>/path/in/subject) should be extracted.
+# include=None means everything that isn't excluded
+def _wanted(name, include=None, exclude=exclude):
+    parts = PurePosixPath(name).parts[1:]
+    if any(_startswith(parts, PurePosixPath(p).parts) for p in exclude):
+        return False
+    if include is None:
+        return True
+    # (keep the folders above an included path too)
+    return any(_startswith(parts, PurePosixPath(p).parts) or
+               _startswith(PurePosixPath(p).parts, parts) for p in include)
+
+
+# the file extract() leaves in a subject folder once everything is in place
+# (a folder without it may be left over from an interrupted extraction)
+donefile = '.extracted'
+
+
+def is_extracted(folder):
+    return (Path(folder) / donefile).exists()
+
 
+# extract a .tar.gz in one pass, only writing the members we want.
+# archive can be a path or a file object (e.g. a download stream); it is read
+# strictly front to back, so it never needs to be on disk in full.
+# everything is unpacked into a temporary folder first and moved into place
+# at the end, so an interrupted extraction doesn't look like a finished one.
+def extract(archive, dest=datafolder, include=None, exclude=exclude,
+            name=None):
+    dest = Path(dest)
+    name = name or Path(archive).name
+    tmpdir = dest / f'.extracting-{name}'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    tmpdir.mkdir(parents=True)
 
-def extract_all(delete_archives=True):
-    local_archives = list(datafolder.glob(pattern='*.tar.gz'))
-    print(f"Extracting {len(local_archives)} files.")
-    for f in tqdm(local_archives):
-        shutil.unpack_archive(f, datafolder, 'gztar')
-        if delete_archives:
+    if isinstance(archive, (str, Path)):
+        tar = tarfile.open(archive, mode='r|gz')
+    else:
+        tar = tarfile.open(fileobj=archive, mode='r|gz')
+    with tar:
+        for member in tar:
+            if not _wanted(member.name, include, exclude):
+                continue
+            if hasattr(tarfile, 'data_filter'):
+                # refuses absolute paths, links out of the folder etc.
+                tar.extract(member, tmpdir, filter='data')
+            else:
+                if member.name.startswith('/') or '..' in member.name:
+                    raise ValueError(f"Unsafe path in {name}: {member.name}")
+                tar.extract(member, tmpdir)
+
+    extracted = []
+    for folder in tmpdir.iterdir():
+        target = dest / folder.name
+        if target.exists():
+            shutil.rmtree(target)
+        os.replace(folder, target)
+        (target / donefile).write_text(name)
+        extracted.append(target)
+    tmpdir.rmdir()
+    return extracted
+
+
+def _extract_file(archive, dest, include, exclude, delete_archive):
+    extracted = extract(archive, dest, include, exclude)
+    if delete_archive:
+        os.remove(archive)
+    return extracted
+
+
+# extract all the archives in dest, several at a time. an archive is only
+# deleted (with delete_archives) once its folder is marked as completely
+# extracted; a folder without the mark is extracted again from the archive
+def extract_all(delete_archives=True, dest=datafolder, workers=4,
+                include=None, exclude=exclude):
+    dest = Path(dest)
+    local_archives = list(dest.glob(pattern='*.tar.gz'))
+    todo = [f for f in local_archives if not is_extracted(dest / f.name[:-7])]
+    if delete_archives:
+        for f in set(local_archives) - set(todo):
             os.remove(f)
+    print(f"Extracting {len(todo)} files.")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_extract_file, f, dest, include, exclude,
+                               delete_archives): f
+                   for f in todo}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                tqdm.write(f"Failed: {futures[future].name} ({e})")
+
+
+# a file object that counts how much has been read from it
+class _ProgressReader:
+    def __init__(self, raw, progress):
+        self.raw = raw
+        self.progress = progress
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size)
+        self.progress.update(len(chunk))
+        return chunk
+
+
+def _stream_file(session, fileobj, dest, baseurl, include, exclude,
+                 progress):
+    with session.get(baseurl + fileobj['Key'], stream=True, timeout=60) as r:
+        r.raise_for_status()
+        return extract(_ProgressReader(r.raw, progress), dest, include,
+                       exclude, name=Path(fileobj['Key']).name)
+
+
+# download and extract in one go, without the archives ever touching the
+# disk. this can't resume a broken transfer (a failed archive is simply
+# fetched again next time), so download() + extract_all() is the safer
+# choice on a flaky connection.
+def download_and_extract(fileobjs, dest=datafolder, workers=4,
+                         baseurl=baseurl, include=None, exclude=exclude):
+    fileobjs = list(fileobjs)
+    session = _session(workers)
+    total = sum(fileobj.get('Size', 0) for fileobj in fileobjs)
+    failed = []
+    with tqdm(total=total, unit='B', unit_scale=True,
+              desc=f'{len(fileobjs)} files') as progress:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(_stream_file, session, fileobj, dest, baseurl,
+                            include, exclude, progress): fileobj['Key']
+                for fileobj in fileobjs
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+                    tqdm.write(f"Failed: {futures[future]} ({e})")
+    if failed:
+        print(f"{len(failed)} archives failed; run again to retry them.")
@@ -0,0 +1,246 @@
+from pathlib import Path
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+# opt-in timing of the loading and analysis stages. nothing is recorded
+# unless it is switched on, either with
+#
+#   HBN_PROFILE=1 python src/data/resting_psd.py         (or =<file>)
+#
+# or from python with instrument.enable(). every stage then writes one
+# record with the subject, the wall and cpu time, the bytes read and the peak
+# memory of the process, as json lines or as a chrome trace (a .json file
+# that chrome://tracing or https://ui.perfetto.dev can open). worker
+# processes inherit the setting and append to the same file. then
+#
+#   python -m data.instrument reports/profile-<time>.jsonl
+#
+# ranks the stages and points out the subjects that took unusually long.
+reportsfolder = Path(__file__).resolve().parents[1] / 'reports'
+
+# (file, format) while recording
+_output = None
+_lock = threading.Lock()
+_local = threading.local()
+_null = contextlib.nullcontext()
+
+
+# start recording to path (default reports/profile-<time>.jsonl). the
+# format is 'chrome' for .json files and 'jsonl' otherwise
+def enable(path=None, format=None):
+    global _output
+    if path is None:
+        path = reportsfolder / \
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}.jsonl"
+    path = Path(path)
+    if format is None:
+        format = 'chrome' if path.suffix == '.json' else 'jsonl'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if format == 'chrome':
+        _start_trace(path)
+    _output = (path, format)
+    # so worker processes started from here write to the same file
+    os.environ['HBN_PROFILE'] = str(path)
+    return path
+
+
+# start a chrome trace with its '[' line, unless there is one already.
+# worker processes call this too when they enable recording, so the file is
+# made under a temporary name and linked into place, which only one of them
+# can do
+def _start_trace(path):
+    if path.exists():
+        return
+    tmpfile = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmpfile.write_text('[\n')
+    try:
+        os.link(tmpfile, path)
+    except FileExistsError:
+        pass
+    finally:
+        tmpfile.unlink()
+
+
+def disable():
+    global _output
+    _output = None
+    os.environ.pop('HBN_PROFILE', None)
+
+
+def enabled():
+    return _output is not None
+
+
+# bytes this process has read so far (linux only; includes the page cache)
+def _read_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+# the peak memory of this process so far, in MB (also used by the
+# benchmarks)
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def _write(record):
+    path, format = _output
+    if format == 'chrome':
+        # the trace viewer is fine with an array that is never closed, so
+        # events can simply be appended (enable wrote the '[')
+        event = {'name': record['stage'], 'cat': 'stage', 'ph': 'X',
+                 'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6,
+                 'pid': record['pid'], 'tid': record['thread'],
+                 'args': {key: value for key, value in record.items()
+                          if key not in ('stage', 'start', 'wall', 'pid',
+                                         'thread')}}
+        with _lock:
+            with open(path, 'a') as f:
+                f.write(json.dumps(event) + ',\n')
+    else:
+        with _lock:
+            with open(path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+# the subject that stages in this thread belong to (unless they say)
+@contextlib.contextmanager
+def subject(pid):
+    previous = getattr(_local, 'subject', None)
+    _local.subject = pid
+    try:
+        yield
+    finally:
+        _local.subject = previous
+
+
+@contextlib.contextmanager
+def _stage(name, pid):
+    start = time.time()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    read = _read_bytes()
+    try:
+        yield
+    finally:
+        end_read = _read_bytes()
+        _write({
+            'stage': name,
+            'subject': pid if pid is not None else getattr(
+                _local, 'subject', None),
+            'start': start,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'read_bytes': (end_read - read if read is not None and
+                           end_read is not None else None),
+            'peak_rss_mb': _peak_rss_mb(),
+            'pid': os.getpid(),
+            'thread': threading.get_ident(),
+        })
+
+
+# time a stage:
+#   with instrument.stage('read', pid):
+#       ...
+# costs next to nothing when recording is off
+def stage(name, subject=None):
+    if _output is None:
+        return _null
+    return _stage(name, subject)
+
+
+# the records in a jsonl or chrome trace file, as a data frame
+def load(path):
+    import pandas as pd
+    path = Path(path)
+    text = path.read_text()
+    if text.lstrip().startswith('['):
+        events = json.loads(text.rstrip().rstrip(',').rstrip() +
+                            ('' if text.rstrip().endswith(']') else ']'))
+        records = [dict(event['args'], stage=event['name'],
+                        start=event['ts'] / 1e6, wall=event['dur'] / 1e6,
+                        pid=event['pid'], thread=event['tid'])
+                   for event in events if event.get('ph') == 'X']
+    else:
+        records = [json.loads(line) for line in text.splitlines()
+                   if line.strip()]
+    return pd.DataFrame(records)
+
+
+# a text summary: the stages ranked by total time, and the subjects that
+# were unusually slow in a stage (robust z-score above threshold)
+def summary(path, top=10, threshold=3.5):
+    import numpy as np
+    import pandas as pd
+    df = load(path)
+    if df.empty:
+        return f"No records in {path}."
+
+    stages = df.groupby('stage').agg(
+        calls=('wall', 'size'), total_s=('wall', 'sum'),
+        mean_s=('wall', 'mean'),
+        p95_s=('wall', lambda x: np.percentile(x, 95)),
+        cpu_s=('cpu', 'sum'), read_mb=('read_bytes', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'),
+    ).sort_values('total_s', ascending=False)
+    stages['read_mb'] /= 2 ** 20
+    stages['share'] = stages['total_s'] / stages['total_s'].sum()
+    lines = [f"{len(df)} records, {df['subject'].nunique()} subjects",
+             '', 'Stages by total wall time:',
+             stages.to_string(float_format=lambda x: f'{x:.3f}')]
+
+    # per subject and stage, compared to the other subjects
+    persubject = df.dropna(subset=['subject']).groupby(
+        ['stage', 'subject'])['wall'].sum().reset_index()
+    outliers = []
+    for name, group in persubject.groupby('stage'):
+        median = group['wall'].median()
+        mad = (group['wall'] - median).abs().median() * 1.4826
+        if mad == 0:
+            continue
+        group = group.assign(z=(group['wall'] - median) / mad,
+                             median_s=median)
+        outliers.append(group[group['z'] > threshold])
+    outliers = [group for group in outliers if len(group)]
+    if outliers:
+        outliers = pd.concat(outliers).sort_values('z', ascending=False)
+        lines += ['', f'Slowest subjects (robust z > {threshold}):',
+                  outliers.head(top).to_string(
+                      index=False, float_format=lambda x: f'{x:.3f}')]
+    else:
+        lines += ['', 'No outlier subjects.']
+    return '\n'.join(lines)
+
+
+# switch on from the environment (this is also how worker processes pick
+# it up)
+if os.environ.get('HBN_PROFILE'):
+    enable(None if os.environ['HBN_PROFILE'] == '1'
+           else os.environ['HBN_PROFILE'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        files = sorted(reportsfolder.glob('profile-*'))
+        if not files:
+            sys.exit(f"No profiles in {reportsfolder}.")
+        path = files[-1]
+    else:
+        path = sys.argv[1]
+    print(summary(path))
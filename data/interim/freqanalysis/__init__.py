@@ -1,19 +1,305 @@
 import numpy as np
 import pickle
+import json
+import os
+import shutil
+import time
 import mne
 from pathlib import Path
 
+from data import derivations
+from data import instrument
 
-picklefolder = Path('data') / 'interim' / 'freqanalysis'
 
+picklefolder = Path(__file__).parent
+
+
+
+# the pickle files of one recording type, as {pid: file}
+def picklefiles(recording='rest'):
+    # the file names are <recording>-<pid>.pickle
+    return {file.stem[len(recording) + 1:]: file
+            for file in picklefolder.glob(pattern=recording + '-*.pickle')}
 
 
 # This generator will produce the freq and psd for each of the pickle files in this folder
-def psds(recording = 'rest'):
-    picklefiles = picklefolder.glob(pattern = recording + '*.pickle')
+# (only for the subjects in subjects, if given; the others aren't opened)
+def psds(recording = 'rest', subjects=None):
+    files = picklefiles(recording)
+    if subjects is not None:
+        subjects = set(subjects)
+        files = {pid: file for pid, file in files.items()
+                 if pid in subjects}
     # load the data and yield it
-    for file in picklefiles:
-        pid = file.name[5:17]
-        with open(file, 'rb') as f:
-            freq, psd = pickle.load(f)
-            yield pid, freq, psd
\ No newline at end of file
+    for pid, file in files.items():
+        with instrument.stage('unpickle', pid):
+            with open(file, 'rb') as f:
+                freq, psd = pickle.load(f)
+        yield pid, freq, psd
+
+
+# The store keeps all the spectra of one recording type in one place:
+#
+#   <recording>.store/params.json     frequencies, channel names, parameters
+#   <recording>.store/<chunk>.npy     subjects x channels x freqs psd array
+#   <recording>.store/<chunk>.json    the subject IDs in that chunk, and
+#                                     a content hash of the pickle each
+#                                     spectrum came from
+#
+# Every append writes a new chunk, and a chunk only becomes visible once its
+# .json is in place (it is written last, and moved into place in one go).
+# So it is safe to read the store while a pipeline is still appending to it.
+def storefolder(recording='rest'):
+    return picklefolder / (recording + '.store')
+
+
+def _write_json(obj, fname):
+    tmpfile = fname.with_suffix('.json.tmp')
+    with open(tmpfile, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmpfile, fname)
+
+
+def _read_json(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _read_params(recording):
+    return _read_json(storefolder(recording) / 'params.json')
+
+
+# the parameters the pickled spectra of a recording type were made with
+# (<recording>-params.json, written by the pipeline that makes them)
+def paramsfile(recording='rest'):
+    return picklefolder / (recording + '-params.json')
+
+
+def pickle_params(recording='rest'):
+    return _read_json(paramsfile(recording))
+
+
+# remove the store of a recording type (the pickles stay)
+def clear(recording='rest'):
+    shutil.rmtree(storefolder(recording), ignore_errors=True)
+
+
+# say which parameters the pickles of a recording type are being made with.
+# if the pickles (or the store) were made with different ones, they are
+# removed, so that old spectra are never mixed in with the new ones.
+# returns whether anything was removed
+def set_params(params, recording='rest'):
+    params = json.loads(json.dumps(params))
+    old = pickle_params(recording)
+    if old is None:
+        stored = _read_params(recording)
+        old = stored['params'] if stored is not None else None
+    removed = old is not None and old != params
+    if removed:
+        for file in picklefiles(recording).values():
+            file.unlink()
+        clear(recording)
+    _write_json(params, paramsfile(recording))
+    return removed
+
+
+# the chunks that are completely written, oldest first, as (file, pids,
+# keys). chunks from before the keys were kept have None for them
+def _chunks(recording):
+    chunks = []
+    for file in sorted(storefolder(recording).glob('*.json')):
+        if file.name == 'params.json':
+            continue
+        with open(file) as f:
+            chunk = json.load(f)
+        if isinstance(chunk, list):
+            chunk = {'pids': chunk, 'keys': [None] * len(chunk)}
+        chunks.append((file.with_suffix('.npy'), chunk['pids'],
+                       chunk['keys']))
+    return chunks
+
+
+# put the rows of a spectrum that only has some channels (psd_multitaper
+# leaves out the bad ones) into a full-size array, with NaN for the others
+def expand(psd, ch_names, all_ch_names):
+    full = np.full((len(all_ch_names), psd.shape[-1]), np.nan,
+                   dtype=psd.dtype)
+    index = {ch: i for i, ch in enumerate(all_ch_names)}
+    full[[index[ch] for ch in ch_names]] = psd
+    return full
+
+
+# add spectra to the store.
+#   pids: the subject IDs
+#   freqs: the frequencies (must be the same for everything in the store)
+#   psd: subjects x channels x freqs array
+#   ch_names: the channel names (must be the same for everything in the store)
+#   params: anything else worth remembering (fmin, fmax, tmax, ...)
+#   keys: what identifies each spectrum (see consolidate), if anything
+def append(pids, freqs, psd, ch_names, params=None, recording='rest',
+           keys=None):
+    psd = np.asarray(psd)
+    if psd.shape != (len(pids), len(ch_names), len(freqs)):
+        raise ValueError(f"psd has shape {psd.shape}, expected "
+                         f"{(len(pids), len(ch_names), len(freqs))}.")
+
+    folder = storefolder(recording)
+    folder.mkdir(parents=True, exist_ok=True)
+    stored = _read_params(recording)
+    newparams = {'freqs': np.asarray(freqs).tolist(),
+                 'ch_names': list(ch_names),
+                 'params': params or {}}
+    if stored is None:
+        _write_json(newparams, folder / 'params.json')
+    elif stored != json.loads(json.dumps(newparams)):
+        raise ValueError(f"The spectra don't match the ones in {folder} "
+                         "(different frequencies, channels or parameters).")
+
+    # chunk names sort by time and can't clash between processes
+    chunk = folder / f'{time.time_ns():020d}-{os.getpid()}'
+    tmpfile = chunk.with_suffix('.npy.tmp')
+    with open(tmpfile, 'wb') as f:
+        np.save(f, psd)
+    os.replace(tmpfile, chunk.with_suffix('.npy'))
+    _write_json({'pids': list(pids),
+                 'keys': list(keys) if keys is not None else
+                 [None] * len(pids)}, chunk.with_suffix('.json'))
+
+
+# the subject IDs that are in the store
+def index(recording='rest'):
+    pids = {}
+    for _, chunkpids, _ in _chunks(recording):
+        pids.update(dict.fromkeys(chunkpids))
+    return list(pids)
+
+
+# the key of the newest copy of every subject in the store
+def keys(recording='rest'):
+    newest = {}
+    for _, chunkpids, chunkkeys in _chunks(recording):
+        newest.update(zip(chunkpids, chunkkeys))
+    return newest
+
+
+# read (part of) the store.
+#   subjects: list of subject IDs (default all)
+#   channels: list of channel names or indices (default all)
+#   fmin, fmax: frequency band (default all)
+# returns pids, freqs, ch_names, psd (subjects x channels x freqs), params.
+# if a subject was stored more than once, the newest spectrum wins.
+def load(recording='rest', subjects=None, channels=None, fmin=None,
+         fmax=None):
+    stored = _read_params(recording)
+    if stored is None:
+        raise FileNotFoundError(f"There is no store in "
+                                f"{storefolder(recording)}.")
+
+    freqs = np.array(stored['freqs'])
+    ch_names = stored['ch_names']
+
+    # which frequencies
+    fmask = np.ones(freqs.size, dtype=bool)
+    if fmin is not None:
+        fmask &= freqs >= fmin
+    if fmax is not None:
+        fmask &= freqs <= fmax
+    fidx = np.flatnonzero(fmask)
+    fslice = slice(fidx[0], fidx[-1] + 1) if fidx.size else slice(0, 0)
+
+    # which channels
+    if channels is None:
+        chidx = slice(None)
+    else:
+        chidx = [ch_names.index(ch) if isinstance(ch, str) else ch
+                 for ch in channels]
+        ch_names = [ch_names[i] for i in chidx]
+
+    # where the newest copy of each subject lives
+    where = {}
+    chunks = _chunks(recording)
+    for c, (_, chunkpids, _) in enumerate(chunks):
+        for i, pid in enumerate(chunkpids):
+            where[pid] = (c, i)
+    if subjects is None:
+        subjects = list(where)
+    subjects = [pid for pid in subjects if pid in where]
+
+    psd = np.empty((len(subjects), len(ch_names),
+                    fslice.stop - fslice.start))
+    # memory-map each chunk once, and only read the parts we need
+    for c, (chunkfile, _, _) in enumerate(chunks):
+        rows = [(out, where[pid][1]) for out, pid in enumerate(subjects)
+                if where[pid][0] == c]
+        if not rows:
+            continue
+        data = np.load(chunkfile, mmap_mode='r')
+        for out, row in rows:
+            psd[out] = data[row][chidx, fslice]
+
+    return subjects, freqs[fslice], ch_names, psd, stored['params']
+
+
+# the spectra in the store one subject at a time, like psds() but full-size
+# (bad channels are NaN), reading batchsize subjects at once
+def iterate(recording='rest', subjects=None, batchsize=64, **kwargs):
+    if subjects is None:
+        subjects = index(recording)
+    for start in range(0, len(subjects), batchsize):
+        pids, freqs, _, psd, _ = load(recording,
+                                      subjects[start:start + batchsize],
+                                      **kwargs)
+        for pid, subjectpsd in zip(pids, psd):
+            yield pid, freqs, subjectpsd
+
+
+# put all the pickled spectra into the store, using the pickled info
+# structures (from the resting state analysis) for the channel names.
+# only the pickles that aren't in the store yet are read: each stored
+# spectrum keeps a content hash of its pickle, so a subject whose pickle
+# was written again (e.g. the data or the code changed) is added again,
+# and load() then returns the new spectrum.
+# params: the parameters the spectra were made with (default: the ones
+#         the pickles were made with, see set_params, or else the ones the
+#         store already has). if the store was made with other parameters,
+#         it is emptied and filled again from the pickles
+def consolidate(recording='rest', params=None, batchsize=64):
+    infofolder = picklefolder.parent / 'info'
+    stored = _read_params(recording)
+    if params is None:
+        params = pickle_params(recording)
+    if params is None:
+        params = stored['params'] if stored is not None else {}
+    if stored is not None and \
+            stored['params'] != json.loads(json.dumps(params)):
+        clear(recording)
+        stored = None
+    stored = keys(recording) if stored is not None else {}
+    # (the hashes are remembered with the size and mtime of the pickles, so
+    # unchanged ones aren't read)
+    current = {pid: derivations.fingerprint(file)
+               for pid, file in picklefiles(recording).items()}
+    new = [pid for pid, key in current.items() if stored.get(pid) != key]
+    batch = []
+
+    def flush():
+        if batch:
+            pids, freqs, psd, all_ch_names = zip(*batch)
+            append(pids, freqs[0], np.stack(psd), all_ch_names[0],
+                   params=params, recording=recording,
+                   keys=[current[pid] for pid in pids])
+            batch.clear()
+
+    for pid, freq, psd in psds(recording, subjects=new):
+        with open(infofolder / f'{recording}-{pid}.pickle', 'rb') as f:
+            info = pickle.load(f)
+        # psd_multitaper leaves out the bad channels
+        ch_names = [ch for ch in info['ch_names'] if ch not in info['bads']]
+        batch.append((pid, freq, expand(psd, ch_names, info['ch_names']),
+                      info['ch_names']))
+        if len(batch) == batchsize:
+            flush()
+    flush()
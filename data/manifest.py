@@ -0,0 +1,199 @@
+from pathlib import Path
+import os
+import re
+import sqlite3
+import sys
+
+from data import datafolder
+from data import instrument
+
+
+# globbing thousands of subject folders every time one of the loader modules
+# is imported is slow, so we keep a list of every csv file in a small sqlite
+# database instead. it maps subject -> task -> block -> file, with the size
+# and mtime of each file, and remembers the mtime of every folder it listed
+# so that rescans only need to look at folders that changed.
+#
+# HBN_MANIFEST can point somewhere else, e.g. to keep a synthetic data set's
+# manifest apart from the real one
+if os.environ.get('HBN_MANIFEST'):
+    dbfile = Path(os.environ['HBN_MANIFEST'])
+else:
+    dbfile = Path(__file__).parent / 'interim' / 'manifest.sqlite'
+
+# the folders (relative to a subject folder) that hold csv files we care about
+leaves = {
+    'preprocessed': Path('EEG') / 'preprocessed' / 'csv_format',
+    'raw': Path('EEG') / 'raw' / 'csv_format',
+    'behavioral': Path('Behavioral') / 'csv_format',
+}
+
+# e.g. SurroundSupp_Block1_data, RestingState_event, SurroundSupp_Block2
+filepattern = re.compile(
+    r'^(?P<task>.+?)(?:_Block(?P<block>\d+))?'
+    r'(?:_(?P<kind>data|event|chanlocs))?$'
+)
+
+# which roots have already been checked in this process
+_updated = set()
+
+
+def _connect(dbfile=dbfile):
+    dbfile.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(dbfile))
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY, subject TEXT, mtime REAL);
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, subject TEXT, stage TEXT, task TEXT,
+            block INTEGER, kind TEXT, size INTEGER, mtime REAL);
+        CREATE INDEX IF NOT EXISTS files_task ON files (task, stage);
+    """)
+    return con
+
+
+# work out task, block and kind from a file name
+def parse_name(name, subject, stage):
+    stem = name[:-len('.csv')]
+    # behavioral (and some raw) files start with the subject ID
+    if stem.startswith(subject + '_'):
+        stem = stem[len(subject) + 1:]
+    match = filepattern.match(stem)
+    kind = match.group('kind')
+    if kind is None:
+        kind = 'behavioral' if stage == 'behavioral' else 'other'
+    return match.group('task'), int(match.group('block') or 0), kind
+
+
+# (re-)list one leaf folder of one subject
+def _scan_leaf(con, subject, stage, leaf):
+    con.execute('DELETE FROM files WHERE subject = ? AND stage = ?',
+                (subject, stage))
+    try:
+        mtime = os.stat(leaf).st_mtime
+    except FileNotFoundError:
+        con.execute('DELETE FROM dirs WHERE path = ?', (str(leaf),))
+        return
+    rows = []
+    for entry in os.scandir(leaf):
+        if not entry.name.endswith('.csv') or not entry.is_file():
+            continue
+        stat = entry.stat()
+        task, block, kind = parse_name(entry.name, subject, stage)
+        rows.append((entry.path, subject, stage, task, block, kind,
+                     stat.st_size, stat.st_mtime))
+    con.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)',
+                    rows)
+    con.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)',
+                (str(leaf), subject, mtime))
+
+
+def _scan_subjects(con, root, full):
+    known = {subject for subject, in con.execute(
+        'SELECT DISTINCT subject FROM dirs')}
+    dirmtimes = dict(con.execute('SELECT path, mtime FROM dirs'))
+    current = set()
+
+    for entry in os.scandir(root):
+        if not entry.is_dir():
+            continue
+        subject = entry.name
+        current.add(subject)
+        if subject in known and not full:
+            continue
+        for stage, leaf in leaves.items():
+            leaf = Path(entry.path) / leaf
+            try:
+                mtime = os.stat(leaf).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime is None or dirmtimes.get(str(leaf)) != mtime:
+                _scan_leaf(con, subject, stage, leaf)
+        # remember the subject folder itself, even if it has no csv files
+        con.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)',
+                    (entry.path, subject, entry.stat().st_mtime))
+
+    # forget subjects that were deleted
+    for subject in known - current:
+        con.execute('DELETE FROM files WHERE subject = ?', (subject,))
+        con.execute('DELETE FROM dirs WHERE subject = ?', (subject,))
+
+
+# bring the manifest up to date with what is on disk.
+#   full=False: only look at subject folders that are new or gone (cheap,
+#               and skipped entirely if the data folder itself is unchanged)
+#   full=True: also stat the csv folders of every known subject and relist
+#              the ones that changed
+def scan(root=datafolder, full=False, dbfile=dbfile):
+    root = Path(root)
+    try:
+        rootmtime = os.stat(root).st_mtime
+    except FileNotFoundError:
+        return
+
+    con = _connect(dbfile)
+    with con:
+        meta = dict(con.execute('SELECT key, value FROM meta'))
+        # a different data folder means none of the entries are valid
+        if meta.get('root') != str(root):
+            con.execute('DELETE FROM files')
+            con.execute('DELETE FROM dirs')
+            meta = {}
+
+        # subjects were only added or removed if the data folder changed
+        if full or meta.get('mtime') != repr(rootmtime):
+            _scan_subjects(con, root, full)
+
+        con.executemany('INSERT OR REPLACE INTO meta VALUES (?,?)',
+                        [('root', str(root)), ('mtime', repr(rootmtime))])
+    con.close()
+
+
+# cheap check that runs once per process before the first query
+def update(root=datafolder, dbfile=dbfile):
+    if (str(root), str(dbfile)) not in _updated:
+        with instrument.stage('manifest'):
+            scan(root, full=False, dbfile=dbfile)
+        _updated.add((str(root), str(dbfile)))
+
+
+# all rows for one task, as dictionaries
+def records(task=None, stages=None, root=datafolder, dbfile=dbfile):
+    update(root, dbfile)
+    query = 'SELECT * FROM files'
+    conditions, args = [], []
+    if task is not None:
+        conditions.append('task = ?')
+        args.append(task)
+    if stages is not None:
+        conditions.append(f"stage IN ({','.join('?' * len(stages))})")
+        args.extend(stages)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY subject, block, kind'
+    con = _connect(dbfile)
+    con.row_factory = sqlite3.Row
+    rows = [dict(row) for row in con.execute(query, args)]
+    con.close()
+    return rows
+
+
+# the files for one task, as {subject: {block: {kind: path}}}, sorted by
+# subject and block. files without a block number are in block 0.
+def files(task, stages=('preprocessed', 'behavioral'), root=datafolder,
+          dbfile=dbfile):
+    out = {}
+    for row in records(task, stages, root, dbfile):
+        out.setdefault(row['subject'], {}).setdefault(
+            row['block'], {})[row['kind']] = Path(row['path'])
+    return out
+
+
+if __name__ == '__main__':
+    scan(full='--full' in sys.argv)
+    con = _connect()
+    n_subjects, n_files = con.execute(
+        'SELECT COUNT(DISTINCT subject), COUNT(*) FROM files').fetchone()
+    print(f"{n_files} files from {n_subjects} subjects in {dbfile}.")
@@ -0,0 +1,67 @@
+import hashlib
+from pathlib import Path
+import numpy as np
+import mne
+
+
+# almost every recording uses the same 111-channel HydroCel layout, so there
+# is no point in parsing the chanlocs csv and building a Montage and an Info
+# for each one. everything here is cached by the *content* of the chanlocs
+# file, so a subject with a different layout still gets its own.
+
+# parsed channel locations: digest -> (ch_names, positions)
+_chanlocs = {}
+# info templates: (digest, sfreq) -> mne.Info
+_infos = {}
+# 2d scalp positions for topomaps: digest of the 3d locations -> array
+_topomaps = {}
+
+
+def _digest(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+# the channel names and x/y/z positions in a chanlocs file
+def read_chanlocs(chanlocfile):
+    content = Path(chanlocfile).read_bytes()
+    key = _digest(content)
+    if key not in _chanlocs:
+        import pandas as pd
+        chanlocs = pd.read_csv(chanlocfile)
+        _chanlocs[key] = (list(chanlocs['labels']),
+                          np.array(chanlocs.loc[:, ('X', 'Y', 'Z')]))
+    return key, _chanlocs[key]
+
+
+# an info structure (with montage) for a chanlocs file. this is a copy of a
+# cached template, so it can be changed freely (bads, subject_info, ...)
+def create_info(chanlocfile, sfreq=500):
+    key, (ch_names, pos) = read_chanlocs(chanlocfile)
+    if (key, sfreq) not in _infos:
+        # make a montage from the chanlocs
+        mtg = mne.channels.Montage(
+            pos, ch_names, 'custom', range(len(ch_names))
+        )
+        # make an info structure
+        _infos[(key, sfreq)] = mne.create_info(ch_names=ch_names,
+                                               sfreq=sfreq, ch_types='eeg',
+                                               montage=mtg)
+    return _infos[(key, sfreq)].copy()
+
+
+# the 2d positions plot_topomap needs, for the channels in picks (default all
+# eeg channels that aren't bad, like mne.pick_types). the projection is worked
+# out once per layout for all channels, and then just indexed.
+def topomap_coords(info, picks=None):
+    if picks is None:
+        picks = mne.pick_types(info, eeg=True)
+    allpicks = mne.pick_types(info, eeg=True, exclude=[])
+    locs = np.array([info['chs'][i]['loc'][:3] for i in allpicks])
+    key = _digest(locs.tobytes() +
+                  ','.join(info['ch_names'][i] for i in allpicks).encode())
+    if key not in _topomaps:
+        _topomaps[key] = mne.channels.layout._auto_topomap_coords(
+            info, picks=allpicks
+        )
+    rows = {pick: row for row, pick in enumerate(allpicks)}
+    return _topomaps[key][[rows[pick] for pick in picks]]
@@ -0,0 +1,124 @@
+from pathlib import Path
+import json
+import os
+import sys
+import numpy as np
+from tqdm import tqdm
+
+from data import datafolder
+from data import csvformat
+
+
+# the binary store sits right next to the csv it was made from:
+#   RestingState_data.csv -> RestingState_data.npy + RestingState_data.json
+# the .npy holds the channels x samples array, the .json sidecar holds the
+# channel names, sampling rate, flat channels and the stats of the source csv
+# (so we notice when the csv changes and the cache goes stale)
+def npyfile(csvfile):
+    return Path(csvfile).with_suffix('.npy')
+
+
+def sidecarfile(csvfile):
+    return Path(csvfile).with_suffix('.json')
+
+
+def _chanlocfile(csvfile):
+    csvfile = Path(csvfile)
+    return csvfile.with_name(
+        csvfile.name.replace('_data.csv', '_chanlocs.csv'))
+
+
+def _source_stats(csvfile):
+    stat = os.stat(csvfile)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+# turn one csv file into a binary entry. this is the slow part and
+# only ever needs to happen once per file
+def convert(csvfile, sfreq=500, overwrite=False):
+    csvfile = Path(csvfile)
+    if not overwrite and load(csvfile) is not None:
+        return npyfile(csvfile)
+
+    data = csvformat.read_data(csvfile)
+
+    # channel names come from the chanlocs file if there is one
+    chanlocfile = _chanlocfile(csvfile)
+    if chanlocfile.exists():
+        import pandas as pd
+        ch_names = list(pd.read_csv(chanlocfile)['labels'])
+    else:
+        ch_names = None
+
+    sidecar = {
+        'ch_names': ch_names,
+        'sfreq': sfreq,
+        'shape': list(data.shape),
+        'dtype': str(data.dtype),
+        'flat': np.all(data == 0, axis=1).tolist(),
+        'source': _source_stats(csvfile),
+    }
+
+    # write to temporary names first and move into place afterwards, so an
+    # interrupted conversion never leaves a half-written cache entry behind
+    tmpnpy = npyfile(csvfile).with_suffix('.npy.tmp')
+    tmpjson = sidecarfile(csvfile).with_suffix('.json.tmp')
+    with open(tmpnpy, 'wb') as f:
+        np.save(f, data)
+    with open(tmpjson, 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(tmpnpy, npyfile(csvfile))
+    os.replace(tmpjson, sidecarfile(csvfile))
+
+    return npyfile(csvfile)
+
+
+# memory-map a cache entry. returns None if it is missing or stale.
+# mmap_mode 'c' (copy-on-write) means nothing is read until it is touched,
+# and in-place operations like re-referencing only copy the pages they change
+def load(csvfile, mmap_mode='c'):
+    csvfile = Path(csvfile)
+    try:
+        with open(sidecarfile(csvfile)) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # stale if the csv was replaced after the conversion
+    if csvfile.exists() and sidecar['source'] != _source_stats(csvfile):
+        return None
+
+    try:
+        data = np.load(npyfile(csvfile), mmap_mode=mmap_mode)
+    except (OSError, ValueError):
+        return None
+
+    return data, sidecar
+
+
+# read the data for one csv file, from the binary store if possible and
+# from the csv if not. returns the data and a boolean mask of flat channels.
+# n_samples only reads the start of the recording (see csvformat.read_data);
+# the flat channels are always the ones that are flat over the whole
+# recording, whichever way the data was read
+def read(csvfile, n_samples=None, n_channels=None):
+    entry = load(csvfile)
+    if entry is not None:
+        data, sidecar = entry
+        return data[:, :n_samples], np.array(sidecar['flat'], dtype=bool)
+
+    return csvformat.read_data(csvfile, n_samples=n_samples,
+                               n_channels=n_channels, return_flat=True)
+
+
+# convert every data csv we can find
+def convert_all(pattern='*/EEG/preprocessed/csv_format/*_data.csv',
+                overwrite=False):
+    csvfiles = sorted(datafolder.glob(pattern=pattern))
+    print(f"Converting {len(csvfiles)} files.")
+    for csvfile in tqdm(csvfiles):
+        convert(csvfile, overwrite=overwrite)
+
+
+if __name__ == '__main__':
+    convert_all(overwrite='--overwrite' in sys.argv)
@@ -0,0 +1,127 @@
+from pathlib import Path
+import os
+
+from data import tables
+
+
+# the phenotypic data that comes with the release, and a columnar copy of it
+# that is rebuilt whenever the csv changes. if HBN_PHENOTYPES is set, that
+# file is used instead (e.g. the one that goes with a synthetic data set),
+# with its copy next to it
+if os.environ.get('HBN_PHENOTYPES'):
+    phenofile = Path(os.environ['HBN_PHENOTYPES'])
+    cachefile = phenofile.with_suffix('')
+else:
+    phenofile = Path(__file__).parent / 'HBN_S1_Pheno_data.csv'
+    cachefile = Path(__file__).parent / 'interim' / 'phenotypes'
+
+# the columns we know about, and their types
+dtypes = {
+    'EID': str,
+    'Sex': 'int8',
+    'Age': 'float64',
+    'EHQ_Total': 'float64',
+    'Study_Site': 'int8',
+    'Commercial_Use': 'category',
+}
+
+# the tables we have loaded in this process, keyed by the csv's mtime
+_memo = {}
+
+
+def _build_cache():
+    import pandas as pd
+    df = pd.read_csv(phenofile, dtype={key: value
+                                       for key, value in dtypes.items()
+                                       if key != 'EID'})
+    df['EID'] = df['EID'].astype(str)
+    tables.write(df, cachefile)
+    return df
+
+
+# index a table by EID, with every subject once: the release lists
+# NDARAV031PPJ twice (with the same values), and only the first row is kept
+def _by_eid(df):
+    df = df.set_index('EID')
+    return df[~df.index.duplicated()]
+
+
+def _table():
+    csvmtime = os.stat(phenofile).st_mtime
+    if csvmtime not in _memo:
+        cache = tables.tablefile(cachefile)
+        if cache.exists() and cache.stat().st_mtime >= csvmtime:
+            df = tables.read(cachefile)
+        else:
+            df = _build_cache()
+        _memo.clear()
+        _memo[csvmtime] = _by_eid(df)
+    return _memo[csvmtime]
+
+
+# load the phenotypic data, indexed by EID (one row per subject).
+#   columns: only return these columns
+#   eids: only return these subjects (missing ones are left out)
+def load_phenotypes(columns=None, eids=None):
+    # a worker that only wants a few columns doesn't need the whole table
+    if columns is not None and not _memo:
+        cache = tables.tablefile(cachefile)
+        if cache.exists() and cache.stat().st_mtime >= os.stat(
+                phenofile).st_mtime:
+            df = _by_eid(tables.read(cachefile,
+                                     columns=['EID'] + list(columns)))
+            return df if eids is None else df[df.index.isin(list(eids))]
+
+    df = _table()
+    if columns is not None:
+        df = df[list(columns)]
+    if eids is not None:
+        df = df[df.index.isin(list(eids))]
+    return df.copy()
+
+
+# which of pids pass a subject filter, in their original order. the filter
+# is resolved here, against the phenotype table, so the loaders never open
+# the files of subjects that would be dropped later. subjects can be
+#   - None: everyone
+#   - a list (or set) of EIDs
+#   - a dict of phenotype criteria, all of which have to hold:
+#       {'Age': (5, 10)}       between 5 and 10 (inclusive; None = open)
+#       {'Sex': 1}             equal to
+#       {'Study_Site': [1, 3]} one of
+#   - a query string for DataFrame.query, e.g. 'Age < 10 and Sex == 0'
+#   - a function of the phenotype table that returns a boolean mask
+# subjects without phenotypic data only pass an EID list
+def select_subjects(pids, subjects=None):
+    pids = list(pids)
+    if subjects is None:
+        return pids
+    if isinstance(subjects, (str, dict)) or callable(subjects):
+        eids = set(_matching(subjects, pids))
+    else:
+        eids = set(subjects)
+    return [pid for pid in pids if pid in eids]
+
+
+def _matching(subjects, pids):
+    import numpy as np
+    if isinstance(subjects, dict):
+        df = load_phenotypes(columns=list(subjects), eids=pids)
+        mask = np.ones(len(df), dtype=bool)
+        for column, value in subjects.items():
+            if isinstance(value, tuple):
+                low, high = value
+                if low is not None:
+                    mask &= (df[column] >= low).to_numpy()
+                if high is not None:
+                    mask &= (df[column] <= high).to_numpy()
+            elif isinstance(value, (list, set, frozenset)):
+                mask &= df[column].isin(list(value)).to_numpy()
+            else:
+                mask &= (df[column] == value).to_numpy()
+    else:
+        df = load_phenotypes(eids=pids)
+        if isinstance(subjects, str):
+            return df.query(subjects).index
+        mask = np.asarray(subjects(df), dtype=bool)
+    return df.index[mask]
@@ -0,0 +1,202 @@
+import collections
+import contextlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# the generators in this package load one subject at a time, so the CPU
+# waits while a file is read and the disk waits while a spectrum is
+# computed. prefetch() loads the next few subjects in the background while
+# the current one is being analysed:
+#
+#   for raw in prefetch(resting.raws(), depth=2):
+#       ...
+#
+# or, to load several subjects at once on a thread pool:
+#
+#   for raw in prefetch(resting.read_raw, subjects=resting.restfiles['id'],
+#                       depth=4, workers=2):
+#       ...
+#
+# items always come out in the original order. threads (rather than
+# processes) are used so the loaded data never has to be pickled; reading
+# files and parsing with numpy release the GIL for most of the work.
+#
+# when a generator fails, prefetch can only name the subject if the error
+# says which one it was: the loaders' generators load each subject inside
+# loading(pid), which does that.
+
+
+class PrefetchError(Exception):
+    # raised in the consuming loop when loading a subject failed. the
+    # original exception is attached as __cause__
+    def __init__(self, subject, index, error):
+        self.subject = subject
+        self.index = index
+        super().__init__(f"Loading subject {subject} (item {index}) "
+                         f"failed: {error!r}")
+
+
+# mark an error raised while loading a subject with its ID (as
+# error.subject), so prefetch knows which subject failed:
+#   for pid in pids:
+#       with loading(pid):
+#           raw = read_raw(pid)
+#       yield raw
+@contextlib.contextmanager
+def loading(subject):
+    try:
+        yield
+    except Exception as e:
+        if getattr(e, 'subject', None) is None:
+            e.subject = subject
+        raise
+
+
+# roughly how much memory an item takes up (Raw / Epochs, arrays, or tuples
+# of those, like the (pid, freq, psd) tuples from psds())
+def nbytes(item):
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    if isinstance(item, (tuple, list)):
+        return sum(nbytes(x) for x in item)
+    data = getattr(item, '_data', None)
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    return 0
+
+
+# the subject ID of a loaded item, if it has one
+def _subject(item):
+    info = getattr(item, 'info', None)
+    if info is not None:
+        return info.get('subject_info')
+    if isinstance(item, tuple) and item and isinstance(item[0], str):
+        return item[0]
+    return None
+
+
+# wrap an iterable (or a loading function plus a list of subjects) so that
+# the next items are loaded in the background.
+#   depth: how many items to load ahead
+#   max_bytes: don't load further ahead once the waiting items take up this
+#              much memory (at least one item is always loaded). the size of
+#              an item is only known once it is loaded, so the waiting items
+#              can go over max_bytes by the last one
+#   subjects: the subject IDs, in order. needed with a loading function;
+#             with an iterable it is only used to name failed subjects whose
+#             error doesn't say (see loading)
+#   workers: threads loading at once (only with a loading function)
+def prefetch(items, depth=2, max_bytes=None, subjects=None, workers=1):
+    if callable(items):
+        if subjects is None:
+            raise ValueError("Need the subjects to call the loader with.")
+        return _prefetch_calls(items, list(subjects), depth, max_bytes,
+                               workers)
+    return _prefetch_iterable(items, depth, max_bytes, subjects)
+
+
+def _prefetch_iterable(items, depth, max_bytes, subjects):
+    results = queue.Queue()
+    stop = threading.Event()
+    # how many items / bytes are loaded but not yet used
+    budget = threading.Condition()
+    waiting = {'items': 0, 'bytes': 0}
+
+    def full():
+        return waiting['items'] >= depth or (
+            max_bytes is not None and waiting['items'] > 0 and
+            waiting['bytes'] >= max_bytes)
+
+    # room is made for an item before it is loaded (not after), so there
+    # are never more than depth items loaded and waiting
+    def producer():
+        iterator = iter(items)
+        try:
+            while True:
+                with budget:
+                    budget.wait_for(lambda: stop.is_set() or not full())
+                    if stop.is_set():
+                        return
+                    waiting['items'] += 1
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                size = nbytes(item)
+                with budget:
+                    waiting['bytes'] += size
+                results.put(('item', item, size))
+            results.put(('done', None, 0))
+        except Exception as e:
+            results.put(('error', e, 0))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    index = 0
+    last = None
+    try:
+        while True:
+            kind, item, size = results.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                if getattr(item, 'subject', None) is not None:
+                    subject = item.subject
+                elif subjects is not None and index < len(subjects):
+                    subject = subjects[index]
+                elif index:
+                    subject = f'after {last}'
+                else:
+                    subject = 'unknown'
+                raise PrefetchError(subject, index, item) from item
+            with budget:
+                waiting['items'] -= 1
+                waiting['bytes'] -= size
+                budget.notify()
+            last = _subject(item)
+            index += 1
+            yield item
+    finally:
+        # the loop was left early: let the producer finish
+        with budget:
+            stop.set()
+            budget.notify()
+
+
+def _prefetch_calls(load, subjects, depth, max_bytes, workers):
+    pending = collections.deque()
+    subjects = iter(enumerate(subjects))
+
+    def waiting_bytes():
+        return sum(nbytes(future.result()) for _, _, future in pending
+                   if future.done() and future.exception() is None)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                # top up the queue, unless it's using too much memory
+                while len(pending) < depth and (
+                        not pending or max_bytes is None or
+                        waiting_bytes() < max_bytes):
+                    try:
+                        index, subject = next(subjects)
+                    except StopIteration:
+                        break
+                    pending.append((index, subject,
+                                    pool.submit(load, subject)))
+                if not pending:
+                    return
+                index, subject, future = pending.popleft()
+                try:
+                    item = future.result()
+                except Exception as e:
+                    raise PrefetchError(subject, index, e) from e
+                yield item
+        finally:
+            for _, _, future in pending:
+                future.cancel()
@@ -1,54 +1,18 @@
 from pathlib import Path
-import os
-import shutil
 import sys
-import platform
 
-# where the compressed data is stored
-datadir = Path('D:\\') / 'cmi-hbn'
-# where 7zip is stored
-if platform.system() == 'Windows':
-    zipcommand = '7z'
+# make the data package importable when this is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
 
-# find the compressed Files
-tarfiles = datadir.glob('*.tar.gz')
+from data import datafolder  # noqa: E402
+from data.download import extract_all  # noqa: E402
 
-# extraction
-for tarfile in tarfiles:
-    # only proceed if there isn't a folder already:
-    subjectid = tarfile.name[:-7]
-    # extract the preproc eeg data
-    if not os.path.isdir(datadir / subjectid):
-        # build the command to extract
-
-        command = (
-            # extract the tar
-            zipcommand + ' x "' + str(tarfile) + '" -so | ' +
-            # extract the files
-            zipcommand + ' x -aoa -si -ttar -o' + '"' + str(datadir) + '"'
-        )
-        # run the command
-        print(command)
-        os.system(command)
-
-        # remove any unwanted files
-        try:
-            shutil.rmtree(datadir / subjectid / 'EEG' / 'raw')
-        except:
-            pass
-        try:
-            shutil.rmtree(datadir / subjectid / 'EEG' /
-                          'preprocessed' / 'mat_format')
-        except:
-            pass
-        try:
-            shutil.rmtree(datadir / subjectid / 'Eyetracking' / 'idf')
-        except:
-            try:
-                shutil.rmtree(datadir / subjectid /
-                              'Eyetracking' / 'idf_format')
-            except:
-                pass
-
-        # remove the TAR file itself
-        os.remove(tarfile)
+# extraction (guarded, because the worker processes re-import this file
+# on windows)
+if __name__ == '__main__':
+    # the archives are in the data folder (HBN_DATA, if it is set). the raw
+    # EEG, the .mat files and the eyetracking idf files are skipped while
+    # reading each archive, so they are never written to disk. archives that
+    # have been extracted completely are left alone, and the TAR files are
+    # removed once their extraction has finished.
+    extract_all(delete_archives=True, dest=datafolder)
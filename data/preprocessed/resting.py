@@ -4,60 +4,82 @@ import numpy as np
 import mne
 import pandas as pd
 
-# get the data path (not sure this works)
-from data import datafolder
+from data import npystore
+from data import csvformat
+from data import montage
+from data import manifest
+from data import instrument
+from data import qc
+from data.pheno import select_subjects
+from data.prefetch import loading
 
 # the types of files this dataset has
 filetypes = ['chanlocs', 'event', 'data']
 
-# make a list of the resting state files
-restfiles = {}
-for key in filetypes:
-    restfiles[key] = list(datafolder.glob(
-        pattern=f'*/EEG/preprocessed/csv_format/RestingState_{key}.csv'
-    ))
-
-# add the IDs to this dictionary
-restfiles['id'] = [s.parts[-5] for s in restfiles['chanlocs']]
+# make a list of the resting state files (from the manifest, so
+# that the lists line up and we don't glob the whole drive on import)
+restfiles = {key: [] for key in filetypes + ['id']}
+for pid, blocks in manifest.files('RestingState').items():
+    if all(key in blocks.get(0, {}) for key in filetypes):
+        # add the IDs to this dictionary
+        restfiles['id'].append(pid)
+        for key in filetypes:
+            restfiles[key].append(blocks[0][key])
 
 
 # number of rest files
 n = len(restfiles['id'])
 
 
-# implement the raw data structures as a generator
-# so that the code isn't run >400x just on import
-def raws():
-    for idx in range(len(restfiles['id'])):
-        # read the channel locations
-        chanlocs = pd.read_csv(restfiles['chanlocs'][idx])
-        ch_names = list(chanlocs['labels'])
-        pos = np.array(chanlocs.loc[:, ('X', 'Y', 'Z')])
-        # make a montage from the chanlocs
-        mtg = mne.channels.Montage(
-            pos, ch_names, 'custom', range(len(ch_names))
+# load the raw data structure for one subject
+# tmax (in seconds) only loads the start of the recording
+def read_raw(pid, tmax=None):
+    idx = restfiles['id'].index(pid)
+    # make an info structure from the channel locations
+    # (a copy of a cached one, if we've seen this layout)
+    with instrument.stage('info', pid):
+        info = montage.create_info(restfiles['chanlocs'][idx], sfreq=500)
+    ch_names = info['ch_names']
+    # load the data from the binary store (or the text file)
+    with instrument.stage('read', pid):
+        data, badbool = npystore.read(
+            restfiles['data'][idx],
+            n_samples=csvformat.tmax_to_samples(tmax, sfreq=500),
+            n_channels=len(ch_names)
         )
-        # make an info structure
-        info = mne.create_info(ch_names=ch_names, sfreq=500,
-                               ch_types='eeg', montage=mtg)
-        # load the data from the text file
-        data = np.genfromtxt(restfiles['data'][idx], delimiter=',')
-        # find bad electrodes
-        badbool = np.all(data == 0, axis=1)
-        badlist = [ch for b, ch in zip(badbool.ravel(), ch_names) if b]
-        # make the raw data structure
+    # find bad electrodes (over the whole recording, if the qc index has
+    # them, rather than just the part that was read)
+    stored = qc.flat(restfiles['data'][idx])
+    if stored is not None and stored.size == len(ch_names):
+        badbool = stored
+    badlist = [ch for b, ch in zip(badbool.ravel(), ch_names) if b]
+    # make the raw data structure (this doesn't copy the memory-map)
+    with instrument.stage('rawarray', pid):
         raw = mne.io.RawArray(data, info)
 
-        # add some cool info
-        raw.info['subject_info'] = restfiles['id'][idx]
-        raw.info['bads'] = badlist
+    # add some cool info
+    raw.info['subject_info'] = pid
+    raw.info['bads'] = badlist
+
+    return raw
 
+
+# implement the raw data structures as a generator
+# so that the code isn't run >400x just on import
+#   subjects: only these subjects, either a list of EIDs or phenotype
+#             criteria like {'Age': (5, 10)} (see data.pheno.select_subjects)
+def raws(tmax=None, subjects=None):
+    for pid in select_subjects(restfiles['id'], subjects):
+        with loading(pid):
+            raw = read_raw(pid, tmax=tmax)
         yield raw
 
 
 # make a generator for the events, read from file
-def events():
-    for idx in range(len(restfiles['id'])):
+# (subjects works as in raws, so the two can be zipped)
+def events(subjects=None):
+    for pid in select_subjects(restfiles['id'], subjects):
+        idx = restfiles['id'].index(pid)
         # load the events from file
         eventdf = pd.read_csv(restfiles['event'][idx])
         # discard first and last row
@@ -1,146 +1,280 @@
 from pathlib import Path
 import os
+import sys
+import json
 import numpy as np
 import mne
 import pandas as pd
 
-# get the data path (not sure this works)
-from data import datafolder
+from data import npystore
+from data import csvformat
+from data import montage
+from data import manifest
+from data import instrument
+from data import qc
+from data.pheno import select_subjects
+from data.prefetch import loading
 
 # the types of files this dataset has
 filetypes = ['chanlocs', 'event', 'data']
 
-# make a list of the csv files
-
-datafiles = list(datafolder.glob(
-    pattern='*/EEG/preprocessed/csv_format/*SurroundSupp*data.csv'
-))
-eventfiles = list(datafolder.glob(
-    pattern='*/EEG/preprocessed/csv_format/*SurroundSupp*event.csv'
-))
-chanlocfiles = list(datafolder.glob(
-    pattern='*/EEG/preprocessed/csv_format/*SurroundSupp*chanlocs.csv'
-))
-stimulusfiles = list(datafolder.glob(
-    pattern='*/Behavioral/csv_format/*SurroundSupp*.csv'
-))
-
-pids = list(set(
-    [f.parts[-5] for f in datafiles]
-))
-
-datafiles = {
-    pid: [f for f in datafiles if pid in f.parts]
-    for pid in pids
-}
-eventfiles = {
-    pid: [f for f in eventfiles if pid in f.parts]
-    for pid in pids
-}
-chanlocfiles = {
-    pid: [f for f in chanlocfiles if pid in f.parts]
-    for pid in pids
-}
-stimulusfiles = {
-    pid: [f for f in stimulusfiles if pid in f.parts]
-    for pid in pids
-}
+# make a list of the csv files, per subject and in block order. a block
+# only counts if all its eeg files and its behavioral file are there
+datafiles, eventfiles, chanlocfiles, stimulusfiles = {}, {}, {}, {}
+for pid, blocks in manifest.files('SurroundSupp').items():
+    blocks = [blocks[block] for block in sorted(blocks)
+              if all(key in blocks[block]
+                     for key in filetypes + ['behavioral'])]
+    if not blocks:
+        continue
+    datafiles[pid] = [files['data'] for files in blocks]
+    eventfiles[pid] = [files['event'] for files in blocks]
+    chanlocfiles[pid] = [files['chanlocs'] for files in blocks]
+    stimulusfiles[pid] = [files['behavioral'] for files in blocks]
+
+pids = list(datafiles)
 
 # add the IDs to this dictionary
 n = len(datafiles)
 
 
+# the epochs run from the stimulus onset to 3 s after it
+tmin, tmax = 0, 3
+sfreq = 500
+n_times = int(round((tmax - tmin) * sfreq)) + 1
+
+
+# the trial columns from the behavioral file that are kept with the epochs
+metadatacolumns = ['BGcon', 'CNTcon', 'StimCond']
+
+
+# the events of one block as an mne event array (sample, 0, code), and the
+# matching trials from the behavioral file. the code is CNTcon * 100 + BGcon
+def block_events(pid, block):
+    eventdf = pd.read_csv(eventfiles[pid][block])
+    decodedf = pd.read_csv(stimulusfiles[pid][block])
+    # only the stimulus onsets
+    samples = eventdf['sample'].to_numpy()[
+        (eventdf['type'] == '8   ').to_numpy()]
+    if samples.size != decodedf.shape[0]:
+        raise ValueError(f"{pid} block {block + 1}: {samples.size} stimulus "
+                         f"events, but {decodedf.shape[0]} trials in the "
+                         "behavioral file.")
+    events = np.zeros((samples.size, 3), dtype=int)
+    events[:, 0] = samples
+    events[:, 2] = (decodedf['CNTcon'].to_numpy() * 100 +
+                    decodedf['BGcon'].to_numpy())
+    metadata = decodedf.loc[:, [col for col in metadatacolumns
+                                if col in decodedf]]
+    return events, metadata
+
+
+# cut the epochs of one subject out of the block data.
+#   select: a function of the event array that returns which epochs to keep,
+#           e.g. lambda events: events[:, 2] <= 99
+# returns the info, the epochs x channels x samples array, the events, the
+# bad channels and the metadata
+def _epoch_arrays(pid, select=None):
+    # make an info structure from the channel locations
+    # (a copy of a cached one, if we've seen this layout)
+    with instrument.stage('info', pid):
+        info = montage.create_info(chanlocfiles[pid][0], sfreq=sfreq)
+    ch_names = info['ch_names']
+    info['subject_info'] = pid
+
+    # the data (memory-mapped if it has been converted), the events that
+    # fit inside it, and the bad channels of each block
+    blocks = []
+    flat = np.zeros(len(ch_names), dtype=bool)
+    offset = 0
+    for block in range(len(datafiles[pid])):
+        with instrument.stage('read', pid):
+            data, badbool = npystore.read(datafiles[pid][block],
+                                          n_channels=len(ch_names))
+        stored = qc.flat(datafiles[pid][block])
+        flat |= (stored if stored is not None and stored.size == flat.size
+                 else badbool.ravel())
+        with instrument.stage('events', pid):
+            events, metadata = block_events(pid, block)
+        # like mne.Epochs, drop epochs that run off either end
+        start = events[:, 0] + int(round(tmin * sfreq))
+        keep = (start >= 0) & (start + n_times <= data.shape[1])
+        # number the samples as if the blocks were one recording
+        events = events[keep]
+        events[:, 0] += offset
+        start = start[keep]
+        metadata = metadata[keep]
+        if select is not None:
+            selected = np.asarray(select(events), dtype=bool)
+            events, start = events[selected], start[selected]
+            metadata = metadata[selected]
+        blocks.append((data, start, events, metadata))
+        offset += data.shape[1]
+
+    # cut the epochs straight into one array
+    n_epochs = sum(starts.size for _, starts, _, _ in blocks)
+    epochdata = np.empty((n_epochs, len(ch_names), n_times))
+    i = 0
+    with instrument.stage('slice', pid):
+        for data, starts, _, _ in blocks:
+            for sample in starts:
+                epochdata[i] = data[:, sample:sample + n_times]
+                i += 1
+
+    events = np.concatenate([events for _, _, events, _ in blocks])
+    metadata = pd.concat([metadata for _, _, _, metadata in blocks],
+                         ignore_index=True)
+    bads = [ch for b, ch in zip(flat, ch_names) if b]
+    return info, epochdata, events, bads, metadata
+
+
+# the epoch cache: one set of files per subject in data/interim/epochs,
+#   surround-<pid>.npy    epochs x channels x samples (baseline corrected)
+#   surround-<pid>.json   events, bad channels, metadata, and the stats of
+#                         the files it was made from
+# the .json is written last, so an entry only counts once it is complete.
+# bump cacheversion whenever the epoch definition above changes.
+cachefolder = Path(__file__).parent.parent / 'interim' / 'epochs'
+cacheversion = 1
+
+
+def cachefile(pid):
+    return cachefolder / f'surround-{pid}.npy'
+
+
+def _sources(pid):
+    files = (datafiles[pid] + eventfiles[pid] + stimulusfiles[pid] +
+             chanlocfiles[pid])
+    return [[str(f), os.stat(f).st_size, os.stat(f).st_mtime] for f in files]
+
+
+def _read_sidecar(pid):
+    try:
+        with open(cachefile(pid).with_suffix('.json')) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # stale if the definition or any of the source files changed
+    if (sidecar['version'] != cacheversion or
+            sidecar['sources'] != json.loads(json.dumps(_sources(pid)))):
+        return None
+    return sidecar
+
+
+# write the cache entry for one subject (unless there is an up-to-date one)
+def cache_epochs(pid, overwrite=False):
+    if not overwrite and _read_sidecar(pid) is not None:
+        return cachefile(pid)
+    info, epochdata, events, bads, metadata = _epoch_arrays(pid)
+    # store it baseline corrected, as it comes out of mne
+    epochdata -= epochdata[..., :1]
+
+    cachefolder.mkdir(parents=True, exist_ok=True)
+    sidecar = {
+        'version': cacheversion,
+        'sources': _sources(pid),
+        'ch_names': info['ch_names'],
+        'events': events.tolist(),
+        'bads': bads,
+        'metadata': {col: metadata[col].tolist() for col in metadata},
+    }
+    tmpnpy = cachefile(pid).with_suffix('.npy.tmp')
+    tmpjson = cachefile(pid).with_suffix('.json.tmp')
+    with open(tmpnpy, 'wb') as f:
+        np.save(f, epochdata)
+    with open(tmpjson, 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(tmpnpy, cachefile(pid))
+    os.replace(tmpjson, cachefile(pid).with_suffix('.json'))
+    return cachefile(pid)
+
+
+# the epochs of one subject from the cache (made first if needed). only the
+# selected epochs are read from disk
+def _cached_arrays(pid, select=None):
+    sidecar = _read_sidecar(pid)
+    if sidecar is None:
+        cache_epochs(pid)
+        sidecar = _read_sidecar(pid)
+    info = montage.create_info(chanlocfiles[pid][0], sfreq=sfreq)
+    info['subject_info'] = pid
+    events = np.array(sidecar['events'], dtype=int).reshape(-1, 3)
+    metadata = pd.DataFrame(sidecar['metadata'])
+    data = np.load(cachefile(pid), mmap_mode='r')
+    if select is None:
+        return info, np.array(data), events, sidecar['bads'], metadata
+    keep = np.flatnonzero(select(events))
+    return (info, data[keep], events[keep], sidecar['bads'],
+            metadata.iloc[keep].reset_index(drop=True))
+
+
 # implement the epoch data structures as a generator
-# so that the code isn't run >400x just on import
-def epochs():
-    for pid in pids:
-
-        # how many files there are for this subject:
-        n_subject = len(datafiles[pid])
-
-        # empty lists for appending
-        epochs = []
-        badlist = []
-
-        for block in range(n_subject):
-            # read the channel locations:
-            chanlocs = pd.read_csv(
-                chanlocfiles[pid][block]
-            )
-            ch_names = list(chanlocs['labels'])
-            pos = np.array(chanlocs.loc[:, ('X', 'Y', 'Z')])
-            # make a montage from the chanlocs
-            mtg = mne.channels.Montage(
-                pos, ch_names, 'custom', range(len(ch_names))
-            )
-
-            # make info structure
-            info = mne.create_info(ch_names=ch_names, sfreq=500,
-                                   ch_types='eeg', montage=mtg)
-            info['subject_info'] = pid
-
-            # load the data from the text file
-            data = np.genfromtxt(
-                datafiles[pid][block], delimiter=',')
-            # make a raw structure
-            raw = mne.io.RawArray(data, info)
-            # find bad electrodes
-            badbool = np.all(data == 0, axis=1)
-
-            badlist = list(set(
-                badlist + [ch for b, ch in zip(badbool.ravel(), ch_names)
-                           if b]
-            ))
-
-            # read the events file and the behav file
-            eventdf = pd.read_csv(eventfiles[pid][block])
-            decodedf = pd.read_csv(stimulusfiles[pid][block])
-
-            # drop superfluous events
-            eventdf = eventdf.loc[eventdf['type'] == '8   ', :]
-            # construct a new trigger code:
-            eventcode = np.array([cntcon * 100 + bgcon
-                                  for cntcon, bgcon in
-                                  zip(decodedf['CNTcon'], decodedf['BGcon'])
-                                  ])
-            eventarray = np.array([eventdf.loc[:, 'sample'],
-                                   np.zeros(eventdf.shape[0]),
-                                   eventcode],
-                                  dtype='int').T
-
-            # make the epoch structure
-            epochs.append(mne.Epochs(raw, eventarray, tmin=0, tmax=3))
-
-        # concatenate the two epoch structs since they are equivalent
-        epoch = mne.concatenate_epochs(epochs)
-        epoch.info['bads'] = badlist
+# so that the code isn't run >400x just on import.
+#   cached: use (and fill) the epoch cache in data/interim/epochs
+#   select: a function of the event array that returns which epochs to keep,
+#           e.g. lambda events: events[:, 2] <= 99. only those are read
+#   subjects: only these subjects, either a list of EIDs or phenotype
+#             criteria like {'Age': (5, 10)} (see data.pheno.select_subjects)
+def epochs(cached=False, select=None, subjects=None):
+    for pid in select_subjects(pids, subjects):
+        with loading(pid):
+            if cached:
+                with instrument.stage('epoch-cache', pid):
+                    info, epochdata, events, bads, metadata = _cached_arrays(
+                        pid, select)
+            else:
+                info, epochdata, events, bads, metadata = _epoch_arrays(
+                    pid, select)
+
+            # (same baseline as mne.Epochs applies by default)
+            with instrument.stage('epochsarray', pid):
+                epoch = mne.EpochsArray(epochdata, info, events, tmin=tmin,
+                                        baseline=(None, 0))
+            epoch.info['bads'] = bads
+            epoch.metadata = metadata
 
         yield epoch
 
 
-def raws(block=1):
-    for subject in range(len(csvfiles['id'])):
-        # read the channel locations:
-        chanlocs = pd.read_csv(csvfiles['chanlocs'][subject][block])
-        ch_names = list(chanlocs['labels'])
-        pos = np.array(chanlocs.loc[:, ('X', 'Y', 'Z')])
-        # make a montage from the chanlocs
-        mtg = mne.channels.Montage(
-            pos, ch_names, 'custom', range(len(ch_names))
-        )
-
-        # make info structure
-        info = mne.create_info(ch_names=ch_names, sfreq=500,
-                               ch_types='eeg', montage=mtg)
-        # load the data from the text file
-        data = np.genfromtxt(
-            csvfiles['data'][subject][block], delimiter=',')
-        # make a raw structure
-        raw = mne.io.RawArray(data, info)
-        # find bad electrodes
-        badbool = np.all(data == 0, axis=1)
-        raw.info['bads'] = [ch for b, ch in zip(badbool.ravel(), ch_names) if b]
-        # add some cool info
-        raw.info['subject_info'] = csvfiles['id'][subject]
+# fill the epoch cache for every subject
+def cache_all(overwrite=False, subjects=None):
+    from tqdm import tqdm
+    for pid in tqdm(select_subjects(pids, subjects)):
+        try:
+            cache_epochs(pid, overwrite=overwrite)
+        except Exception as e:
+            tqdm.write(f"Failed: {pid} ({e})")
+
+
+# load the raw data structure of one block of one subject
+# tmax (in seconds) only loads the start of the recording
+def read_raw(pid, block=1, tmax=None):
+    # make an info structure from the channel locations
+    # (a copy of a cached one, if we've seen this layout)
+    info = montage.create_info(chanlocfiles[pid][block], sfreq=500)
+    ch_names = info['ch_names']
+    # load the data from the binary store (or the text file)
+    data, badbool = npystore.read(
+        datafiles[pid][block],
+        n_samples=csvformat.tmax_to_samples(tmax, sfreq=500),
+        n_channels=len(ch_names)
+    )
+    # make a raw structure
+    raw = mne.io.RawArray(data, info)
+    # find bad electrodes
+    raw.info['bads'] = [ch for b, ch in zip(badbool.ravel(), ch_names) if b]
+    # add some cool info
+    raw.info['subject_info'] = pid
 
+    return raw
+
+
+def raws(block=1, tmax=None, subjects=None):
+    for pid in select_subjects(pids, subjects):
+        with loading(pid):
+            raw = read_raw(pid, block=block, tmax=tmax)
         yield raw
+
+
+if __name__ == '__main__':
+    cache_all(overwrite='--overwrite' in sys.argv)
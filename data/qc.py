@@ -0,0 +1,245 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import json
+import os
+import sys
+import time
+import numpy as np
+
+from data import csvformat
+from data import manifest
+from data import npystore
+
+
+# quality numbers for every eeg data file, so that unusable recordings can
+# be left out before anything is loaded (rather than finding out with a
+# ValueError from raw.crop halfway through a pipeline). each file is read
+# once, one channel at a time, and gives
+#   - duration: the length of the recording in seconds
+#   - flat: which channels are all zeros (the bad channels the loaders use)
+#   - variance: the variance of each channel
+#   - line noise: the power at 60 Hz over the power around it, per channel
+#   - clipping: the fraction of samples stuck at the channel's min or max
+# they live in a qc table next to the file list in the manifest database,
+# with the size and mtime of the file, so an entry goes stale (and is
+# worked out again) when the file changes.
+#
+#   python -m data.qc                  # index every new or changed file
+#   qc.table('RestingState')           # one row per file, as a data frame
+#   qc.passing('RestingState', min_duration=200)   # EIDs to analyse
+sfreq = 500
+linefreq = 60
+# bump this whenever the measures change, so everything is measured again
+version = 1
+
+_columns = ('path', 'subject', 'task', 'block', 'size', 'mtime', 'version',
+            'n_channels', 'n_samples', 'duration', 'n_flat', 'flat',
+            'variance', 'line_noise', 'clipping', 'computed')
+
+
+def _connect(dbfile=manifest.dbfile):
+    con = manifest._connect(dbfile)
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS qc (
+            path TEXT PRIMARY KEY, subject TEXT, task TEXT, block INTEGER,
+            size INTEGER, mtime REAL, version INTEGER, n_channels INTEGER,
+            n_samples INTEGER, duration REAL, n_flat INTEGER, flat TEXT,
+            variance TEXT, line_noise TEXT, clipping REAL, computed REAL);
+        CREATE INDEX IF NOT EXISTS qc_task ON qc (task, subject);
+    """)
+    return con
+
+
+# the channels of a data file, one at a time: from the binary store if it
+# has been converted, otherwise parsed from the csv line by line
+def _channels(csvfile):
+    entry = npystore.load(csvfile, mmap_mode='r')
+    if entry is not None:
+        data, _ = entry
+        for row in data:
+            yield np.asarray(row, dtype=float)
+    else:
+        with open(csvfile, 'rb') as f:
+            for line in csvformat._lines(f):
+                yield np.fromstring(line, dtype=float, sep=',')
+
+
+# power at linefreq over the median power from 5 Hz below to 5 Hz above it
+# (leaving out the line itself), from one fft of the whole channel
+def _line_noise(x, sfreq=sfreq, linefreq=linefreq):
+    if x.size < 2 * sfreq or linefreq >= sfreq / 2:
+        return float('nan')
+    freqs = np.fft.rfftfreq(x.size, 1. / sfreq)
+    power = np.abs(np.fft.rfft(x - x.mean())) ** 2
+    line = np.abs(freqs - linefreq) <= 0.5
+    around = (np.abs(freqs - linefreq) <= 5) & ~(
+        np.abs(freqs - linefreq) <= 1)
+    reference = np.median(power[around])
+    return float(power[line].mean() / reference) if reference > 0 \
+        else float('nan')
+
+
+# the fraction of samples that sit at the channel's min or max and are the
+# same as the sample before (a flat top)
+def _clipped(x):
+    if x.size < 2:
+        return 0
+    repeated = x[1:] == x[:-1]
+    extreme = (x[1:] == x.max()) | (x[1:] == x.min())
+    return int((repeated & extreme).sum())
+
+
+# the qc numbers of one data file, in one pass over it
+def measure(csvfile, sfreq=sfreq, linefreq=linefreq):
+    flat, variance, line_noise = [], [], []
+    n_samples = None
+    clipped = 0
+    for x in _channels(csvfile):
+        if n_samples is None:
+            n_samples = x.size
+        is_flat = not x.any()
+        flat.append(is_flat)
+        variance.append(float(x.var()))
+        if is_flat:
+            line_noise.append(float('nan'))
+        else:
+            line_noise.append(_line_noise(x, sfreq, linefreq))
+            clipped += _clipped(x)
+    if n_samples is None:
+        raise ValueError(f"{csvfile} is empty.")
+    n_good = len(flat) - sum(flat)
+    return {
+        'n_channels': len(flat),
+        'n_samples': n_samples,
+        'duration': n_samples / sfreq,
+        'n_flat': sum(flat),
+        'flat': flat,
+        'variance': variance,
+        'line_noise': line_noise,
+        'clipping': clipped / (n_good * n_samples) if n_good else 1.,
+    }
+
+
+def _measure_row(record):
+    stats = measure(record['path'])
+    return (record['path'], record['subject'], record['task'],
+            record['block'], record['size'], record['mtime'], version,
+            stats['n_channels'], stats['n_samples'], stats['duration'],
+            stats['n_flat'], json.dumps(stats['flat']),
+            json.dumps(stats['variance']), json.dumps(stats['line_noise']),
+            stats['clipping'], time.time())
+
+
+# the data files (of one task) that have no qc entry, or a stale one
+def _todo(task=None, dbfile=manifest.dbfile):
+    records = [record for record in manifest.records(task, ('preprocessed',),
+                                                     dbfile=dbfile)
+               if record['kind'] == 'data']
+    con = _connect(dbfile)
+    known = {path: (size, mtime, v) for path, size, mtime, v in con.execute(
+        'SELECT path, size, mtime, version FROM qc')}
+    con.close()
+    return [record for record in records
+            if known.get(record['path']) !=
+            (record['size'], record['mtime'], version)]
+
+
+# measure every data file (of one task) that is new or has changed
+def index(task=None, workers=1, dbfile=manifest.dbfile):
+    from tqdm import tqdm
+    todo = _todo(task, dbfile)
+    con = _connect(dbfile)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        rows = (pool.map(_measure_row, todo) if pool is not None
+                else map(_measure_row, todo))
+        for row in tqdm(rows, total=len(todo)):
+            with con:
+                con.execute('INSERT OR REPLACE INTO qc VALUES '
+                            f"({','.join('?' * len(_columns))})", row)
+        # forget files that are no longer in the manifest
+        with con:
+            con.execute('DELETE FROM qc WHERE path NOT IN '
+                        '(SELECT path FROM files)')
+    finally:
+        con.close()
+        if pool is not None:
+            pool.shutdown()
+    return len(todo)
+
+
+# the qc table (of one task) as a data frame, one row per file. the per
+# channel columns (flat, variance, line_noise) hold arrays
+def table(task=None, dbfile=manifest.dbfile):
+    import pandas as pd
+    con = _connect(dbfile)
+    query = 'SELECT * FROM qc'
+    args = ()
+    if task is not None:
+        query += ' WHERE task = ?'
+        args = (task,)
+    df = pd.read_sql_query(query + ' ORDER BY subject, block', con,
+                           params=args)
+    con.close()
+    df['flat'] = [np.array(json.loads(x), dtype=bool) for x in df['flat']]
+    for column in ('variance', 'line_noise'):
+        df[column] = [np.array(json.loads(x), dtype=float)
+                      for x in df[column]]
+    return df
+
+
+# the stored flat channels of a data file (a boolean mask), or None if it
+# hasn't been indexed or has changed since
+def flat(csvfile, dbfile=manifest.dbfile):
+    csvfile = Path(csvfile)
+    con = _connect(dbfile)
+    row = con.execute('SELECT size, mtime, version, flat FROM qc '
+                      'WHERE path = ?', (str(csvfile),)).fetchone()
+    con.close()
+    if row is None:
+        return None
+    stat = os.stat(csvfile)
+    if row[:3] != (stat.st_size, stat.st_mtime, version):
+        return None
+    return np.array(json.loads(row[3]), dtype=bool)
+
+
+# the subjects with a data file for a task that isn't usable, i.e. that
+#   - is shorter than min_duration seconds
+#   - has more than max_flat flat channels (a fraction of all channels)
+#   - has more than max_clipping of its samples clipped
+#   - has a median line noise ratio above max_line_noise
+# (None switches a check off). subjects that haven't been indexed are not
+# in here, so they are still analysed
+def failing(task, min_duration=None, max_flat=0.2, max_clipping=0.01,
+            max_line_noise=None, dbfile=manifest.dbfile):
+    df = table(task, dbfile)
+    ok = np.ones(len(df), dtype=bool)
+    if min_duration is not None:
+        ok &= (df['duration'] >= min_duration).to_numpy()
+    if max_flat is not None:
+        ok &= (df['n_flat'] <= max_flat * df['n_channels']).to_numpy()
+    if max_clipping is not None:
+        ok &= (df['clipping'] <= max_clipping).to_numpy()
+    if max_line_noise is not None:
+        ok &= np.array([np.nanmedian(x) <= max_line_noise
+                        if np.isfinite(x).any() else False
+                        for x in df['line_noise']], dtype=bool)
+    return set(df['subject'][~ok])
+
+
+# the indexed subjects that pass all the checks (see failing), e.g. to give
+# to the loaders: resting.raws(subjects=qc.passing('RestingState'))
+def passing(task, dbfile=manifest.dbfile, **limits):
+    failed = failing(task, dbfile=dbfile, **limits)
+    subjects = dict.fromkeys(table(task, dbfile)['subject'])
+    return [subject for subject in subjects if subject not in failed]
+
+
+if __name__ == '__main__':
+    workers = int(sys.argv[sys.argv.index('--workers') + 1]) \
+        if '--workers' in sys.argv else 1
+    n = index(workers=workers)
+    df = table()
+    print(f"Measured {n} files; {len(df)} files from "
+          f"{df['subject'].nunique()} subjects in the qc index.")
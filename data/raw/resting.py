@@ -4,18 +4,19 @@ import numpy as np
 import mne
 import pandas as pd
 
-# get the data path (not sure this works)
-from data import datafolder
+from data import csvformat
+from data import manifest
 
 # the types of files this dataset has
 filetypes = ['chanlocs', 'event', 'data']
 
-datafiles = list(datafolder.glob(
-    pattern='*/EEG/raw/csv_format/*RestingState_data.csv'
-))
-eventfiles = list(datafolder.glob(
-    pattern='*/EEG/raw/csv_format/*RestingState_event.csv'
-))
+# the raw resting state files, from the manifest (one entry per subject
+# that has both a data and an event file, so the two lists line up)
+rawfiles = [blocks[0] for blocks in
+            manifest.files('RestingState', stages=('raw',)).values()
+            if 'data' in blocks.get(0, {}) and 'event' in blocks.get(0, {})]
+datafiles = [files['data'] for files in rawfiles]
+eventfiles = [files['event'] for files in rawfiles]
 
 
 # number of files
@@ -24,7 +25,8 @@ n = len(datafiles)
 
 # implement the raw data structures as a generator
 # so that the code isn't run >400x just on import
-def raws():
+# tmax (in seconds) only loads the start of each recording
+def raws(tmax=None):
     for datafile in datafiles:
         # read the channel locations
         # chanlocs = pd.read_csv(restfiles['chanlocs'][idx])
@@ -38,7 +40,10 @@ def raws():
         info = mne.create_info(ch_names=111, sfreq=500,
                                ch_types='eeg', montage=None)
         # load the data from the text file
-        data = np.genfromtxt(datafile, delimiter=',')
+        data = csvformat.read_data(
+            datafile, n_samples=csvformat.tmax_to_samples(tmax, sfreq=500),
+            n_channels=111
+        )
         # find bad electrodes
         # badbool = np.all(data == 0, axis=1)
         # badlist = [ch for b, ch in zip(badbool.ravel(), ch_names) if b]
@@ -54,9 +59,9 @@ def raws():
 
 # make a generator for the events, read from file
 def restevents():
-    for idx in range(len(restfiles['id'])):
+    for eventfile in eventfiles:
         # load the events from file
-        eventdf = pd.read_csv(restfiles['event'][idx])
+        eventdf = pd.read_csv(eventfile)
         # discard first and last row
         eventdf = eventdf.drop(0)
         eventdf = eventdf.drop(eventdf.tail(1).index)
@@ -4,30 +4,28 @@ import numpy as np
 import mne
 import pandas as pd
 
-# get the data path (not sure this works)
-from data import datafolder
+from data import csvformat
+from data import montage
+from data import manifest
 
 # the types of files this dataset has
 filetypes = ['chanlocs', 'event', 'data']
 
-# make a list of the resting state files
-csvfiles = {}
-for key in filetypes:
-    csvfiles[key] = [tup for tup in zip(
-        list(datafolder.glob(
-            pattern=f'*/EEG/preprocessed/csv_format/SurroundSupp_Block1_{key}.csv')),
-        list(datafolder.glob(
-            pattern=f'*/EEG/preprocessed/csv_format/SurroundSupp_Block2_{key}.csv'))
-    )]
-csvfiles['triggerkeys'] = [tup for tup in zip(
-    list(datafolder.glob(
-        pattern=f'*/Behavioral/csv_format/*SurroundSupp_Block1.csv')),
-    list(datafolder.glob(
-        pattern=f'*/Behavioral/csv_format/*SurroundSupp_Block2.csv'))
-)]
-
-# add the IDs to this dictionary
-csvfiles['id'] = [s[0].parts[-5] for s in csvfiles['chanlocs']]
+# make a list of the surround suppression files, as (block 1, block 2)
+# tuples. the blocks are paired up per subject from the manifest, so a
+# subject only shows up if it has every file for both blocks
+csvfiles = {key: [] for key in filetypes + ['triggerkeys', 'id']}
+for pid, blocks in manifest.files('SurroundSupp').items():
+    if not all(key in blocks.get(block, {})
+               for block in (1, 2)
+               for key in filetypes + ['behavioral']):
+        continue
+    for key in filetypes:
+        csvfiles[key].append((blocks[1][key], blocks[2][key]))
+    csvfiles['triggerkeys'].append(
+        (blocks[1]['behavioral'], blocks[2]['behavioral']))
+    # add the IDs to this dictionary
+    csvfiles['id'].append(pid)
 n = len(csvfiles['id'])
 
 
@@ -39,21 +37,14 @@ def epochs():
         epochs = []
         badlists = []
         for block in range(2):
-            # read the channel locations:
-            chanlocs = pd.read_csv(csvfiles['chanlocs'][subject][block])
-            ch_names = list(chanlocs['labels'])
-            pos = np.array(chanlocs.loc[:, ('X', 'Y', 'Z')])
-            # make a montage from the chanlocs
-            mtg = mne.channels.Montage(
-                pos, ch_names, 'custom', range(len(ch_names))
-            )
-
-            # make info structure
-            info = mne.create_info(ch_names=ch_names, sfreq=500,
-                                   ch_types='eeg', montage=mtg)
+            # make an info structure from the channel locations
+            # (a copy of a cached one, if we've seen this layout)
+            info = montage.create_info(
+                csvfiles['chanlocs'][subject][block], sfreq=500)
+            ch_names = info['ch_names']
             # load the data from the text file
-            data = np.genfromtxt(
-                csvfiles['data'][subject][block], delimiter=',')
+            data = csvformat.read_data(csvfiles['data'][subject][block],
+                                       n_channels=len(ch_names))
             # make a raw structure
             raw = mne.io.RawArray(data, info)
             # find bad electrodes
@@ -91,28 +82,25 @@ def epochs():
         yield epoch
 
         
-def raws(block=1):
+def raws(block=1, tmax=None):
     for subject in range(len(csvfiles['id'])):
-        # read the channel locations:
-        chanlocs = pd.read_csv(csvfiles['chanlocs'][subject][block])
-        ch_names = list(chanlocs['labels'])
-        pos = np.array(chanlocs.loc[:, ('X', 'Y', 'Z')])
-        # make a montage from the chanlocs
-        mtg = mne.channels.Montage(
-            pos, ch_names, 'custom', range(len(ch_names))
-        )
-
-        # make info structure
-        info = mne.create_info(ch_names=ch_names, sfreq=500,
-                               ch_types='eeg', montage=mtg)
+        # make an info structure from the channel locations
+        # (a copy of a cached one, if we've seen this layout)
+        info = montage.create_info(
+            csvfiles['chanlocs'][subject][block], sfreq=500)
+        ch_names = info['ch_names']
         # load the data from the text file
-        data = np.genfromtxt(
-            csvfiles['data'][subject][block], delimiter=',')
+        data = csvformat.read_data(
+            csvfiles['data'][subject][block],
+            n_samples=csvformat.tmax_to_samples(tmax, sfreq=500),
+            n_channels=len(ch_names)
+        )
         # make a raw structure
         raw = mne.io.RawArray(data, info)
         # find bad electrodes
         badbool = np.all(data == 0, axis=1)
-        raw.info['bads'] = [ch for b, ch in zip(badbool.ravel(), ch_names) if b]
+        raw.info['bads'] = [ch for b, ch in zip(badbool.ravel(), ch_names)
+                            if b]
         # add some cool info
         raw.info['subject_info'] = csvfiles['id'][subject]
         
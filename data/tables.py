@@ -0,0 +1,39 @@
+from pathlib import Path
+
+
+# small helpers to store data frames in a typed, columnar format. feather
+# (via pyarrow) lets us read only the columns we need; if pyarrow isn't
+# installed we fall back to a pickle, which is still typed and fast to load
+try:
+    import pyarrow  # noqa: F401
+    suffix = '.feather'
+except ImportError:
+    suffix = '.pickle'
+
+
+# the actual file name for a table, e.g. data/interim/phenotypes.feather
+def tablefile(stem):
+    return Path(stem).with_suffix(suffix)
+
+
+def write(df, stem):
+    fname = tablefile(stem)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmpfile = fname.with_suffix(suffix + '.tmp')
+    # feather needs a plain range index
+    df = df.reset_index(drop=True)
+    if suffix == '.feather':
+        df.to_feather(tmpfile)
+    else:
+        df.to_pickle(tmpfile)
+    tmpfile.replace(fname)
+    return fname
+
+
+def read(stem, columns=None):
+    import pandas as pd
+    fname = tablefile(stem)
+    if suffix == '.feather':
+        return pd.read_feather(fname, columns=columns)
+    df = pd.read_pickle(fname)
+    return df if columns is None else df[list(columns)]
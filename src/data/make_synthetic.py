@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import string
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import click
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+
+# writes a fake data set in the same layout as the HBN release, so the
+# loaders and pipelines can be run (and scale-tested) without the real drive:
+#
+#   <root>/<EID>/EEG/preprocessed/csv_format/RestingState_data.csv
+#                                            RestingState_event.csv
+#                                            RestingState_chanlocs.csv
+#                                            SurroundSupp_Block1_data.csv
+#                                            ...
+#   <root>/<EID>/Behavioral/csv_format/<EID>_SurroundSupp_Block1.csv
+#   <root>/HBN_S1_Pheno_data.csv
+#
+# the EEG is 1/f noise (with an exponent that depends on age, and alpha in
+# the eyes closed parts of the resting state) plus a 25 Hz SSVEP during the
+# surround suppression stimuli (bigger at higher contrast, smaller with a
+# surround, and mostly at the back of the head). point the loaders at it
+# with HBN_DATA=<root> and HBN_PHENOTYPES=<root>/HBN_S1_Pheno_data.csv
+
+sfreq = 500
+n_channels = 111
+# the surround suppression task
+stimfreq = 25
+contrasts = (1.0, 0.6, 0.3)  # by CNTcon
+surrounds = (1.0, 0.6, 0.8)  # by BGcon
+stimulus_seconds = 2.4
+trial_seconds = 3.5
+# the resting state task alternates eyes open / eyes closed
+rest_cycle = ((20, 20), (30, 40))  # (event code, seconds)
+
+preprocessed = Path('EEG') / 'preprocessed' / 'csv_format'
+behavioral = Path('Behavioral') / 'csv_format'
+
+
+# e.g. NDARYM832PX3, like the IDs in the release
+def make_eid(rng):
+    letters = string.ascii_uppercase
+    alnum = letters + string.digits
+    return ('NDAR' + ''.join(rng.choice(list(letters), 2)) +
+            ''.join(rng.choice(list(string.digits), 3)) +
+            ''.join(rng.choice(list(alnum), 3)))
+
+
+# the channel locations: evenly spread over the upper part of a sphere
+def chanlocs(n=n_channels):
+    import pandas as pd
+    i = np.arange(n) + 0.5
+    elevation = np.arcsin(1 - 1.2 * i / n)
+    azimuth = np.pi * (1 + 5 ** 0.5) * i
+    x = np.cos(elevation) * np.cos(azimuth)
+    y = np.cos(elevation) * np.sin(azimuth)
+    z = np.sin(elevation)
+    labels = [f'E{k + 1}' for k in range(n - 1)] + ['Cz']
+    return pd.DataFrame({
+        'labels': labels, 'type': '',
+        'theta': np.degrees(-azimuth) % 360 - 180,
+        'radius': 0.5 - np.degrees(elevation) / 180,
+        'X': 10 * x, 'Y': 10 * y, 'Z': 10 * z,
+        'sph_theta': np.degrees(azimuth) % 360 - 180,
+        'sph_phi': np.degrees(elevation), 'sph_radius': 10.,
+    })
+
+
+# noise with a 1/f^exponent power spectrum, channels x samples
+def powerlaw_noise(rng, n_channels, n_times, exponent):
+    spectrum = np.fft.rfft(rng.standard_normal((n_channels, n_times)))
+    freqs = np.fft.rfftfreq(n_times, 1 / sfreq)
+    freqs[0] = freqs[1]
+    spectrum *= freqs ** (-exponent / 2)
+    spectrum[:, 0] = 0
+    noise = np.fft.irfft(spectrum, n=n_times)
+    return noise / noise.std(axis=-1, keepdims=True)
+
+
+def _eeg(rng, locs, n_times, exponent, flat):
+    # 10 uV of 1/f noise, partly shared between channels
+    data = 10 * (0.8 * powerlaw_noise(rng, len(locs), n_times, exponent) +
+                 0.2 * powerlaw_noise(rng, 1, n_times, exponent))
+    data[flat] = 0
+    return data
+
+
+def write_data(fname, data):
+    np.savetxt(fname, data, fmt='%.4f', delimiter=',')
+
+
+def write_events(fname, rows):
+    import pandas as pd
+    events = pd.DataFrame(rows, columns=['type', 'sample'])
+    events['latency'] = events['sample'].astype(float)
+    events['urevent'] = np.arange(1, len(events) + 1)
+    events.to_csv(fname, index=False)
+
+
+def _codestring(code):
+    return str(code).ljust(4)
+
+
+def make_resting(folder, rng, locs, seconds, exponent, flat):
+    n_times = int(seconds * sfreq)
+    data = _eeg(rng, locs, n_times, exponent, flat)
+    rows = [(_codestring(90), 1)]
+    t = sfreq
+    alpha = np.sin(2 * np.pi * 10 * np.arange(n_times) / sfreq)
+    # alpha is strongest at the back of the head
+    weight = np.clip(-locs['Y'].to_numpy() / 10, 0, None)[:, np.newaxis]
+    while t < n_times:
+        for code, duration in rest_cycle:
+            if t >= n_times:
+                break
+            rows.append((_codestring(code), t))
+            stop = min(t + duration * sfreq, n_times)
+            if code == 30:
+                data[:, t:stop] += 8 * weight * alpha[t:stop]
+            t = stop
+    rows.append(('break cnt', n_times))
+    data[flat] = 0
+    write_data(folder / 'RestingState_data.csv', data)
+    write_events(folder / 'RestingState_event.csv', rows)
+
+
+def make_surround(folder, behavfolder, eid, block, rng, locs, n_trials,
+                  exponent, flat, amplitude):
+    import pandas as pd
+    onsets = (sfreq + np.arange(n_trials) * trial_seconds * sfreq).astype(int)
+    n_times = int(onsets[-1] + trial_seconds * sfreq)
+    data = _eeg(rng, locs, n_times, exponent, flat)
+
+    conditions = pd.DataFrame({
+        'CNTcon': rng.integers(0, len(contrasts), n_trials),
+        'BGcon': rng.integers(0, len(surrounds), n_trials),
+    })
+    conditions['StimCond'] = (conditions['CNTcon'] * len(surrounds) +
+                              conditions['BGcon'] + 1)
+
+    # the SSVEP, over the back of the head
+    weight = np.clip(-locs['Y'].to_numpy() / 10, 0, None)[:, np.newaxis]
+    t = np.arange(int(stimulus_seconds * sfreq)) / sfreq
+    ssvep = np.sin(2 * np.pi * stimfreq * t)
+    rows = [('break cnt', 0)]
+    for onset, cnt, bg in zip(onsets, conditions['CNTcon'],
+                              conditions['BGcon']):
+        rows.append((_codestring(12), onset - sfreq // 2))
+        rows.append((_codestring(8), onset))
+        data[:, onset:onset + t.size] += (amplitude * contrasts[cnt] *
+                                          surrounds[bg] * weight * ssvep)
+    data[flat] = 0
+
+    write_data(folder / f'SurroundSupp_Block{block}_data.csv', data)
+    write_events(folder / f'SurroundSupp_Block{block}_event.csv', rows)
+    conditions.to_csv(behavfolder / f'{eid}_SurroundSupp_Block{block}.csv',
+                      index=False)
+
+
+# one subject's folder. age drives the 1/f exponent and the SSVEP size, so
+# there is something for the analyses to find
+def make_subject(root, eid, age, seed, rest_seconds=60, n_trials=32,
+                 tasks=('RestingState', 'SurroundSupp'), p_flat=0.02):
+    rng = np.random.default_rng(seed)
+    folder = Path(root) / eid / preprocessed
+    behavfolder = Path(root) / eid / behavioral
+    folder.mkdir(parents=True, exist_ok=True)
+    behavfolder.mkdir(parents=True, exist_ok=True)
+
+    locs = chanlocs()
+    flat = rng.random(len(locs)) < p_flat
+    exponent = 2.2 - 0.05 * (age - 5) + rng.normal(0, 0.15)
+    amplitude = 2 + 0.1 * age + rng.normal(0, 0.5)
+
+    if 'RestingState' in tasks:
+        locs.to_csv(folder / 'RestingState_chanlocs.csv', index=False)
+        make_resting(folder, rng, locs, rest_seconds, exponent, flat)
+    if 'SurroundSupp' in tasks:
+        for block in (1, 2):
+            locs.to_csv(folder / f'SurroundSupp_Block{block}_chanlocs.csv',
+                        index=False)
+            make_surround(folder, behavfolder, eid, block, rng, locs,
+                          n_trials, exponent, flat, amplitude)
+    return eid
+
+
+def make_phenotypes(rng, n):
+    import pandas as pd
+    eids = set()
+    while len(eids) < n:
+        eids.add(make_eid(rng))
+    return pd.DataFrame({
+        'EID': sorted(eids),
+        'Sex': rng.integers(0, 2, n),
+        'Age': rng.uniform(5, 21, n).round(6),
+        'EHQ_Total': np.clip(rng.normal(60, 40, n), -100, 100).round(2),
+        'Study_Site': 1,
+        'Commercial_Use': rng.choice(['Yes', 'No'], n),
+    })
+
+
+@click.command()
+@click.argument('root', type=click.Path(file_okay=False))
+@click.option('--subjects', default=20, show_default=True,
+              help='number of subjects')
+@click.option('--rest-seconds', default=60., show_default=True,
+              help='length of each resting state recording')
+@click.option('--trials', default=32, show_default=True,
+              help='surround suppression trials per block')
+@click.option('--missing', default=0.1, show_default=True,
+              help='fraction of subjects with only one of the two tasks')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+def main(root, subjects, rest_seconds, trials, missing, workers, seed):
+    """ Writes a synthetic data set with the same layout as the HBN release
+        to ROOT, with a matching phenotype file.
+    """
+    logger = logging.getLogger(__name__)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    pheno = make_phenotypes(rng, subjects)
+    phenofile = root / 'HBN_S1_Pheno_data.csv'
+    pheno.to_csv(phenofile, index=False)
+
+    # like the real thing, not everyone did every task
+    tasks = [('RestingState', 'SurroundSupp')] * subjects
+    for i in np.flatnonzero(rng.random(subjects) < missing):
+        tasks[i] = (rng.choice(['RestingState', 'SurroundSupp']),)
+
+    logger.info(f'Writing {subjects} subjects to {root}')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(make_subject, root, eid, age, seed + i + 1,
+                               rest_seconds, trials, tasks[i])
+                   for i, (eid, age) in enumerate(zip(pheno['EID'],
+                                                      pheno['Age']))]
+        for n, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if n % 100 == 0:
+                logger.info(f'{n}/{subjects} subjects')
+
+    logger.info(f'Done. To use it:\n'
+                f'  export HBN_DATA={root.resolve()}\n'
+                f'  export HBN_PHENOTYPES={phenofile.resolve()}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
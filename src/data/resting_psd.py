@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import click
+from dotenv import find_dotenv, load_dotenv
+
+project_dir = Path(__file__).resolve().parents[2]
+# make the data package importable when this is run as a script
+if str(project_dir) not in sys.path:
+    sys.path.insert(0, str(project_dir))
+
+# where the spectra and info structures go (same as the resting script)
+psdfolder = project_dir / 'data' / 'interim' / 'freqanalysis'
+infofolder = project_dir / 'data' / 'interim' / 'info'
+# one json line per subject that failed or was skipped
+failurelog = psdfolder / 'rest-failures.jsonl'
+
+# the environment variables that control the numpy / BLAS thread pools
+threadvars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+              'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+
+def psdfile(pid):
+    return psdfolder / f'rest-{pid}.pickle'
+
+
+def infofile(pid):
+    return infofolder / f'rest-{pid}.pickle'
+
+
+# pickle to a temporary file and move it into place, so that a crash never
+# leaves a half-written output behind that would be mistaken for a result
+def _dump(obj, fname):
+    tmpfile = fname.with_suffix('.tmp')
+    with open(tmpfile, 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmpfile, fname)
+
+
+# runs in each worker before anything else is imported, so the thread
+# limits apply to numpy/scipy in that worker
+def _init_worker(n_threads):
+    for var in threadvars:
+        os.environ[var] = str(n_threads)
+
+
+# the kind of DPSS tapers the spectra are made with, which depends on the
+# installed mne (see src/features/multitaper.py)
+def tapers():
+    from src.features import multitaper
+    return 'symmetric' if multitaper.symmetric() else 'periodic'
+
+
+# load, crop, re-reference and frequency-transform one subject. returns the
+# status, the spectrum (or why it was skipped) and the info structure
+def compute_psd(pid, tmax, fmin, fmax, reference):
+    import mne
+    from data import instrument
+    from data.preprocessed import resting
+    from src.features import multitaper
+
+    # only the first tmax seconds are needed
+    raw = resting.read_raw(pid, tmax=tmax)
+
+    # try cropping it; this will fail if the recording is too short
+    try:
+        with instrument.stage('crop', pid):
+            raw.crop(tmin=0, tmax=tmax)
+    except ValueError:
+        return 'skipped', f'recording shorter than {tmax}s', raw.info
+
+    # average reference
+    if reference == 'average':
+        with instrument.stage('reference', pid):
+            raw.set_eeg_reference()
+            raw.apply_proj()
+
+    # do the time-frequency analysis (same numbers as psd_multitaper, which
+    # also leaves out the bad channels, but the tapers are only made once
+    # per worker since every recording has the same length)
+    picks = mne.pick_types(raw.info, eeg=True)
+    with instrument.stage('psd', pid):
+        psd, freqs = multitaper.psd_array(raw.get_data(picks=picks),
+                                          raw.info['sfreq'], fmin=fmin,
+                                          fmax=fmax)
+    return 'done', (freqs, psd), raw.info
+
+
+# one subject, through the derivation cache: the spectrum is only computed
+# again if the data or channel location file, the parameters or the code
+# changed. the code is everything from reading the file to the spectrum:
+# the loader and the modules it reads with, as well as the analysis
+def process_subject(pid, tmax, fmin, fmax, reference='average'):
+    from data import csvformat, derivations, montage, npystore, qc
+    from data.preprocessed import resting
+    from src.features import multitaper
+
+    idx = resting.restfiles['id'].index(pid)
+    status, result, info = derivations.derive(
+        'rest-psd', compute_psd, pid,
+        inputs=[Path(resting.restfiles['data'][idx]),
+                Path(resting.restfiles['chanlocs'][idx])],
+        params={'tmax': tmax, 'fmin': fmin, 'fmax': fmax,
+                'reference': reference, 'tapers': tapers()},
+        version=derivations.code_version(compute_psd, multitaper, resting,
+                                         npystore, csvformat, montage, qc),
+    ).value
+
+    # save the info structure to file (incl bads)
+    _dump(info, infofile(pid))
+    if status != 'done':
+        return status, result
+
+    _dump(result, psdfile(pid))
+    return 'done', None
+
+
+# wrapper that turns any exception into a log entry instead of
+# taking the whole run down
+def _run_subject(pid, tmax, fmin, fmax):
+    from data import derivations
+    from data import instrument
+    derivations.reset_stats()
+    start = time.time()
+    try:
+        with instrument.stage('subject', pid):
+            status, message = process_subject(pid, tmax, fmin, fmax)
+    except Exception as e:
+        status, message = 'failed', ''.join(
+            traceback.format_exception(type(e), e, e.__traceback__))
+    return {'pid': pid, 'status': status, 'message': message,
+            'seconds': time.time() - start, 'cache': derivations.stats()}
+
+
+# (with the parameters of the run, since whether a subject is skipped
+# depends on them)
+def _log_failure(entry, params):
+    with open(failurelog, 'a') as f:
+        f.write(json.dumps(dict(entry, params=params,
+                                time=time.strftime('%c'))) + '\n')
+
+
+# subjects that were skipped in a previous run with the same parameters
+# (e.g. too short for tmax), which won't change by trying again. failed
+# subjects are retried, and so are the ones skipped with other parameters
+def _previously_skipped(params):
+    params = json.loads(json.dumps(params))
+    skipped = set()
+    if failurelog.exists():
+        with open(failurelog) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get('params') != params:
+                    continue
+                if entry['status'] == 'skipped':
+                    skipped.add(entry['pid'])
+                else:
+                    skipped.discard(entry['pid'])
+    return skipped
+
+
+@click.command()
+@click.option('--workers', default=max(1, (os.cpu_count() or 1) // 2),
+              show_default=True, help='number of subjects processed at once')
+@click.option('--threads', default=1, show_default=True,
+              help='numpy / BLAS threads per worker')
+@click.option('--tmax', default=200., show_default=True,
+              help='seconds of each recording to analyse')
+@click.option('--fmin', default=1., show_default=True)
+@click.option('--fmax', default=30., show_default=True)
+@click.option('--retry-skipped', is_flag=True,
+              help='also retry subjects that were skipped before')
+@click.option('--store-every', default=32, show_default=True,
+              help='add finished spectra to the consolidated store after '
+              'this many subjects')
+@click.option('--where', default=None,
+              help="only subjects whose phenotypes match this query, e.g. "
+              "'Age >= 5 and Age <= 10'")
+def main(workers, threads, tmax, fmin, fmax, retry_skipped, store_every,
+         where):
+    """ Computes the resting state power spectra for every subject in
+        parallel, and saves them to data/interim/freqanalysis (one pickle
+        per subject, plus the consolidated rest.store). Subjects that
+        already have a spectrum with the same parameters are not
+        processed again.
+    """
+    logger = logging.getLogger(__name__)
+    psdfolder.mkdir(parents=True, exist_ok=True)
+    infofolder.mkdir(parents=True, exist_ok=True)
+
+    from data import derivations
+    from data.preprocessed import resting
+    from data.interim import freqanalysis
+    from data.pheno import select_subjects
+    from data import qc
+
+    params = {'tmax': tmax, 'fmin': fmin, 'fmax': fmax,
+              'reference': 'average', 'method': 'multitaper',
+              'tapers': tapers()}
+    # spectra made with other parameters are removed (they come back out
+    # of the derivation cache if those parameters are used again)
+    if freqanalysis.set_params(params, 'rest'):
+        logger.info('The parameters changed: removed the old spectra and '
+                    'the store')
+
+    # move finished spectra into the store (which can be read meanwhile)
+    def store():
+        try:
+            freqanalysis.consolidate('rest', params=params)
+        except ValueError as e:
+            logger.error(f'Could not add spectra to the store: {e}')
+
+    # resume: subjects whose spectrum is up to date (same data, parameters
+    # and code) come straight out of the derivation cache
+    skipped = _previously_skipped(params)
+    todo = [pid for pid in select_subjects(resting.restfiles['id'], where)
+            if retry_skipped or pid not in skipped]
+    # recordings the qc index (python -m data.qc) knows to be too short are
+    # skipped without loading them
+    short = qc.failing('RestingState', min_duration=tmax + 1 / 500,
+                       max_flat=None, max_clipping=None)
+    # (and only logged once)
+    for pid in [pid for pid in todo if pid in short and pid not in skipped]:
+        _log_failure({'pid': pid, 'status': 'skipped',
+                      'message': f'recording shorter than {tmax}s (qc)',
+                      'seconds': 0, 'cache': {}}, params)
+    todo = [pid for pid in todo if pid not in short]
+    logger.info(f'{len(todo)} of {resting.n} subjects left to process '
+                f'with {workers} workers x {threads} threads')
+
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+    start = time.time()
+    # spawn (rather than fork) so the thread limits are set before
+    # numpy is imported in the workers
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(threads,)) as pool:
+        futures = {pool.submit(_run_subject, pid, tmax, fmin, fmax): pid
+                   for pid in todo}
+        for future in as_completed(futures):
+            try:
+                entry = future.result()
+            except Exception as e:
+                # the worker process itself died (e.g. out of memory)
+                entry = {'pid': futures[future], 'status': 'failed',
+                         'message': repr(e), 'seconds': None, 'cache': {}}
+            derivations.add_stats(entry['cache'])
+            counts[entry['status']] += 1
+            if entry['status'] == 'done' and counts['done'] % store_every == 0:
+                store()
+            if entry['status'] != 'done':
+                _log_failure(entry, params)
+                logger.warning(f"{entry['pid']} {entry['status']}: " +
+                               ''.join(entry['message'].splitlines()[-1:]))
+
+            finished = sum(counts.values())
+            rate = finished / (time.time() - start) * 60
+            logger.info(f"{finished}/{len(todo)} subjects "
+                        f"({rate:.1f} subjects/min)")
+
+    store()
+    logger.info(f"{counts['done']} done, {counts['skipped']} skipped, "
+                f"{counts['failed']} failed (see {failurelog})")
+    logger.info(f"Derivation cache: {derivations.report()}")
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
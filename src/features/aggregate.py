@@ -0,0 +1,302 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+import numpy as np
+
+
+# cohort summaries of spectra (grand averages, spread, quantiles, averages
+# per age bin, ...) that are built up one subject at a time, so memory
+# doesn't grow with the number of subjects. every accumulator can be merged
+# with another of the same kind, so worker processes can each summarise
+# some of the subjects and only send back their (small) accumulators.
+#
+#   from data.interim import freqanalysis
+#   agg = aggregate(freqanalysis.iterate('rest'), bins={'Age': [5, 8, 11,
+#                                                               14, 22]})
+#   agg.moments.mean          # channels x freqs grand average
+#   agg.binned['Age'][1].std  # the spread for 8 - 11 year olds
+#
+# NaNs (bad channels) are left out element by element.
+
+
+# running count, mean and sum of squared deviations per element (welford's
+# algorithm), merged with chan et al.'s formula
+class Moments:
+
+    def __init__(self):
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+    def _start(self, shape):
+        if self.count is None:
+            self.count = np.zeros(shape, dtype=np.int64)
+            self.mean = np.zeros(shape)
+            self.m2 = np.zeros(shape)
+        elif self.count.shape != tuple(shape):
+            raise ValueError(f"Expected shape {self.count.shape}, "
+                             f"got {tuple(shape)}.")
+
+    # add one observation (e.g. one subject's channels x freqs spectrum)
+    def update(self, x):
+        x = np.asarray(x, dtype=float)
+        self._start(x.shape)
+        ok = np.isfinite(x)
+        self.count += ok
+        delta = np.where(ok, x - self.mean, 0)
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * np.where(ok, x - self.mean, 0)
+        return self
+
+    # add a stack of observations along the first axis at once
+    def update_many(self, xs):
+        xs = np.asarray(xs, dtype=float)
+        ok = np.isfinite(xs)
+        batch = Moments()
+        batch.count = ok.sum(axis=0)
+        n = np.maximum(batch.count, 1)
+        batch.mean = np.where(ok, xs, 0).sum(axis=0) / n
+        batch.m2 = (np.where(ok, xs - batch.mean, 0) ** 2).sum(axis=0)
+        return self.merge(batch)
+
+    def merge(self, other):
+        if other.count is None:
+            return self
+        self._start(other.count.shape)
+        count = self.count + other.count
+        n = np.maximum(count, 1)
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / n
+        self.mean += delta * other.count / n
+        self.count = count
+        return self
+
+    # (with ddof=1; NaN where there are fewer than two values)
+    @property
+    def var(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1),
+                            np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def sem(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.std / np.sqrt(self.count)
+
+
+# approximate quantiles per element, from a fixed-bin histogram: memory is
+# n_bins counts per element whatever the number of subjects, merging is
+# adding the counts, and the error is about one bin wide. by default the
+# bins are in log10 units, which suits power (the default range covers
+# 1e-16 to 1e-6 V^2/Hz in 0.02 decade steps); values outside the range are
+# counted at its ends
+class Quantiles:
+
+    def __init__(self, low=-16, high=-6, n_bins=500, log=True):
+        self.low, self.high, self.n_bins, self.log = low, high, n_bins, log
+        self.counts = None
+
+    @property
+    def edges(self):
+        return np.linspace(self.low, self.high, self.n_bins + 1)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.counts is None:
+            self.counts = np.zeros(x.shape + (self.n_bins,), dtype=np.int32)
+        elif self.counts.shape[:-1] != x.shape:
+            raise ValueError(f"Expected shape {self.counts.shape[:-1]}, "
+                             f"got {x.shape}.")
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.log10(x) if self.log else x
+        ok = ~np.isnan(values)
+        width = (self.high - self.low) / self.n_bins
+        with np.errstate(invalid='ignore'):
+            bins = np.clip((values - self.low) // width, 0, self.n_bins - 1)
+        flat = self.counts.reshape(-1, self.n_bins)
+        rows = np.flatnonzero(ok)
+        # (each element gets one count, so plain fancy indexing is enough)
+        flat[rows, bins.ravel()[rows].astype(int)] += 1
+        return self
+
+    def merge(self, other):
+        if other.counts is None:
+            return self
+        if (self.low, self.high, self.n_bins, self.log) != \
+                (other.low, other.high, other.n_bins, other.log):
+            raise ValueError("Can only merge quantiles with the same bins.")
+        if self.counts is None:
+            self.counts = other.counts.copy()
+        else:
+            self.counts += other.counts
+        return self
+
+    # the q-th quantile(s) of every element (q in [0, 1]), interpolated
+    # linearly within the bin it falls in. returns q.shape + element shape
+    def quantile(self, q):
+        q = np.asarray(q, dtype=float)
+        counts = self.counts.reshape(-1, self.n_bins)
+        total = counts.sum(axis=1)
+        cumulative = np.cumsum(counts, axis=1)
+        width = (self.high - self.low) / self.n_bins
+        out = np.empty(q.shape + (counts.shape[0],))
+        for i, qi in enumerate(q.ravel()):
+            target = qi * total
+            # the first bin whose cumulative count reaches the target
+            b = (cumulative < target[:, np.newaxis]).sum(axis=1)
+            b = np.minimum(b, self.n_bins - 1)
+            rows = np.arange(counts.shape[0])
+            before = np.where(b > 0, cumulative[rows, b - 1], 0)
+            inbin = counts[rows, b]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frac = np.where(inbin > 0, (target - before) / inbin, 0.5)
+            value = self.low + (b + np.clip(frac, 0, 1)) * width
+            value[total == 0] = np.nan
+            out.reshape(-1, counts.shape[0])[i] = value
+        out = out.reshape(q.shape + self.counts.shape[:-1])
+        return 10 ** out if self.log else out
+
+    @property
+    def median(self):
+        return self.quantile(0.5)
+
+
+# one accumulator per bin of a phenotype (e.g. age), made with make() when
+# the first subject in that bin comes along. bins are [edges[i],
+# edges[i + 1]); subjects outside them (or without a value) are left out.
+# make has to be picklable (a class or functools.partial, not a lambda) for
+# the accumulators to go between processes
+class Binned:
+
+    def __init__(self, edges, make=Moments):
+        self.edges = np.asarray(edges, dtype=float)
+        self.make = make
+        self.bins = {}
+
+    def bin(self, value):
+        if value is None or not np.isfinite(value):
+            return None
+        b = int(np.searchsorted(self.edges, value, side='right')) - 1
+        return b if 0 <= b < self.edges.size - 1 else None
+
+    def update(self, x, value):
+        b = self.bin(value)
+        if b is not None:
+            if b not in self.bins:
+                self.bins[b] = self.make()
+            self.bins[b].update(x)
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Can only merge accumulators with the same "
+                             "bins.")
+        for b, accumulator in other.bins.items():
+            if b in self.bins:
+                self.bins[b].merge(accumulator)
+            else:
+                self.bins[b] = accumulator
+        return self
+
+    def __getitem__(self, b):
+        return self.bins[b]
+
+    # (low, high) of every bin that has subjects, in order
+    def labels(self):
+        return {b: (self.edges[b], self.edges[b + 1])
+                for b in sorted(self.bins)}
+
+
+# everything about a set of spectra: the frequencies, which subjects went
+# in, the moments, optionally the quantiles, and moments per bin of each
+# phenotype in bins ({column: edges})
+class Aggregate:
+
+    def __init__(self, bins=None, quantiles=None):
+        self.freqs = None
+        self.pids = []
+        self.moments = Moments()
+        self.quantiles = Quantiles(**quantiles) if quantiles is not None \
+            else None
+        self.binned = {column: Binned(edges)
+                       for column, edges in (bins or {}).items()}
+
+    def _check_freqs(self, freqs):
+        freqs = np.asarray(freqs)
+        if self.freqs is None:
+            self.freqs = freqs
+        elif not np.array_equal(self.freqs, freqs):
+            raise ValueError("The spectra have different frequencies.")
+
+    # one subject's spectrum; phenotype is a mapping with the values of the
+    # binned columns
+    def update(self, pid, freqs, psd, phenotype=None):
+        self._check_freqs(freqs)
+        self.pids.append(pid)
+        self.moments.update(psd)
+        if self.quantiles is not None:
+            self.quantiles.update(psd)
+        for column, binned in self.binned.items():
+            value = None if phenotype is None else phenotype.get(column)
+            binned.update(psd, value)
+        return self
+
+    def merge(self, other):
+        if other.freqs is not None:
+            self._check_freqs(other.freqs)
+        self.pids.extend(other.pids)
+        self.moments.merge(other.moments)
+        if self.quantiles is not None and other.quantiles is not None:
+            self.quantiles.merge(other.quantiles)
+        for column, binned in other.binned.items():
+            if column in self.binned:
+                self.binned[column].merge(binned)
+            else:
+                self.binned[column] = binned
+        return self
+
+
+# summarise an iterator of (pid, freqs, psd), like freqanalysis.psds() or
+# freqanalysis.iterate(). the spectra have to be the same shape, so use
+# iterate() (or freqanalysis.expand) when bad channels are left out.
+#   bins: {phenotype column: bin edges}, e.g. {'Age': [5, 10, 15, 22]}
+#   phenotypes: a data frame indexed by EID (default: load_phenotypes)
+#   quantiles: None for no quantiles, or the arguments of Quantiles
+def aggregate(spectra, bins=None, phenotypes=None, quantiles=None):
+    if bins and phenotypes is None:
+        from data.pheno import load_phenotypes
+        phenotypes = load_phenotypes(columns=list(bins))
+    lookup = {} if not bins else \
+        phenotypes[list(bins)].to_dict(orient='index')
+    agg = Aggregate(bins, quantiles)
+    for pid, freqs, psd in spectra:
+        agg.update(pid, freqs, psd, lookup.get(pid))
+    return agg
+
+
+def _aggregate_store(recording, subjects, bins, quantiles):
+    from data.interim import freqanalysis
+    return aggregate(freqanalysis.iterate(recording, subjects), bins,
+                     quantiles=quantiles)
+
+
+# summarise the spectra in a store with several worker processes: each one
+# reads and summarises a share of the subjects, and only the accumulators
+# come back to be merged
+def aggregate_store(recording='rest', subjects=None, bins=None,
+                    quantiles=None, workers=1):
+    from data.interim import freqanalysis
+    if subjects is None:
+        subjects = freqanalysis.index(recording)
+    shares = [subjects[i::workers] for i in range(workers)]
+    if workers == 1:
+        return _aggregate_store(recording, subjects, bins, quantiles)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(_aggregate_store, [recording] * workers,
+                              shares, [bins] * workers,
+                              [quantiles] * workers))
+    return reduce(Aggregate.merge, parts)
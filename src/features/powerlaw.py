@@ -0,0 +1,83 @@
+from collections import namedtuple
+
+import numpy as np
+import scipy.stats
+
+
+# the frequency bands the 1/f fits are done in (avoiding alpha and beta peaks)
+bands = ((4, 7), (14, 24))
+
+# same fields as scipy.stats.linregress returns
+LinregressResult = namedtuple('LinregressResult', (
+    'slope', 'intercept', 'rvalue', 'pvalue', 'stderr', 'intercept_stderr'
+))
+
+
+# scipy.stats.linregress for a whole stack of regressions at once.
+#   x: the shared predictor, shape (n,)
+#   y: the responses, shape (..., n) - e.g. subjects x channels x freqs
+# every field of the result has shape y.shape[:-1]. the numbers are the same
+# as linregress gives for each row (up to floating point error). rows that
+# contain NaN give NaN.
+def linregress(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = x.size
+    if y.shape[-1] != n:
+        raise ValueError(f"y has {y.shape[-1]} points along its last axis, "
+                         f"but x has {n}.")
+    if n < 3:
+        raise ValueError("Need at least 3 points to fit.")
+
+    # centered sums (biased, like the np.cov(x, y, bias=1) in scipy)
+    xmean = x.mean()
+    ymean = y.mean(axis=-1)
+    xm = x - xmean
+    ym = y - ymean[..., np.newaxis]
+    ssxm = np.dot(xm, xm) / n
+    ssym = np.einsum('...i,...i->...', ym, ym) / n
+    ssxym = ym @ xm / n
+
+    slope = ssxym / ssxm
+    intercept = ymean - slope * xmean
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rvalue = ssxym / np.sqrt(ssxm * ssym)
+    rvalue = np.where(ssym == 0, 0., np.clip(rvalue, -1., 1.))
+
+    df = n - 2
+    tiny = 1.0e-20
+    t = rvalue * np.sqrt(df / ((1.0 - rvalue + tiny) * (1.0 + rvalue + tiny)))
+    pvalue = 2 * scipy.stats.t.sf(np.abs(t), df)
+    stderr = np.sqrt((1 - rvalue ** 2) * ssym / ssxm / df)
+    intercept_stderr = stderr * np.sqrt(ssxm + xmean ** 2)
+
+    return LinregressResult(slope, intercept, rvalue, pvalue, stderr,
+                            intercept_stderr)
+
+
+# the frequencies that fall inside any of the bands (edges excluded)
+def bandmask(freqs, bands=bands):
+    freqs = np.asarray(freqs)
+    mask = np.zeros(freqs.shape, dtype=bool)
+    for fmin, fmax in bands:
+        mask |= (freqs > fmin) & (freqs < fmax)
+    return mask
+
+
+# fit a line to the log power spectrum, for every spectrum in psd at once.
+#   freqs: the frequencies, shape (n_freqs,)
+#   psd: the spectra, shape (..., n_freqs)
+#   space: 'semilog' (log power vs frequency) or
+#          'loglog' (log power vs log frequency, i.e. the 1/f exponent)
+def fit_1f(freqs, psd, bands=bands, space='loglog'):
+    freqs = np.asarray(freqs)
+    mask = bandmask(freqs, bands)
+    if space == 'semilog':
+        x = freqs[mask]
+    elif space == 'loglog':
+        x = np.log10(freqs[mask])
+    else:
+        raise ValueError(f"space should be 'semilog' or 'loglog', "
+                         f"not {space!r}.")
+    return linregress(x, np.log10(np.asarray(psd)[..., mask]))
@@ -0,0 +1,104 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+# the stimulus in the surround suppression task flickers at 25 Hz
+stimfreq = 25
+# which multiples of the stimulus frequency to look at
+harmonics = (1, 2)
+# the noise is estimated from this many frequency bins on either side of
+# each target, leaving out the skip bins right next to it (spectral leakage)
+n_neighbours = 10
+skip = 1
+
+
+# the frequencies to evaluate: for each harmonic the target itself and its
+# noise bins, spaced by the frequency resolution of the epoch (sfreq / n)
+def target_freqs(n_times, sfreq, stimfreq=stimfreq, harmonics=harmonics,
+                 n_neighbours=n_neighbours, skip=skip):
+    resolution = sfreq / n_times
+    offsets = np.arange(skip + 1, skip + n_neighbours + 1) * resolution
+    offsets = np.concatenate([[0], -offsets[::-1], offsets])
+    return np.array([h * stimfreq + offsets for h in harmonics])
+
+
+# the DFT at just the frequencies we need, as an n_freqs x n_times matrix.
+# it only depends on the epoch length and frequencies, so it is made once
+# and reused for every subject
+@lru_cache(maxsize=16)
+def _dft_matrix(freqs, n_times, sfreq):
+    t = np.arange(n_times) / sfreq
+    return np.exp(-2j * np.pi * np.outer(freqs, t)) * 2 / n_times
+
+
+# the amplitude spectrum at arbitrary frequencies (not just the FFT bins),
+# for a whole stack of signals at once.
+#   data: shape (..., n_times), e.g. epochs x channels x samples
+#   freqs: the frequencies, any shape
+# returns shape data.shape[:-1] + freqs.shape
+def amplitudes(data, sfreq, freqs):
+    data = np.asarray(data)
+    freqs = np.asarray(freqs, dtype=float)
+    n_times = data.shape[-1]
+    dft = _dft_matrix(tuple(freqs.ravel()), n_times, float(sfreq))
+    # remove the mean, so the DC offset doesn't leak into the low bins
+    data = data - data.mean(axis=-1, keepdims=True)
+    amp = np.abs(data @ dft.T)
+    return amp.reshape(data.shape[:-1] + freqs.shape)
+
+
+# amplitude and signal-to-noise ratio at each harmonic of the stimulus.
+#   data: shape (..., n_times)
+# the power is averaged over axis (the epochs) first, if given. the snr is
+# the power at the target over the mean power in the noise bins. returns
+# freqs (n_harmonics,), amplitude and snr (shape (..., n_harmonics))
+def snr(data, sfreq, axis=None, stimfreq=stimfreq, harmonics=harmonics,
+        n_neighbours=n_neighbours, skip=skip):
+    freqs = target_freqs(np.shape(data)[-1], sfreq, stimfreq, harmonics,
+                         n_neighbours, skip)
+    power = amplitudes(data, sfreq, freqs) ** 2
+    if axis is not None:
+        power = power.mean(axis=axis)
+    signal = power[..., 0]
+    noise = power[..., 1:].mean(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = signal / noise
+    return freqs[:, 0], np.sqrt(signal), ratio
+
+
+# a tidy table of the SSVEP in every subject, condition (event code),
+# channel and harmonic. epochs is an iterable of mne epochs, like
+# surround_suppression.epochs(); bad channels are left out.
+def snr_table(epochs, stimfreq=stimfreq, harmonics=harmonics,
+              n_neighbours=n_neighbours, skip=skip):
+    import pandas as pd
+    tables = []
+    for epoch in epochs:
+        info = epoch.info
+        picks = [i for i, ch in enumerate(info['ch_names'])
+                 if ch not in info['bads']]
+        data = epoch.get_data()[:, picks]
+        codes = epoch.events[:, 2]
+        conditions = np.unique(codes)
+        # the power is averaged over the epochs of each condition
+        results = [snr(data[codes == code], info['sfreq'], axis=0,
+                       stimfreq=stimfreq, harmonics=harmonics,
+                       n_neighbours=n_neighbours, skip=skip)
+                   for code in conditions]
+        freqs = results[0][0]
+        amplitude = np.stack([amp for _, amp, _ in results])
+        ratio = np.stack([ratio for _, _, ratio in results])
+        # conditions x channels x harmonics, flattened into rows
+        shape = amplitude.shape
+        tables.append(pd.DataFrame({
+            'subject': info['subject_info'],
+            'condition': np.repeat(conditions, shape[1] * shape[2]),
+            'channel': np.tile(np.repeat([info['ch_names'][i] for i in picks],
+                                         shape[2]), shape[0]),
+            'harmonic': np.tile(harmonics, shape[0] * shape[1]),
+            'frequency': np.tile(freqs, shape[0] * shape[1]),
+            'amplitude': amplitude.ravel(),
+            'snr': ratio.ravel(),
+        }))
+    return pd.concat(tables, ignore_index=True)
@@ -0,0 +1,174 @@
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+from data import csvformat
+from data import npystore
+
+
+# welch power spectra of whole recordings, without loading them: the PSD is
+# a running sum over windows, so memory doesn't grow with the length.
+#   - from the binary store (npystore), blocks of windows are read from the
+#     memory-map, all channels at once
+#   - from a csv file (one line per channel), one channel is parsed at a
+#     time. with the average reference that needs a first pass to sum up the
+#     channels, so this holds one channel's worth of samples at most
+# the result is the same as scipy.signal.welch with the default settings
+# (hann window, constant detrend, density scaling, mean over windows)
+#
+# the spectra can also be split up by time, e.g. into the eyes open and eyes
+# closed parts of the resting state recording:
+#
+#   for (pid, csvfile), eventarray in zip(zip(resting.restfiles['id'],
+#                                             resting.restfiles['data']),
+#                                         resting.events()):
+#       freqs, psds, counts = welch(csvfile,
+#                                   segments=event_segments(eventarray))
+#       psds['eyes closed']  # channels x freqs
+
+
+# the resting state event codes
+restcodes = {20: 'eyes open', 30: 'eyes closed'}
+
+
+# turn an event array into segments: each event of one of the codes starts
+# a segment that lasts until the next one (or the end of the recording).
+# returns {label: [(start, stop), ...]} in samples (stop None = the end)
+def event_segments(events, codes=restcodes):
+    events = np.asarray(events)
+    events = events[np.isin(events[:, 2], list(codes))]
+    events = events[np.argsort(events[:, 0], kind='stable')]
+    segments = {label: [] for label in codes.values()}
+    stops = list(events[1:, 0]) + [None]
+    for (start, _, code), stop in zip(events, stops):
+        segments[codes[code]].append((int(start), stop if stop is None
+                                      else int(stop)))
+    return segments
+
+
+# the start samples of the windows that fit in [start, stop)
+def _window_starts(start, stop, nperseg, step):
+    return np.arange(start, stop - nperseg + 1, step)
+
+
+# accumulate the periodograms of a stack of windows into total
+#   x: channels x samples, holding every window in starts (offset by first)
+def _add_windows(total, x, starts, first, nperseg, window):
+    windows = np.lib.stride_tricks.sliding_window_view(
+        x, nperseg, axis=-1)[:, starts - first]
+    windows = windows - windows.mean(axis=-1, keepdims=True)
+    spectra = scipy.fft.rfft(windows * window, axis=-1)
+    total += (spectra.real ** 2 + spectra.imag ** 2).sum(axis=1)
+
+
+# the welch psd of a recording, from the binary store or the csv.
+#   segments: {label: [(start, stop), ...]} (see event_segments). the
+#             default is one segment, 'all', covering the whole recording
+#   reference: 'average' to re-reference to the average of the good
+#              channels first, or None
+#   blocksize: how many windows to read and transform at once
+# returns the frequencies, {label: channels x freqs psd} and {label: number
+# of windows}. flat (bad) channels are NaN.
+def welch(csvfile, sfreq=500, nperseg=1000, noverlap=500, fmin=0,
+          fmax=np.inf, segments=None, reference='average', n_channels=None,
+          blocksize=64):
+    if segments is None:
+        segments = {'all': [(0, None)]}
+    if reference not in ('average', None):
+        raise ValueError(f"reference should be 'average' or None, "
+                         f"not {reference!r}.")
+    step = nperseg - noverlap
+    window = scipy.signal.get_window('hann', nperseg)
+    freqs = scipy.fft.rfftfreq(nperseg, 1. / sfreq)
+
+    entry = npystore.load(csvfile)
+    if entry is not None:
+        data, sidecar = entry
+        flat = np.array(sidecar['flat'], dtype=bool)
+        totals, counts = _welch_array(data, flat, segments, nperseg, step,
+                                      window, reference, blocksize)
+    else:
+        totals, counts, flat = _welch_csv(csvfile, segments, nperseg, step,
+                                          window, reference, n_channels,
+                                          blocksize)
+
+    # density scaling, one-sided (like scipy.signal.welch)
+    scale = 1 / (sfreq * (window ** 2).sum())
+    fmask = (freqs >= fmin) & (freqs <= fmax)
+    psds = {}
+    for label, total in totals.items():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            psd = total * scale / counts[label]
+        psd[:, 1:] *= 2
+        if nperseg % 2 == 0:
+            psd[:, -1] /= 2
+        psd[flat] = np.nan
+        psds[label] = psd[:, fmask]
+    return freqs[fmask], psds, counts
+
+
+def _welch_array(data, flat, segments, nperseg, step, window, reference,
+                 blocksize):
+    n_channels, n_samples = data.shape
+    totals = {label: np.zeros((n_channels, nperseg // 2 + 1))
+              for label in segments}
+    counts = dict.fromkeys(segments, 0)
+    for label, ranges in segments.items():
+        for start, stop in ranges:
+            stop = n_samples if stop is None else min(stop, n_samples)
+            starts = _window_starts(start, stop, nperseg, step)
+            # a block of windows at a time, straight from the memory-map
+            for i in range(0, starts.size, blocksize):
+                block = starts[i:i + blocksize]
+                x = np.array(data[:, block[0]:block[-1] + nperseg],
+                             dtype=float)
+                if reference == 'average':
+                    x -= x[~flat].mean(axis=0)
+                _add_windows(totals[label], x, block, block[0], nperseg,
+                             window)
+            counts[label] += starts.size
+    return totals, counts
+
+
+def _welch_csv(csvfile, segments, nperseg, step, window, reference,
+               n_channels, blocksize):
+    if n_channels is None:
+        n_channels = csvformat.count_lines(csvfile)
+
+    # first pass for the average reference: the sum of all channels (the
+    # flat ones add nothing) and which channels are flat
+    if reference == 'average':
+        total = None
+        flat = np.zeros(n_channels, dtype=bool)
+        for row, x in enumerate(_channels(csvfile)):
+            total = x if total is None else total + x
+            flat[row] = not x.any()
+        average = total / max(1, (~flat).sum())
+
+    totals = {label: np.zeros((n_channels, nperseg // 2 + 1))
+              for label in segments}
+    counts = dict.fromkeys(segments, 0)
+    flat = np.zeros(n_channels, dtype=bool)
+    for row, x in enumerate(_channels(csvfile)):
+        flat[row] = not x.any()
+        if reference == 'average':
+            x = x - average
+        for label, ranges in segments.items():
+            for start, stop in ranges:
+                stop = x.size if stop is None else min(stop, x.size)
+                starts = _window_starts(start, stop, nperseg, step)
+                for i in range(0, starts.size, blocksize):
+                    block = starts[i:i + blocksize]
+                    _add_windows(totals[label][row:row + 1],
+                                 x[np.newaxis, block[0]:block[-1] + nperseg],
+                                 block, block[0], nperseg, window)
+                if row == 0:
+                    counts[label] += starts.size
+    return totals, counts, flat
+
+
+# the channels of a csv_format file, one at a time
+def _channels(csvfile):
+    with open(csvfile, 'rb') as f:
+        for line in csvformat._lines(f):
+            yield np.fromstring(line, dtype=float, sep=',')
@@ -0,0 +1,211 @@
+from pathlib import Path
+import warnings
+
+import numpy as np
+import scipy.stats
+
+from data import tables
+
+
+# correlations between every spectral metric and every phenotype at once,
+# instead of one scipy.stats.pearsonr per pair. subjects with a missing
+# value only drop out of the pairs that value is in (like pairwise complete
+# observations in R), which is done with masked matrix products: every sum
+# pearson's r needs is a (metrics x subjects) @ (subjects x phenotypes)
+# product. permutations and bootstrap resamples are batches of the same
+# products, so they cost a few more matrix multiplications rather than a
+# python loop per pair.
+#
+#   metrics = metric_table(fits, pids, ch_names)
+#   results = associate(metrics, load_phenotypes(), n_permutations=1000,
+#                       n_bootstrap=1000)
+#   save(results, 'rest-1f')
+#
+# the results are a tidy table (one row per metric and phenotype) in
+# data/interim/associations, which pandas (or R, via feather) can read a
+# column at a time.
+outfolder = Path(__file__).resolve().parents[2] / 'data' / 'interim' / \
+    'associations'
+
+
+# a float array with the missing values set to 0 after centering each
+# column, and a float mask of the values that are there
+def _prepare(x):
+    x = np.array(x, dtype=float)
+    mask = np.isfinite(x)
+    # (columns without any values stay all-missing)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        x -= np.nanmean(np.where(mask, x, np.nan), axis=0)
+    x[~mask] = 0
+    return x, mask.astype(float)
+
+
+# pearson's r and the number of pairs for every column of x against every
+# column of y.
+#   x, mx: subjects x metrics (centered, 0 where missing) and its mask
+#   y, my: (batch x) subjects x phenotypes, and its mask
+#   w: (batch x) subjects weights, e.g. how often each subject was drawn
+# returns n and r, (batch x) metrics x phenotypes
+def _pearson(x, mx, y, my, w=None):
+    xt, mxt, xxt = x.T, mx.T, (x ** 2).T
+    if w is not None:
+        w = w[..., np.newaxis, :]
+        xt, mxt, xxt = xt * w, mxt * w, xxt * w
+    n = mxt @ my
+    sx = xt @ my
+    sy = mxt @ y
+    sxx = xxt @ my
+    syy = mxt @ y ** 2
+    sxy = xt @ y
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx ** 2) *
+                                          (n * syy - sy ** 2))
+    r = np.clip(r, -1, 1)
+    r[n < 3] = np.nan
+    return n, r
+
+
+# two-sided p-values of r with n pairs (the same as scipy.stats.pearsonr)
+def _pvalue(r, n):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = r * np.sqrt((n - 2) / ((1 - r) * (1 + r)))
+        p = 2 * scipy.stats.t.sf(np.abs(t), n - 2)
+    return np.where(np.abs(r) == 1, 0., p)
+
+
+# correlations of every column of x with every column of y.
+# returns n, r and p, each metrics x phenotypes
+def pearson(x, y):
+    x, mx = _prepare(x)
+    y, my = _prepare(y)
+    n, r = _pearson(x, mx, y, my)
+    return n, r, _pvalue(r, n)
+
+
+# permutation p-values: the phenotypes are shuffled across subjects (all
+# columns together), batch permutations at a time. two-sided, and
+# (1 + count) / (1 + n_permutations) so they are never 0
+def permutation_p(x, y, n_permutations=1000, batch=100, seed=0):
+    rng = np.random.default_rng(seed)
+    x, mx = _prepare(x)
+    y, my = _prepare(y)
+    _, r = _pearson(x, mx, y, my)
+    # (a little tolerance, so permutations that give the same r count)
+    observed = np.abs(r) - 1e-12
+    count = np.zeros(r.shape)
+    for start in range(0, n_permutations, batch):
+        size = min(batch, n_permutations - start)
+        order = np.argsort(rng.random((size, y.shape[0])), axis=1)
+        _, rperm = _pearson(x, mx, y[order], my[order])
+        count += (np.abs(rperm) >= observed).sum(axis=0)
+    p = (1 + count) / (1 + n_permutations)
+    p[np.isnan(r)] = np.nan
+    return p
+
+
+# bootstrap percentile confidence intervals of r: subjects are drawn with
+# replacement, which is the same as weighting each one by how often it was
+# drawn, so every resample in a batch is one weighted product
+def bootstrap_ci(x, y, n_bootstrap=1000, ci=0.95, batch=100, seed=0):
+    rng = np.random.default_rng(seed)
+    x, mx = _prepare(x)
+    y, my = _prepare(y)
+    n_subjects = x.shape[0]
+    samples = []
+    for start in range(0, n_bootstrap, batch):
+        size = min(batch, n_bootstrap - start)
+        w = rng.multinomial(n_subjects, np.full(n_subjects, 1 / n_subjects),
+                            size=size).astype(float)
+        samples.append(_pearson(x, mx, y, my, w)[1])
+    samples = np.concatenate(samples)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, high = np.nanpercentile(samples, [50 * (1 - ci), 50 * (1 + ci)],
+                                     axis=0)
+    return low, high
+
+
+# benjamini-hochberg adjusted p-values (q-values) of any shape. NaNs are
+# left out of the correction and stay NaN
+def fdr(p):
+    p = np.asarray(p, dtype=float)
+    q = np.full(p.shape, np.nan)
+    finite = np.isfinite(p)
+    values = p[finite]
+    if values.size == 0:
+        return q
+    order = np.argsort(values)
+    ranked = values[order] * values.size / np.arange(1, values.size + 1)
+    # make them monotonic, from the largest p down
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    adjusted = np.empty(values.size)
+    adjusted[order] = np.minimum(ranked, 1)
+    q[finite] = adjusted
+    return q
+
+
+# correlate every metric with every phenotype.
+#   metrics: data frame, subjects (index) x metrics
+#   phenotypes: data frame, subjects (index) x phenotypes. only the numeric
+#               columns are used, unless columns says which ones
+#   n_permutations, n_bootstrap: 0 to leave out the permutation p-values or
+#                                the confidence intervals
+# returns a data frame with one row per metric and phenotype: n, r, p and
+# its fdr q-value (over all pairs), and optionally p_perm / q_perm and
+# ci_low / ci_high
+def associate(metrics, phenotypes, columns=None, n_permutations=0,
+              n_bootstrap=0, ci=0.95, batch=100, seed=0):
+    import pandas as pd
+    if columns is None:
+        columns = list(phenotypes.select_dtypes('number').columns)
+    # (a subject that is in the phenotypes more than once only counts once,
+    # with its first row, so that the rows of x and y line up)
+    phenotypes = phenotypes[~phenotypes.index.duplicated()]
+    subjects = metrics.index[metrics.index.isin(phenotypes.index)]
+    x = metrics.loc[subjects].to_numpy(dtype=float)
+    y = phenotypes.loc[subjects, columns].to_numpy(dtype=float)
+
+    n, r, p = pearson(x, y)
+    results = {'n': n, 'r': r, 'p': p, 'q': fdr(p)}
+    if n_permutations:
+        results['p_perm'] = permutation_p(x, y, n_permutations, batch, seed)
+        results['q_perm'] = fdr(results['p_perm'])
+    if n_bootstrap:
+        results['ci_low'], results['ci_high'] = bootstrap_ci(
+            x, y, n_bootstrap, ci, batch, seed)
+
+    index = pd.MultiIndex.from_product([list(metrics.columns), columns],
+                                       names=['metric', 'phenotype'])
+    df = pd.DataFrame({key: value.ravel() for key, value in results.items()},
+                      index=index).reset_index()
+    df['n'] = df['n'].astype(int)
+    return df
+
+
+# the 1/f fits (as from powerlaw.fit_1f, subjects x channels, one per
+# space) as a subjects x metrics table: the average over good channels,
+# and every channel on its own, e.g. loglog_slope_mean, loglog_slope_E12
+def metric_table(fits, pids, ch_names=None, fields=('slope', 'intercept')):
+    import pandas as pd
+    columns = {}
+    for space, fit in fits.items():
+        for field in fields:
+            values = np.asarray(getattr(fit, field), dtype=float)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                columns[f'{space}_{field}_mean'] = np.nanmean(values, axis=1)
+            names = ch_names if ch_names is not None else [
+                str(i) for i in range(values.shape[1])]
+            for channel, name in enumerate(names):
+                columns[f'{space}_{field}_{name}'] = values[:, channel]
+    df = pd.DataFrame(columns, index=pd.Index(list(pids), name='EID'))
+    return df
+
+
+def save(results, name):
+    return tables.write(results, outfolder / name)
+
+
+def load(name, columns=None):
+    return tables.read(outfolder / name, columns=columns)
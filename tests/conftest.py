@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# make the data and src packages importable however pytest is started
+project_dir = Path(__file__).resolve().parents[1]
+if str(project_dir) not in sys.path:
+    sys.path.insert(0, str(project_dir))
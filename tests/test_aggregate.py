@@ -0,0 +1,55 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from data import pheno
+from src.features.aggregate import aggregate
+
+
+# the phenotype file that comes with the release, with its columnar copy
+# in a temporary folder
+@pytest.fixture
+def phenotypes(tmp_path, monkeypatch):
+    monkeypatch.setattr(pheno, 'phenofile', Path(pheno.__file__).parent /
+                        'HBN_S1_Pheno_data.csv')
+    monkeypatch.setattr(pheno, 'cachefile', tmp_path / 'phenotypes')
+    monkeypatch.setattr(pheno, '_memo', {})
+    return pheno.load_phenotypes()
+
+
+def test_subjects_are_listed_once(phenotypes):
+    assert phenotypes.index.is_unique
+    assert 'NDARAV031PPJ' in phenotypes.index
+    # also when only some columns are read from the columnar copy
+    pheno._memo.clear()
+    ages = pheno.load_phenotypes(columns=['Age'])
+    assert ages.index.is_unique
+    assert ages['Age'].equals(phenotypes['Age'])
+
+
+def test_aggregate_by_age(phenotypes):
+    rng = np.random.default_rng(0)
+    pids = ['NDARAV031PPJ'] + list(phenotypes.index[:30]) + ['NDARXX000XXX']
+    freqs = np.arange(1., 31)
+    spectra = {pid: rng.random((4, freqs.size)) for pid in pids}
+    edges = [5, 10, 15, 22]
+
+    # (the phenotypes are loaded by aggregate itself)
+    agg = aggregate(((pid, freqs, spectra[pid]) for pid in pids),
+                    bins={'Age': edges})
+
+    assert agg.pids == pids
+    np.testing.assert_allclose(agg.moments.mean,
+                               np.mean(list(spectra.values()), axis=0))
+    ages = phenotypes['Age'].reindex(pids)
+    for b, (low, high) in agg.binned['Age'].labels().items():
+        inbin = [pid for pid, age in ages.items() if low <= age < high]
+        moments = agg.binned['Age'][b]
+        assert (moments.count == len(inbin)).all()
+        np.testing.assert_allclose(
+            moments.mean, np.mean([spectra[pid] for pid in inbin], axis=0))
+    # everyone with an age in range is in a bin, once
+    assert sum(agg.binned['Age'][b].count.max()
+               for b in agg.binned['Age'].bins) == \
+        ((ages >= 5) & (ages < 22)).sum()
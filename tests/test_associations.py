@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats
+
+from src.models import associations
+
+
+@pytest.fixture
+def tables():
+    rng = np.random.default_rng(0)
+    pids = [f'NDAR{i:08d}' for i in range(40)]
+    metrics = pd.DataFrame(rng.normal(size=(40, 3)),
+                           columns=['slope', 'intercept', 'rvalue'],
+                           index=pd.Index(pids, name='EID'))
+    metrics.iloc[[2, 5], 0] = np.nan
+    phenotypes = pd.DataFrame(
+        {'Age': metrics['slope'].to_numpy() + rng.normal(size=40),
+         'EHQ_Total': rng.normal(size=40),
+         'Sex': rng.integers(0, 2, 40).astype(float)},
+        index=pd.Index(pids, name='EID'))
+    phenotypes.iloc[[5, 7, 11], 1] = np.nan
+    # not every subject has phenotypes, and some without metrics do
+    phenotypes = pd.concat([phenotypes.iloc[3:], pd.DataFrame(
+        {'Age': [10.], 'EHQ_Total': [0.], 'Sex': [1.]},
+        index=pd.Index(['NDAR99999999'], name='EID'))])
+    return metrics, phenotypes
+
+
+# r, p and n of every pair are scipy's, on the subjects that have both
+def check(results, metrics, phenotypes):
+    assert len(results) == metrics.shape[1] * phenotypes.shape[1]
+    for row in results.itertuples():
+        x = metrics[row.metric]
+        y = phenotypes[row.phenotype]
+        both = pd.concat([x, y], axis=1, join='inner').dropna()
+        r, p = scipy.stats.pearsonr(both.iloc[:, 0], both.iloc[:, 1])
+        assert row.n == len(both)
+        assert row.r == pytest.approx(r, abs=1e-10)
+        assert row.p == pytest.approx(p, rel=1e-8)
+
+
+def test_same_as_scipy(tables):
+    metrics, phenotypes = tables
+    check(associations.associate(metrics, phenotypes), metrics, phenotypes)
+
+
+# a subject in the phenotype table twice (NDARAV031PPJ is, in the real
+# one) counts once, with its first row
+def test_duplicate_subjects(tables):
+    metrics, phenotypes = tables
+    duplicated = pd.concat([phenotypes, phenotypes.iloc[[4]] + 100])
+    results = associations.associate(metrics, duplicated)
+    check(results, metrics, phenotypes)
+
+
+def test_fdr():
+    p = np.array([0.01, 0.04, np.nan, 0.03, 0.5])
+    q = associations.fdr(p)
+    assert np.isnan(q[2])
+    np.testing.assert_allclose(q[[0, 3, 1, 4]], [0.04, 0.0533333, 0.0533333,
+                                                 0.5], rtol=1e-5)
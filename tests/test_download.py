@@ -0,0 +1,177 @@
+import hashlib
+
+import pytest
+
+from data import download
+
+
+content = bytes(range(256)) * 40
+etag = '"' + hashlib.md5(content).hexdigest() + '"'
+key = 'data/Projects/HBN/S1/EEG/NDARAA000AAA.tar.gz'
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+# serves one file like S3 does: a Range request gets the rest of the file
+# (206), unless If-Range names an ETag that no longer matches (200, all of it)
+class FakeSession:
+
+    def __init__(self, body=content, etag=etag, honour_range=True):
+        self.body = body
+        self.etag = etag
+        self.honour_range = honour_range
+        self.requests = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        headers = headers or {}
+        self.requests.append((url, headers))
+        if ('Range' in headers and self.honour_range and
+                headers.get('If-Range', self.etag) == self.etag):
+            start = int(headers['Range'][len('bytes='):-1])
+            return FakeResponse(206, self.body[start:])
+        return FakeResponse(200, self.body)
+
+
+class Progress:
+
+    def __init__(self):
+        self.n = 0
+
+    def update(self, n):
+        self.n += n
+
+
+def fileobj(etag=etag):
+    return {'Key': key, 'Size': len(content), 'ETag': etag}
+
+
+def partfile(tmp_path):
+    return tmp_path / 'NDARAA000AAA.tar.gz.part'
+
+
+def test_download(tmp_path):
+    session = FakeSession()
+    target = download._download_file(session, fileobj(), tmp_path,
+                                     'http://test/', Progress())
+    assert target.read_bytes() == content
+    assert session.requests == [('http://test/' + key, {})]
+    assert not partfile(tmp_path).exists()
+
+
+def test_resume_with_range_and_etag(tmp_path):
+    partfile(tmp_path).write_bytes(content[:1000])
+    session = FakeSession()
+    progress = Progress()
+    target = download._download_file(session, fileobj(), tmp_path,
+                                     'http://test/', progress)
+    assert target.read_bytes() == content
+    _, headers = session.requests[0]
+    assert headers == {'Range': 'bytes=1000-', 'If-Range': etag}
+    assert progress.n == len(content)
+
+
+def test_restart_when_the_server_sends_everything(tmp_path):
+    partfile(tmp_path).write_bytes(b'x' * 1000)
+    session = FakeSession(honour_range=False)
+    target = download._download_file(session, fileobj(), tmp_path,
+                                     'http://test/', Progress())
+    assert target.read_bytes() == content
+
+
+def test_changed_file_fails_the_checksum(tmp_path):
+    # the listing still has the old ETag, but the file has been replaced
+    partfile(tmp_path).write_bytes(content[:1000])
+    changed = content[::-1]
+    session = FakeSession(body=changed,
+                          etag='"' + hashlib.md5(changed).hexdigest() + '"')
+    with pytest.raises(IOError, match='checksum'):
+        download._download_file(session, fileobj(), tmp_path,
+                                'http://test/', Progress())
+    # the server ignored the range (the ETag didn't match), and the bad
+    # part file is gone so the next run starts from scratch
+    assert session.requests[0][1]['If-Range'] == etag
+    assert not partfile(tmp_path).exists()
+    assert not (tmp_path / 'NDARAA000AAA.tar.gz').exists()
+
+
+# a part file that is longer than the file is thrown away, rather than
+# failing the same way on every run
+def test_restart_when_the_part_file_is_too_long(tmp_path):
+    partfile(tmp_path).write_bytes(content + b'xxxx')
+    session = FakeSession()
+    target = download._download_file(session, fileobj(), tmp_path,
+                                     'http://test/', Progress())
+    assert target.read_bytes() == content
+    assert session.requests == [('http://test/' + key, {})]
+
+
+def test_complete_file_is_not_fetched_again(tmp_path):
+    (tmp_path / 'NDARAA000AAA.tar.gz').write_bytes(content)
+    session = FakeSession()
+    download._download_file(session, fileobj(), tmp_path, 'http://test/',
+                            Progress())
+    assert session.requests == []
+
+
+def _archive(tmp_path, eid='NDARAA000AAA'):
+    import io
+    import tarfile
+    archive = tmp_path / f'{eid}.tar.gz'
+    with tarfile.open(archive, 'w:gz') as tar:
+        for name in ('EEG/preprocessed/csv_format/RestingState_data.csv',
+                     'EEG/raw/csv_format/RestingState_data.csv'):
+            info = tarfile.TarInfo(f'{eid}/{name}')
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b'1,2'))
+    return archive
+
+
+def test_extract_all_redoes_partial_folders(tmp_path):
+    archive = _archive(tmp_path)
+    # left over from an interrupted extraction
+    (tmp_path / 'NDARAA000AAA' / 'EEG').mkdir(parents=True)
+    download.extract_all(dest=tmp_path, workers=1)
+    folder = tmp_path / 'NDARAA000AAA'
+    assert download.is_extracted(folder)
+    assert (folder / 'EEG/preprocessed/csv_format/RestingState_data.csv'
+            ).read_bytes() == b'1,2'
+    assert not (folder / 'EEG' / 'raw').exists()
+    assert not archive.exists()
+
+
+def test_extract_all_keeps_archive_if_extraction_fails(tmp_path):
+    archive = tmp_path / 'NDARAA000AAA.tar.gz'
+    archive.write_bytes(b'not a tar file')
+    (tmp_path / 'NDARAA000AAA').mkdir()
+    download.extract_all(dest=tmp_path, workers=1)
+    assert archive.exists()
+    assert not download.is_extracted(tmp_path / 'NDARAA000AAA')
+
+
+# a folder that never finished extracting (and has lost its archive) is
+# downloaded again
+def test_missing_needs_finished_folders(tmp_path):
+    other = key.replace('NDARAA000AAA', 'NDARBB000BBB')
+    listing = [fileobj(), dict(fileobj(), Key=other)]
+    (tmp_path / 'NDARAA000AAA').mkdir()
+    (tmp_path / 'NDARBB000BBB').mkdir()
+    (tmp_path / 'NDARBB000BBB' / download.donefile).write_text('')
+    assert download.missing(listing, dest=tmp_path) == [listing[0]]
@@ -0,0 +1,136 @@
+import json
+import pickle
+
+import numpy as np
+import pytest
+
+pytest.importorskip('mne')
+
+from data import derivations  # noqa: E402
+from data.interim import freqanalysis  # noqa: E402
+
+
+ch_names = ['E1', 'E2', 'E3']
+pids = ['NDARAA000AAA', 'NDARBB000BBB']
+
+
+@pytest.fixture
+def folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(freqanalysis, 'picklefolder',
+                        tmp_path / 'freqanalysis')
+    # (the content hashes of the pickles are remembered in here)
+    connect = derivations._connect
+    monkeypatch.setattr(derivations, '_connect',
+                        lambda: connect(tmp_path / 'index.sqlite'))
+    (tmp_path / 'freqanalysis').mkdir()
+    (tmp_path / 'info').mkdir()
+    for pid in pids:
+        with open(tmp_path / 'info' / f'rest-{pid}.pickle', 'wb') as f:
+            pickle.dump({'ch_names': ch_names, 'bads': ['E2']}, f)
+    return tmp_path / 'freqanalysis'
+
+
+def params(fmax):
+    return {'tmax': 200., 'fmin': 1., 'fmax': fmax}
+
+
+# what the pipeline does: the spectra of every subject, from 1 to fmax Hz
+# (all value, or fmax)
+def make_pickles(folder, fmax, subjects=pids, value=None):
+    freqs = np.arange(1., fmax + 1)
+    for pid in subjects:
+        with open(folder / f'rest-{pid}.pickle', 'wb') as f:
+            pickle.dump((freqs, np.ones((2, freqs.size)) *
+                         (value if value is not None else fmax)), f)
+
+
+def test_consolidate(folder):
+    freqanalysis.set_params(params(30.))
+    make_pickles(folder, 30.)
+    freqanalysis.consolidate('rest')
+    loaded, freqs, names, psd, stored = freqanalysis.load('rest')
+    assert loaded == pids
+    assert freqs[-1] == 30
+    assert names == ch_names
+    assert stored == params(30.)
+    # the bad channel is NaN
+    assert np.isnan(psd[:, 1]).all()
+    assert (psd[:, [0, 2]] == 30).all()
+
+
+def test_new_params_replace_the_old_spectra(folder):
+    freqanalysis.set_params(params(30.))
+    make_pickles(folder, 30.)
+    freqanalysis.consolidate('rest', params=params(30.))
+    # the same parameters keep everything
+    assert not freqanalysis.set_params(params(30.))
+    assert len(freqanalysis.picklefiles('rest')) == 2
+
+    assert freqanalysis.set_params(params(40.))
+    assert freqanalysis.picklefiles('rest') == {}
+    assert not freqanalysis.storefolder('rest').exists()
+    make_pickles(folder, 40.)
+    freqanalysis.consolidate('rest', params=params(40.))
+    loaded, freqs, _, psd, stored = freqanalysis.load('rest')
+    assert loaded == pids
+    assert freqs[-1] == 40
+    assert stored == params(40.)
+    assert (psd[:, 0] == 40).all()
+
+
+# a store made with other parameters is filled again from the pickles,
+# rather than keeping its subjects
+def test_consolidate_with_other_params(folder):
+    make_pickles(folder, 30.)
+    freqanalysis.consolidate('rest', params=params(30.))
+    make_pickles(folder, 40.)
+    freqanalysis.consolidate('rest', params=params(40.))
+    _, freqs, _, psd, stored = freqanalysis.load('rest')
+    assert freqs[-1] == 40
+    assert stored == params(40.)
+    assert (psd[:, 0] == 40).all()
+
+
+# a pickle that is written again (the data or the code changed) replaces
+# the spectrum in the store, and unchanged ones aren't read again
+def test_consolidate_picks_up_rewritten_pickles(folder, monkeypatch):
+    freqanalysis.set_params(params(30.))
+    make_pickles(folder, 30., value=1.)
+    freqanalysis.consolidate('rest')
+    make_pickles(folder, 30., subjects=pids[:1], value=5.)
+    read = []
+    psds = freqanalysis.psds
+
+    def reading(recording, subjects):
+        read.extend(subjects)
+        return psds(recording, subjects)
+
+    monkeypatch.setattr(freqanalysis, 'psds', reading)
+    freqanalysis.consolidate('rest')
+    assert read == pids[:1]
+    loaded, _, _, psd, _ = freqanalysis.load('rest')
+    assert loaded == pids
+    assert (psd[0, 0] == 5).all()
+    assert (psd[1, 0] == 1).all()
+    # nothing changed, nothing to do
+    read.clear()
+    freqanalysis.consolidate('rest')
+    assert read == []
+
+
+# chunks written before the keys were kept are still read, and their
+# subjects are added again once
+def test_chunks_without_keys(folder):
+    freqanalysis.set_params(params(30.))
+    make_pickles(folder, 30.)
+    freqanalysis.consolidate('rest')
+    store = freqanalysis.storefolder('rest')
+    for file in store.glob('*.json'):
+        if file.name != 'params.json':
+            chunk = json.loads(file.read_text())
+            file.write_text(json.dumps(chunk['pids']))
+    assert freqanalysis.index('rest') == pids
+    assert set(freqanalysis.keys('rest').values()) == {None}
+    freqanalysis.consolidate('rest')
+    assert None not in freqanalysis.keys('rest').values()
+    assert freqanalysis.load('rest')[0] == pids
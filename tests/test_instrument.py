@@ -0,0 +1,46 @@
+import multiprocessing
+
+import pytest
+
+from data import instrument
+
+
+@pytest.fixture(autouse=True)
+def off():
+    yield
+    instrument.disable()
+
+
+def _record(path):
+    instrument.enable(path)
+    with instrument.stage('work', 'NDARAA000AAA'):
+        pass
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.jsonl'])
+def test_records(tmp_path, suffix):
+    path = instrument.enable(tmp_path / f'profile{suffix}')
+    for stage in ['read', 'psd']:
+        with instrument.stage(stage, 'NDARAA000AAA'):
+            pass
+    df = instrument.load(path)
+    assert list(df['stage']) == ['read', 'psd']
+    assert set(df['subject']) == {'NDARAA000AAA'}
+
+
+# processes that start recording to the same chrome trace at once still
+# give one '[' at the top
+def test_chrome_trace_from_many_processes(tmp_path):
+    path = tmp_path / 'profile.json'
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_record, args=(path,))
+                 for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    text = path.read_text()
+    assert text.startswith('[\n')
+    assert text.count('[') == 1
+    assert len(instrument.load(path)) == 4
+    assert list(tmp_path.iterdir()) == [path]
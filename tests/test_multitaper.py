@@ -0,0 +1,98 @@
+from importlib import metadata
+
+import numpy as np
+import pytest
+import scipy.signal
+
+from src.features import multitaper
+
+
+@pytest.mark.parametrize('version, sym', [
+    ('0.19.2', True), ('1.2.1', True), ('1.3.0', False), ('1.13.2', False),
+    (None, False)])
+def test_tapers_follow_the_mne_version(monkeypatch, version, sym):
+    def fake_version(name):
+        if version is None:
+            raise metadata.PackageNotFoundError(name)
+        return version
+
+    monkeypatch.setattr(metadata, 'version', fake_version)
+    multitaper.symmetric.cache_clear()
+    try:
+        assert multitaper.symmetric() is sym
+    finally:
+        multitaper.symmetric.cache_clear()
+
+
+def test_symmetric_tapers():
+    dpss, eigvals = multitaper.tapers(1000, 500., sym=True)
+    expected, ratios = scipy.signal.windows.dpss(1000, 4., 8,
+                                                 return_ratios=True)
+    keep = ratios > 0.9
+    np.testing.assert_allclose(dpss, expected[keep])
+    np.testing.assert_allclose(eigvals, ratios[keep])
+    x = np.random.default_rng(0).normal(size=(2, 1000))
+    symmetric, _ = multitaper.psd_array(x, 500, sym=True)
+    periodic, _ = multitaper.psd_array(x, 500, sym=False)
+    assert not np.allclose(symmetric, periodic, rtol=1e-4)
+
+
+# mne's psd_array_multitaper (psd_multitaper works on Raw / Epochs and
+# calls it), with the defaults multitaper.psd_array copies. the tests that
+# use it are skipped without mne
+def mne_psd(x, sfreq, normalization='length', **kwargs):
+    mne = pytest.importorskip('mne')
+    return mne.time_frequency.psd_array_multitaper(
+        x, sfreq, adaptive=False, low_bias=True, normalization=normalization,
+        verbose=False, **kwargs)
+
+
+@pytest.fixture
+def signals():
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(4, 3, 1000))
+
+
+@pytest.mark.parametrize('n_times', [1000, 999])
+@pytest.mark.parametrize('fmin, fmax', [(0, np.inf), (1, 30)])
+def test_same_as_mne(signals, n_times, fmin, fmax):
+    x = signals[..., :n_times]
+    psd, freqs = multitaper.psd_array(x, 500, fmin=fmin, fmax=fmax)
+    expected, expected_freqs = mne_psd(x, 500, fmin=fmin, fmax=fmax)
+    np.testing.assert_allclose(freqs, expected_freqs)
+    np.testing.assert_allclose(psd, expected, rtol=1e-10)
+
+
+def test_bandwidth_and_full_normalization(signals):
+    psd, freqs = multitaper.psd_array(signals, 250, bandwidth=2.,
+                                      normalization='full')
+    expected, _ = mne_psd(signals, 250, bandwidth=2., normalization='full')
+    np.testing.assert_allclose(psd, expected, rtol=1e-10)
+
+
+def test_chunks_and_out(signals):
+    out = np.empty(signals.shape[:-1] + (501,))
+    psd, _ = multitaper.psd_array(signals, 500, out=out, chunksize=1)
+    assert psd is out
+    expected, _ = mne_psd(signals, 500)
+    np.testing.assert_allclose(out, expected, rtol=1e-10)
+
+
+def test_float32(signals):
+    psd, _ = multitaper.psd_array(signals, 500, dtype='float32')
+    expected, _ = mne_psd(signals, 500)
+    assert psd.dtype == np.float32
+    np.testing.assert_allclose(psd, expected, rtol=1e-3)
+
+
+# a channel with a NaN in it gives a NaN spectrum, and leaves the other
+# channels in its chunk alone
+def test_nan_rows(signals):
+    x = signals.copy()
+    x[1, 2, 10] = np.nan
+    psd, _ = multitaper.psd_array(x, 500)
+    assert np.isnan(psd[1, 2]).all()
+    ok = np.ones(x.shape[:-1], dtype=bool)
+    ok[1, 2] = False
+    expected, _ = mne_psd(signals, 500)
+    np.testing.assert_allclose(psd[ok], expected[ok], rtol=1e-10)
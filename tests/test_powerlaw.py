@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import scipy.stats
+
+from src.features import powerlaw
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    x = np.linspace(1, 30, 40)
+    y = -1.5 * x[np.newaxis, np.newaxis] + rng.normal(size=(3, 5, x.size))
+    # a row with a NaN in it
+    y[1, 2, 7] = np.nan
+    return x, y
+
+
+def test_linregress_matches_scipy(data):
+    x, y = data
+    result = powerlaw.linregress(x, y)
+    for i in range(y.shape[0]):
+        for j in range(y.shape[1]):
+            if np.isnan(y[i, j]).any():
+                continue
+            expected = scipy.stats.linregress(x, y[i, j])
+            for field in powerlaw.LinregressResult._fields:
+                np.testing.assert_allclose(
+                    getattr(result, field)[i, j], getattr(expected, field),
+                    rtol=1e-10, err_msg=field)
+
+
+def test_linregress_nan_rows(data):
+    x, y = data
+    result = powerlaw.linregress(x, y)
+    for field in powerlaw.LinregressResult._fields:
+        values = getattr(result, field)
+        assert np.isnan(values[1, 2]), field
+        assert np.isfinite(np.delete(values.ravel(), 1 * 5 + 2)).all(), field
+
+
+def test_fit_1f_matches_scipy():
+    freqs = np.arange(1, 31, 0.5)
+    psd = 10 ** (-1.2 * np.log10(freqs) +
+                 np.random.default_rng(1).normal(0, 0.05, (4, freqs.size)))
+    mask = powerlaw.bandmask(freqs)
+    for space, xfit in (('loglog', np.log10(freqs[mask])),
+                        ('semilog', freqs[mask])):
+        result = powerlaw.fit_1f(freqs, psd, space=space)
+        for row in range(psd.shape[0]):
+            expected = scipy.stats.linregress(xfit, np.log10(psd[row, mask]))
+            np.testing.assert_allclose(result.slope[row], expected.slope,
+                                       rtol=1e-10)
+            np.testing.assert_allclose(result.intercept[row],
+                                       expected.intercept, rtol=1e-10)
+
+
+def test_linregress_checks_shapes():
+    with pytest.raises(ValueError):
+        powerlaw.linregress(np.arange(5), np.zeros((2, 4)))
+    with pytest.raises(ValueError):
+        powerlaw.linregress(np.arange(2), np.zeros(2))
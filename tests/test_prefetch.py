@@ -0,0 +1,85 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from data.prefetch import PrefetchError, loading, prefetch
+
+
+# a generator that counts how many of its items have been loaded and not
+# used yet
+class Counting:
+
+    def __init__(self, n, size=0):
+        self.n = n
+        self.size = size
+        self.loaded = 0
+        self.used = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        for i in range(self.n):
+            with self.lock:
+                self.loaded += 1
+                self.most = max(self.most, self.loaded - self.used)
+            yield np.zeros(self.size, dtype=np.uint8)
+
+    def use(self):
+        with self.lock:
+            self.used += 1
+
+
+def test_order():
+    assert list(prefetch(iter(range(20)), depth=3)) == list(range(20))
+
+
+@pytest.mark.parametrize('depth', [1, 2, 4])
+def test_never_more_than_depth_ahead(depth):
+    items = Counting(12)
+    for _ in prefetch(items, depth=depth):
+        # give the producer time to run ahead as far as it can
+        time.sleep(0.01)
+        items.use()
+    # (the one being used counts as loaded and not used yet)
+    assert items.most <= depth + 1
+
+
+def test_max_bytes():
+    items = Counting(10, size=1000)
+    for _ in prefetch(items, depth=10, max_bytes=1500):
+        time.sleep(0.01)
+        items.use()
+    # two items go over max_bytes, plus the one being used
+    assert items.most <= 3
+
+
+def pids():
+    for pid in ['NDARAA000AAA', 'NDARBB000BBB', 'NDARCC000CCC']:
+        with loading(pid):
+            if pid == 'NDARBB000BBB':
+                raise OSError('no such file')
+        yield (pid, None, None)
+
+
+def test_error_names_the_failing_subject():
+    loaded = []
+    with pytest.raises(PrefetchError) as info:
+        for item in prefetch(pids(), depth=2):
+            loaded.append(item[0])
+    assert loaded == ['NDARAA000AAA']
+    assert info.value.subject == 'NDARBB000BBB'
+    assert info.value.index == 1
+    assert isinstance(info.value.__cause__, OSError)
+
+
+def test_loader_error_names_the_subject():
+    def load(pid):
+        if pid == 'b':
+            raise ValueError(pid)
+        return pid
+
+    with pytest.raises(PrefetchError) as info:
+        list(prefetch(load, subjects=['a', 'b', 'c'], workers=2))
+    assert info.value.subject == 'b'
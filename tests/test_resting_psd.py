@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip('click')
+pytest.importorskip('dotenv')
+
+from src.data import resting_psd  # noqa: E402
+
+
+def params(tmax):
+    return {'tmax': tmax, 'fmin': 1., 'fmax': 30., 'reference': 'average',
+            'method': 'multitaper'}
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    monkeypatch.setattr(resting_psd, 'failurelog',
+                        tmp_path / 'rest-failures.jsonl')
+
+
+def entry(pid, status):
+    return {'pid': pid, 'status': status, 'message': '', 'seconds': 0,
+            'cache': {}}
+
+
+# a skip only holds for the parameters it was made with
+def test_skips_follow_the_parameters(log):
+    resting_psd._log_failure(entry('NDARAA000AAA', 'skipped'), params(200.))
+    resting_psd._log_failure(entry('NDARBB000BBB', 'skipped'), params(200.))
+    assert resting_psd._previously_skipped(params(200.)) == {
+        'NDARAA000AAA', 'NDARBB000BBB'}
+    assert resting_psd._previously_skipped(params(100.)) == set()
+
+
+def test_failures_are_retried(log):
+    resting_psd._log_failure(entry('NDARAA000AAA', 'skipped'), params(200.))
+    resting_psd._log_failure(entry('NDARAA000AAA', 'failed'), params(200.))
+    assert resting_psd._previously_skipped(params(200.)) == set()
+
+
+# entries from before the parameters were logged don't count
+def test_old_entries(log):
+    with open(resting_psd.failurelog, 'w') as f:
+        f.write('{"pid": "NDARAA000AAA", "status": "skipped"}\n')
+    assert resting_psd._previously_skipped(params(200.)) == set()